@@ -147,6 +147,8 @@ def install():
     run('git clone https://github.com/PierreRochard/ofxtools')
     with cd('/home/ec2-user/ofxtools/'):
         run('sudo python setup.py install')
+    # The OFX functions only support this ofxtools release
+    run('python -c "import pkg_resources; pkg_resources.require(\'ofxtools==0.3.8\')"')
 
     put('pacioli/settings.py', '/home/ec2-user/pacioli/pacioli/settings.py')
     run('mkdir ~/pacioli/logs/')
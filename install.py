@@ -23,9 +23,12 @@ def install_dependencies():
     run_command(['pip', '--no-cache-dir', 'install', '--upgrade', '-r',
                  'instance-requirements.txt'])
 
+    # pacioli.functions.ofx_functions relies on ofxtools internals and
+    # refuses to import with any other version
     custom_repos = [{'package': 'ofxtools',
                      'url': 'https://github.com/PierreRochard/ofxtools',
-                     'branch': None},
+                     'branch': None,
+                     'version': '0.3.8'},
                     ]
     for repo in custom_repos:
         directory = os.path.join(library_directory, repo['package'])
@@ -40,6 +43,9 @@ def install_dependencies():
                             cwd=directory)
             run_command(['git', 'pull'], cwd=directory)
         run_command([python, 'setup.py', 'install'], cwd=directory)
+        if repo['version']:
+            subprocess.check_call([python, '-c', 'import pkg_resources; '
+                                   'pkg_resources.require("{package}=={version}")'.format(**repo)])
 
 
 def setup_settings():
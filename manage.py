@@ -7,17 +7,13 @@ import platform
 import subprocess
 
 from dateutil.tz import tzlocal
-from flask import current_app
 from flask_migrate import MigrateCommand, Migrate
 from flask_script import Manager, Server
 from flask_script.commands import ShowUrls, Clean
 from flask_security.utils import encrypt_password
 from flask_mail import Message
-from ofxtools.ofxalchemy import OFXParser
 from ofxtools.ofxalchemy import Base as OFX_Base
-from sqlalchemy import create_engine
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import scoped_session, sessionmaker
 
 from pacioli import create_app, mail
 from pacioli.extensions import db
@@ -115,22 +111,35 @@ def create_admin(email, password):
     db.session.commit()
 
 
+@manager.option('-d', '--directory', dest='directory',
+                default=os.path.join('configuration_files', 'data'))
+@manager.option('-p', '--processes', dest='processes', type=int, default=1)
+def import_ofx(directory, processes):
+    from pacioli.functions.ofx_functions import import_ofx_files
+    directory = os.path.abspath(directory)
+    files = [os.path.join(directory, ofx_file) for ofx_file in sorted(os.listdir(directory))
+             if ofx_file.endswith(('.ofx', '.OFX', '.qfx', '.QFX'))]
+    import_ofx_files(files, processes=processes)
+
+
+@manager.command
+def archive_connection_responses():
+    from pacioli.functions.ofx_functions import archive_connection_responses
+    archived, stored = archive_connection_responses()
+    print('Archived {0} responses into {1} new blobs'.format(archived, stored))
+
+
 @manager.command
-def import_ofx():
-    from pacioli.functions.ofx_functions import fix_ofx_file
-    directory = os.path.abspath(os.path.join('configuration_files', 'data'))
-    files = [ofx_file for ofx_file in os.listdir(directory) if ofx_file.endswith(('.ofx', '.OFX', '.qfx', '.QFX'))]
-    for ofx_file_name in files:
-        ofx_file_path = os.path.join(directory, ofx_file_name)
-        parser = OFXParser()
-        engine = create_engine(current_app.config['SQLALCHEMY_DATABASE_URI'], echo=False)
-        DBSession = scoped_session(sessionmaker())
-        DBSession.configure(bind=engine)
-        if 'fixed' not in ofx_file_path:
-            ofx_file_path = fix_ofx_file(ofx_file_path)
-        parser.parse(ofx_file_path)
-        parser.instantiate()
-        DBSession.commit()
+def show_pool_status():
+    from pacioli.database import pool_status
+    print(pool_status())
+
+
+@manager.option('-p', '--processes', dest='processes', type=int, default=1)
+@manager.option('-s', '--shards', dest='shards', type=int, default=None)
+def rebuild_trial_balances(processes, shards):
+    from pacioli.functions.accounting_functions import refresh_trial_balances
+    refresh_trial_balances(processes=processes, shards=shards)
 
 
 @manager.command
@@ -190,6 +199,19 @@ def import_amazon_report():
     fetch_amazon_email_download()
 
 
+@manager.option('path')
+@manager.option('-p', '--processes', dest='processes', type=int, default=1)
+def import_amazon_csv(path, processes):
+    from pacioli.functions.amazon_functions import import_amazon_csv_files
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = [os.path.join(path, csv_file) for csv_file in sorted(os.listdir(path))
+                 if csv_file.lower().endswith('.csv')]
+    else:
+        files = [path]
+    import_amazon_csv_files(files, processes=processes)
+
+
 @manager.command
 def populate_chart_of_accounts():
     chart_of_accounts_csv = os.path.join(os.path.dirname(__file__), 'Generic Chart of Accounts.csv')
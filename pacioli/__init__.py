@@ -3,7 +3,7 @@ from flask_security import Security
 from flask_admin import helpers as admin_helpers
 
 from pacioli import settings
-from pacioli.extensions import admin, mail, db
+from pacioli.extensions import admin, cache, mail, db
 from pacioli.models import Users, Roles, user_datastore
 
 
@@ -14,6 +14,7 @@ def create_app(config_object, env="prod"):
     app.config['ENV'] = env
     db.init_app(app)
     mail.init_app(app)
+    cache.init_app(app)
     security = Security(app, user_datastore)
 
     @security.context_processor
@@ -0,0 +1,43 @@
+from ofxtools.ofxalchemy import DBSession as OFXSession
+from sqlalchemy import create_engine
+
+from pacioli.extensions import db
+
+ofx_session_engine = None
+worker_engine = None
+
+
+def bind_ofx_session(engine):
+    global ofx_session_engine
+    if ofx_session_engine is not engine:
+        OFXSession.remove()
+        OFXSession.configure(bind=engine)
+        ofx_session_engine = engine
+    return OFXSession
+
+
+def ofx_session():
+    """
+    Return the ofxtools scoped session, bound once to the application's
+    engine so OFX ingestion shares Flask-SQLAlchemy's connection pool.
+    """
+    return bind_ofx_session(db.engine)
+
+
+def init_worker(database_uri):
+    """
+    Process pool initializer: each worker process gets one engine with a
+    single connection, and the ofxtools session is bound to it.
+    """
+    global worker_engine
+    worker_engine = create_engine(database_uri, pool_size=1, max_overflow=0)
+    bind_ofx_session(worker_engine)
+
+
+def pool_status(engine=None):
+    pool = (engine or db.engine).pool
+    return dict(pool=pool.__class__.__name__,
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow())
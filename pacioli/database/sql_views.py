@@ -1,97 +1,458 @@
-from pacioli.models import db
+from sqlalchemy import text
+
+from pacioli.models import db, MappingOverlaps
 
 
 def create_all():
+    alter_connection_responses()
+    alter_connections()
+    create_subaccounts_name_index()
+    create_table_versions_trigger_function()
+    create_ofx_description_trigger_function()
+    create_ofx_transaction_key_trigger_function()
     create_ofx_views()
+    create_position_snapshots_trigger_function()
+    create_journal_entry_period_keys_trigger_function()
     create_trial_balances_trigger_function()
+    create_financial_statements_trigger_function()
+    create_subaccount_lineage_trigger_function()
     create_amazon_views()
     create_bookkeeping_views()
-    create_mappings_views()
+    create_mapping_overlaps_trigger_function()
+
+
+# Tables whose writes invalidate the cached list counts of the admin views,
+# bookkeeping.trial_balances gets its trigger with the others on that table
+VERSIONED_TABLES = ['admin.connection_responses',
+                    'amazon.items',
+                    'bookkeeping.financial_statement_lines',
+                    'bookkeeping.journal_entries',
+                    'ofx.invtran',
+                    'ofx.stmttrn']
+
+
+def create_subaccounts_name_index():
+    # Databases created before subaccount names were unique only get the
+    # index here, write_journal_entries needs it as its ON CONFLICT target
+    duplicates = [name for name, in db.engine.execute("""
+        SELECT name
+          FROM bookkeeping.subaccounts
+          GROUP BY name
+          HAVING count(*) > 1
+          ORDER BY name;
+        """)]
+    if duplicates:
+        raise ValueError('Subaccount names must be unique, rename or merge the '
+                         'duplicates first: {0}'.format(', '.join(duplicates)))
+
+    db.engine.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS subaccounts_name_key
+          ON bookkeeping.subaccounts (name);
+        """)
+
+
+def create_table_versions_trigger_function():
+    # Each write adds a version row instead of incrementing one row per
+    # table, which would hold concurrent writers of the table until the
+    # first one commits. Older versions are pruned unless another writer
+    # holds them. The table used to be keyed by name alone, so it is
+    # rekeyed and emptied, which only invalidates the cached counts.
+    with db.engine.begin() as connection:
+        connection.execute("""
+            CREATE SEQUENCE IF NOT EXISTS admin.table_versions_version_seq;
+            TRUNCATE admin.table_versions;
+            ALTER TABLE admin.table_versions
+              DROP CONSTRAINT table_versions_pkey,
+              ADD CONSTRAINT table_versions_pkey PRIMARY KEY (table_name, version);
+            """)
+
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION admin.add_table_version(_table_name VARCHAR)
+        RETURNS VOID AS $$
+          DECLARE
+            _version BIGINT := nextval('admin.table_versions_version_seq');
+          BEGIN
+            INSERT INTO admin.table_versions (table_name, version)
+              VALUES (_table_name, _version);
+            DELETE FROM admin.table_versions
+              WHERE (table_name, version) IN (
+                SELECT table_name, version
+                  FROM admin.table_versions
+                  WHERE table_name = _table_name
+                    AND version < _version
+                  FOR UPDATE SKIP LOCKED);
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
+
+        CREATE OR REPLACE FUNCTION admin.bump_table_version()
+        RETURNS trigger AS $$
+          BEGIN
+            PERFORM admin.add_table_version(TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME);
+            RETURN NULL;
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
+        """)
+
+    for table_name in VERSIONED_TABLES:
+        create_table_version_trigger(db.engine, table_name)
+
+
+def create_table_version_trigger(connection, table_name):
+    connection.execute("""
+        DROP TRIGGER IF EXISTS table_version_trigger
+            ON {0};
+        CREATE TRIGGER table_version_trigger
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+            ON {0}
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE admin.bump_table_version();
+        """.format(table_name))
+
+
+def bump_table_version(connection, table_name):
+    # For changes that fire no trigger, like a table swapped in by rename
+    connection.execute(text("""
+        SELECT admin.add_table_version(:table_name);
+        """), table_name=table_name)
+
+
+# Period key columns of bookkeeping.journal_entries
+PERIOD_KEY_COLUMNS = ['period_year',
+                      'period_quarter',
+                      'period_month',
+                      'period_week',
+                      'period_day']
+
+
+def create_journal_entry_period_keys_trigger_function():
+    db.engine.execute("""
+        ALTER TABLE bookkeeping.journal_entries
+          ADD COLUMN IF NOT EXISTS period_year VARCHAR,
+          ADD COLUMN IF NOT EXISTS period_quarter VARCHAR,
+          ADD COLUMN IF NOT EXISTS period_month VARCHAR,
+          ADD COLUMN IF NOT EXISTS period_week VARCHAR,
+          ADD COLUMN IF NOT EXISTS period_day VARCHAR;
+        """)
+
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION bookkeeping.journal_entry_period_keys()
+        RETURNS trigger AS $$
+          BEGIN
+            new.period_year := to_char(new.timestamp, 'YYYY');
+            new.period_quarter := to_char(new.timestamp, 'YYYY-Q');
+            new.period_month := to_char(new.timestamp, 'YYYY-MM');
+            new.period_week := to_char(new.timestamp, 'YYYY-WW');
+            new.period_day := to_char(new.timestamp, 'YYYY-MM-DD');
+            RETURN new;
+          END;
+        $$
+        LANGUAGE  plpgsql;
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS journal_entry_period_keys_trigger
+            ON bookkeeping.journal_entries;
+        CREATE TRIGGER journal_entry_period_keys_trigger
+            BEFORE INSERT OR UPDATE OF timestamp
+            ON bookkeeping.journal_entries
+            FOR EACH ROW
+            EXECUTE PROCEDURE bookkeeping.journal_entry_period_keys();
+        """)
+
+    # The baseline trigger recomputed the trial balances of every updated
+    # entry, it has to go before the backfill updates the whole journal
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS subaccount_insert_trigger
+            ON bookkeeping.journal_entries;
+        DROP FUNCTION IF EXISTS bookkeeping.subaccount_insert_triggered();
+        """)
+
+    db.engine.execute("""
+        UPDATE bookkeeping.journal_entries
+          SET period_year = to_char("timestamp", 'YYYY'),
+              period_quarter = to_char("timestamp", 'YYYY-Q'),
+              period_month = to_char("timestamp", 'YYYY-MM'),
+              period_week = to_char("timestamp", 'YYYY-WW'),
+              period_day = to_char("timestamp", 'YYYY-MM-DD')
+          WHERE period_day IS NULL;
+        CREATE INDEX IF NOT EXISTS journal_entries_debit_subaccount_timestamp_index
+          ON bookkeeping.journal_entries (debit_subaccount, "timestamp");
+        CREATE INDEX IF NOT EXISTS journal_entries_credit_subaccount_timestamp_index
+          ON bookkeeping.journal_entries (credit_subaccount, "timestamp");
+        """)
+
+    # The period dropdown of a subaccount's journal lists its distinct
+    # periods from these
+    for period_key in PERIOD_KEY_COLUMNS:
+        db.engine.execute("""
+            CREATE INDEX IF NOT EXISTS journal_entries_debit_subaccount_{0}_index
+              ON bookkeeping.journal_entries (debit_subaccount, {0});
+            CREATE INDEX IF NOT EXISTS journal_entries_credit_subaccount_{0}_index
+              ON bookkeeping.journal_entries (credit_subaccount, {0});
+            """.format(period_key))
 
 
 def create_trial_balances_trigger_function():
+    db.engine.execute("""
+    DROP FUNCTION IF EXISTS
+      bookkeeping.update_trial_balance(VARCHAR, VARCHAR, VARCHAR);
+    """)
+
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION
+      bookkeeping.trial_balance_deltas(
+          _subaccounts VARCHAR[],
+          _period_years VARCHAR[],
+          _period_quarters VARCHAR[],
+          _period_months VARCHAR[],
+          _period_weeks VARCHAR[],
+          _period_days VARCHAR[],
+          _debit_amounts NUMERIC[],
+          _credit_amounts NUMERIC[]
+      ) RETURNS TABLE (
+          subaccount VARCHAR,
+          period_interval VARCHAR,
+          period VARCHAR,
+          debit_amount NUMERIC,
+          credit_amount NUMERIC
+      ) AS $$
+        SELECT entries.subaccount,
+               periods.period_interval,
+               periods.period,
+               sum(entries.debit_amount),
+               sum(entries.credit_amount)
+        FROM unnest(_subaccounts, _period_years, _period_quarters,
+                    _period_months, _period_weeks, _period_days,
+                    _debit_amounts, _credit_amounts)
+          AS entries(subaccount, period_year, period_quarter,
+                     period_month, period_week, period_day,
+                     debit_amount, credit_amount)
+        CROSS JOIN LATERAL (VALUES
+            ('YYYY', entries.period_year),
+            ('YYYY-Q', entries.period_quarter),
+            ('YYYY-MM', entries.period_month),
+            ('YYYY-WW', entries.period_week),
+            ('YYYY-MM-DD', entries.period_day)
+          ) AS periods(period_interval, period)
+        GROUP BY 1, 2, 3;
+    $$
+    LANGUAGE sql IMMUTABLE;
+    """)
+
     db.engine.execute("""
     CREATE OR REPLACE FUNCTION
-      bookkeeping.update_trial_balance(
-          _subaccount VARCHAR,
-          period_interval_name VARCHAR,
-          period_name VARCHAR
+      bookkeeping.apply_trial_balance_deltas(
+          _subaccounts VARCHAR[],
+          _period_years VARCHAR[],
+          _period_quarters VARCHAR[],
+          _period_months VARCHAR[],
+          _period_weeks VARCHAR[],
+          _period_days VARCHAR[],
+          _debit_amounts NUMERIC[],
+          _credit_amounts NUMERIC[]
       ) RETURNS VOID AS $$
-      DECLARE
-          existing_debit_record RECORD;
-          existing_credit_record RECORD;
-          debit_balance_amount NUMERIC;
-          debit_changes_amount NUMERIC;
-          credit_balance_amount NUMERIC;
-          credit_changes_amount NUMERIC;
+      BEGIN
+
+      -- Missing change rows start from the running balance of the
+      -- subaccount's closest earlier period.
+      INSERT INTO bookkeeping.trial_balances
+        (subaccount, period_interval, period,
+          debit_balance, credit_balance, net_balance,
+          debit_changes, credit_changes, net_changes)
+      SELECT deltas.subaccount, deltas.period_interval, deltas.period,
+             coalesce(prior.debit_balance, 0),
+             coalesce(prior.credit_balance, 0),
+             coalesce(prior.net_balance, 0),
+             0, 0, 0
+        FROM bookkeeping.trial_balance_deltas(
+               _subaccounts, _period_years, _period_quarters,
+               _period_months, _period_weeks, _period_days,
+               _debit_amounts, _credit_amounts) AS deltas
+        LEFT JOIN LATERAL (
+          SELECT tb.debit_balance, tb.credit_balance, tb.net_balance
+            FROM bookkeeping.trial_balances tb
+            WHERE tb.subaccount = deltas.subaccount
+              AND tb.period_interval = deltas.period_interval
+              AND tb.period < deltas.period
+            ORDER BY tb.period DESC
+            LIMIT 1
+        ) AS prior ON TRUE
+      ON CONFLICT (subaccount, period_interval, period) DO NOTHING;
 
+      -- Each delta changes its own period and rolls every later running
+      -- balance of the same subaccount and interval forward.
+      UPDATE bookkeeping.trial_balances
+        SET debit_balance = bookkeeping.trial_balances.debit_balance
+                              + rollup.debit_balance_delta,
+            credit_balance = bookkeeping.trial_balances.credit_balance
+                              + rollup.credit_balance_delta,
+            net_balance = bookkeeping.trial_balances.net_balance
+                              + rollup.debit_balance_delta
+                              - rollup.credit_balance_delta,
+            debit_changes = bookkeeping.trial_balances.debit_changes
+                              + rollup.debit_changes_delta,
+            credit_changes = bookkeeping.trial_balances.credit_changes
+                              + rollup.credit_changes_delta,
+            net_changes = bookkeeping.trial_balances.net_changes
+                              + rollup.debit_changes_delta
+                              - rollup.credit_changes_delta
+        FROM (
+          SELECT tb.id,
+                 sum(deltas.debit_amount) AS debit_balance_delta,
+                 sum(deltas.credit_amount) AS credit_balance_delta,
+                 sum(CASE WHEN deltas.period = tb.period
+                          THEN deltas.debit_amount ELSE 0
+                     END) AS debit_changes_delta,
+                 sum(CASE WHEN deltas.period = tb.period
+                          THEN deltas.credit_amount ELSE 0
+                     END) AS credit_changes_delta
+            FROM bookkeeping.trial_balance_deltas(
+                   _subaccounts, _period_years, _period_quarters,
+                   _period_months, _period_weeks, _period_days,
+                   _debit_amounts, _credit_amounts) AS deltas
+            JOIN bookkeeping.trial_balances tb
+              ON tb.subaccount = deltas.subaccount
+                AND tb.period_interval = deltas.period_interval
+                AND tb.period >= deltas.period
+            GROUP BY tb.id
+        ) AS rollup
+        WHERE bookkeeping.trial_balances.id = rollup.id;
+
+      RETURN;
+      END;
+    $$
+    SECURITY DEFINER
+    LANGUAGE  plpgsql;
+    """)
+
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION bookkeeping.journal_entries_changed()
+        RETURNS trigger AS $$
+          BEGIN
+            IF TG_OP = 'INSERT' THEN
+              PERFORM bookkeeping.apply_trial_balance_deltas(
+                    array_agg(legs.subaccount),
+                    array_agg(changes.period_year),
+                    array_agg(changes.period_quarter),
+                    array_agg(changes.period_month),
+                    array_agg(changes.period_week),
+                    array_agg(changes.period_day),
+                    array_agg(legs.debit_amount),
+                    array_agg(legs.credit_amount))
+                FROM new_entries AS changes
+                CROSS JOIN LATERAL (VALUES
+                    (changes.debit_subaccount, changes.functional_amount, 0),
+                    (changes.credit_subaccount, 0, changes.functional_amount)
+                  ) AS legs(subaccount, debit_amount, credit_amount);
+            ELSIF TG_OP = 'UPDATE' THEN
+              PERFORM bookkeeping.apply_trial_balance_deltas(
+                    array_agg(legs.subaccount),
+                    array_agg(changes.period_year),
+                    array_agg(changes.period_quarter),
+                    array_agg(changes.period_month),
+                    array_agg(changes.period_week),
+                    array_agg(changes.period_day),
+                    array_agg(legs.debit_amount),
+                    array_agg(legs.credit_amount))
+                FROM (SELECT debit_subaccount, credit_subaccount,
+                             period_year, period_quarter, period_month,
+                             period_week, period_day, functional_amount
+                        FROM new_entries
+                      UNION ALL
+                      SELECT debit_subaccount, credit_subaccount,
+                             period_year, period_quarter, period_month,
+                             period_week, period_day, -functional_amount
+                        FROM old_entries) AS changes
+                CROSS JOIN LATERAL (VALUES
+                    (changes.debit_subaccount, changes.functional_amount, 0),
+                    (changes.credit_subaccount, 0, changes.functional_amount)
+                  ) AS legs(subaccount, debit_amount, credit_amount);
+            ELSIF TG_OP = 'DELETE' THEN
+              PERFORM bookkeeping.apply_trial_balance_deltas(
+                    array_agg(legs.subaccount),
+                    array_agg(changes.period_year),
+                    array_agg(changes.period_quarter),
+                    array_agg(changes.period_month),
+                    array_agg(changes.period_week),
+                    array_agg(changes.period_day),
+                    array_agg(legs.debit_amount),
+                    array_agg(legs.credit_amount))
+                FROM old_entries AS changes
+                CROSS JOIN LATERAL (VALUES
+                    (changes.debit_subaccount, -changes.functional_amount, 0),
+                    (changes.credit_subaccount, 0, -changes.functional_amount)
+                  ) AS legs(subaccount, debit_amount, credit_amount);
+            END IF;
+            RETURN NULL;
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS journal_entries_insert_trigger
+            ON bookkeeping.journal_entries;
+        CREATE TRIGGER journal_entries_insert_trigger
+            AFTER INSERT
+            ON bookkeeping.journal_entries
+            REFERENCING NEW TABLE AS new_entries
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE bookkeeping.journal_entries_changed();
+
+        DROP TRIGGER IF EXISTS journal_entries_update_trigger
+            ON bookkeeping.journal_entries;
+        CREATE TRIGGER journal_entries_update_trigger
+            AFTER UPDATE
+            ON bookkeeping.journal_entries
+            REFERENCING OLD TABLE AS old_entries NEW TABLE AS new_entries
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE bookkeeping.journal_entries_changed();
+
+        DROP TRIGGER IF EXISTS journal_entries_delete_trigger
+            ON bookkeeping.journal_entries;
+        CREATE TRIGGER journal_entries_delete_trigger
+            AFTER DELETE
+            ON bookkeeping.journal_entries
+            REFERENCING OLD TABLE AS old_entries
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE bookkeeping.journal_entries_changed();
+        """)
+
+
+def create_subaccount_lineage_trigger_function():
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION
+      bookkeeping.refresh_subaccount_lineage(_subaccounts VARCHAR[])
+      RETURNS VOID AS $$
       BEGIN
 
-      SELECT coalesce(sum(functional_amount), 0) INTO debit_balance_amount
-        FROM bookkeeping.journal_entries
-        WHERE debit_subaccount = _subaccount
-          AND to_char(timestamp, period_interval_name) <= period_name;
+      DELETE FROM bookkeeping.subaccount_lineage
+        WHERE subaccount = ANY(_subaccounts);
 
-      SELECT coalesce(sum(functional_amount), 0) INTO debit_changes_amount
-        FROM bookkeeping.journal_entries
-        WHERE debit_subaccount = _subaccount
-          AND to_char(timestamp, period_interval_name) = period_name;
+      INSERT INTO bookkeeping.subaccount_lineage
+        (subaccount, account, classification, element, cash_source)
+      SELECT subaccounts.name, accounts.name, classifications.name,
+             classifications.parent, accounts.cash_source
+        FROM bookkeeping.subaccounts
+        LEFT OUTER JOIN bookkeeping.accounts
+          ON accounts.name = subaccounts.parent
+        LEFT OUTER JOIN bookkeeping.classifications
+          ON classifications.name = accounts.parent
+        WHERE subaccounts.name = ANY(_subaccounts);
 
-      SELECT * INTO existing_debit_record
-        FROM bookkeeping.trial_balances
-        WHERE bookkeeping.trial_balances.subaccount = _subaccount
-          AND bookkeeping.trial_balances.period = period_name
-          AND bookkeeping.trial_balances.period_interval = period_interval_name;
-
-      IF existing_debit_record IS NULL THEN
-        INSERT INTO bookkeeping.trial_balances
-          (subaccount, debit_balance, credit_balance,
-            net_balance, debit_changes, credit_changes,
-            net_changes, period, period_interval)
-        VALUES (_subaccount, debit_balance_amount, 0,
-            debit_balance_amount, debit_changes_amount, 0,
-            debit_changes_amount, period_name, period_interval_name);
-      ELSE
-        UPDATE bookkeeping.trial_balances
-          SET debit_balance = debit_balance_amount,
-              net_balance = debit_balance_amount - existing_debit_record.credit_balance,
-              debit_changes = debit_changes_amount,
-              net_changes = debit_changes_amount - existing_debit_record.credit_changes
-          WHERE id = existing_debit_record.id;
-      END IF;
-
-      SELECT coalesce(sum(functional_amount), 0) INTO credit_balance_amount
-        FROM bookkeeping.journal_entries
-        WHERE credit_subaccount = _subaccount
-          AND to_char(timestamp, period_interval_name) <= period_name;
-
-      SELECT coalesce(sum(functional_amount), 0) INTO credit_changes_amount
-        FROM bookkeeping.journal_entries
-        WHERE credit_subaccount = _subaccount
-          AND to_char(timestamp, period_interval_name) = period_name;
-
-      SELECT * INTO existing_credit_record
+      -- Statement lines carry the element, so moving a subaccount
+      -- around the chart moves its lines between statements.
+      PERFORM bookkeeping.refresh_financial_statements(
+                array_agg(subaccount),
+                array_agg(period_interval),
+                array_agg(period))
         FROM bookkeeping.trial_balances
-        WHERE subaccount = _subaccount
-          AND period = period_name
-          AND period_interval = period_interval_name;
-
-      IF existing_credit_record IS NULL THEN
-        INSERT INTO bookkeeping.trial_balances
-            (subaccount, debit_balance, credit_balance,
-              net_balance, debit_changes, credit_changes,
-              net_changes, period, period_interval)
-        VALUES (_subaccount, 0, credit_balance_amount,
-                -credit_balance_amount, 0, credit_changes_amount,
-                -credit_changes_amount, period_name, period_interval_name);
-      ELSE
-        UPDATE bookkeeping.trial_balances
-          SET credit_balance = credit_balance_amount,
-              net_balance = existing_credit_record.debit_balance - credit_balance_amount,
-              credit_changes = credit_changes_amount,
-              net_changes = existing_credit_record.debit_changes - credit_changes_amount
-          WHERE id = existing_credit_record.id;
-      END IF;
+        WHERE subaccount = ANY(_subaccounts);
 
       RETURN;
       END;
@@ -101,34 +462,41 @@ def create_trial_balances_trigger_function():
     """)
 
     db.engine.execute("""
-        CREATE OR REPLACE FUNCTION bookkeeping.subaccount_insert_triggered()
+        CREATE OR REPLACE FUNCTION bookkeeping.chart_of_accounts_changed()
         RETURNS trigger AS $$
-          DECLARE
-          period_intervals VARCHAR[5] := '{"YYYY", "YYYY-Q", "YYYY-MM",
-                                           "YYYY-WW", "YYYY-MM-DD"}';
-          period_interval_name VARCHAR;
-          period_name RECORD;
           BEGIN
-            <<period_interval_loop>>
-            FOREACH period_interval_name IN ARRAY period_intervals
-              LOOP
-                <<periods_loop>>
-                 FOR period_name in SELECT DISTINCT
-                          to_char(bookkeeping.journal_entries.timestamp,
-                          period_interval_name) AS p
-                    FROM bookkeeping.journal_entries
-                    WHERE bookkeeping.journal_entries.timestamp >= new.timestamp LOOP
-                  PERFORM bookkeeping.update_trial_balance(
-                        new.debit_subaccount,
-                        period_interval_name,
-                        period_name.p);
-                  PERFORM bookkeeping.update_trial_balance(
-                        new.credit_subaccount,
-                        period_interval_name,
-                        period_name.p);
-                END LOOP periods_loop;
-              END LOOP period_interval_loop;
-            RETURN new;
+            IF TG_TABLE_NAME = 'subaccounts' THEN
+              IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM bookkeeping.subaccount_lineage
+                  WHERE subaccount = old.name;
+              END IF;
+              IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM bookkeeping.refresh_subaccount_lineage(
+                      ARRAY[new.name]);
+              END IF;
+            ELSIF TG_TABLE_NAME = 'accounts' THEN
+              PERFORM bookkeeping.refresh_subaccount_lineage(
+                    array_agg(subaccounts.name))
+                FROM bookkeeping.subaccounts
+                WHERE subaccounts.parent IN (old.name, new.name);
+            ELSIF TG_TABLE_NAME = 'classifications' THEN
+              PERFORM bookkeeping.refresh_subaccount_lineage(
+                    array_agg(subaccounts.name))
+                FROM bookkeeping.subaccounts
+                JOIN bookkeeping.accounts
+                  ON accounts.name = subaccounts.parent
+                WHERE accounts.parent IN (old.name, new.name);
+            ELSIF TG_TABLE_NAME = 'elements' THEN
+              PERFORM bookkeeping.refresh_subaccount_lineage(
+                    array_agg(subaccounts.name))
+                FROM bookkeeping.subaccounts
+                JOIN bookkeeping.accounts
+                  ON accounts.name = subaccounts.parent
+                JOIN bookkeeping.classifications
+                  ON classifications.name = accounts.parent
+                WHERE classifications.parent IN (old.name, new.name);
+            END IF;
+            RETURN NULL;
           END;
         $$
         SECURITY DEFINER
@@ -136,21 +504,381 @@ def create_trial_balances_trigger_function():
         """)
 
     db.engine.execute("""
-        DROP TRIGGER IF EXISTS subaccount_insert_trigger
-            ON bookkeeping.journal_entries;
-        CREATE TRIGGER subaccount_insert_trigger
-            AFTER INSERT OR UPDATE
-            ON bookkeeping.journal_entries
+        DROP TRIGGER IF EXISTS subaccount_lineage_trigger
+            ON bookkeeping.subaccounts;
+        CREATE TRIGGER subaccount_lineage_trigger
+            AFTER INSERT OR DELETE OR UPDATE OF name, parent
+            ON bookkeeping.subaccounts
+            FOR EACH ROW
+            EXECUTE PROCEDURE bookkeeping.chart_of_accounts_changed();
+
+        DROP TRIGGER IF EXISTS account_lineage_trigger
+            ON bookkeeping.accounts;
+        CREATE TRIGGER account_lineage_trigger
+            AFTER UPDATE OF name, parent, cash_source
+            ON bookkeeping.accounts
+            FOR EACH ROW
+            EXECUTE PROCEDURE bookkeeping.chart_of_accounts_changed();
+
+        DROP TRIGGER IF EXISTS classification_lineage_trigger
+            ON bookkeeping.classifications;
+        CREATE TRIGGER classification_lineage_trigger
+            AFTER UPDATE OF name, parent
+            ON bookkeeping.classifications
+            FOR EACH ROW
+            EXECUTE PROCEDURE bookkeeping.chart_of_accounts_changed();
+
+        DROP TRIGGER IF EXISTS element_lineage_trigger
+            ON bookkeeping.elements;
+        CREATE TRIGGER element_lineage_trigger
+            AFTER UPDATE OF name
+            ON bookkeeping.elements
             FOR EACH ROW
-            EXECUTE PROCEDURE bookkeeping.subaccount_insert_triggered();
+            EXECUTE PROCEDURE bookkeeping.chart_of_accounts_changed();
+        """)
+
+    # A plain SELECT is not autocommitted by the engine
+    with db.engine.begin() as connection:
+        connection.execute("""
+            SELECT bookkeeping.refresh_subaccount_lineage(array_agg(name))
+              FROM bookkeeping.subaccounts;
+            """)
+
+
+def create_financial_statements_trigger_function():
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION
+      bookkeeping.financial_statement(_element VARCHAR)
+      RETURNS VARCHAR AS $$
+        SELECT CASE
+          WHEN _element IN ('Revenues', 'Expenses', 'Gains', 'Losses')
+            THEN 'Income Statement'
+          WHEN _element IN ('Assets', 'Liabilities',
+                            'Capital Contributions', 'Capital Distributions')
+            THEN 'Balance Sheet'
+        END;
+    $$
+    LANGUAGE sql IMMUTABLE;
+    """)
+
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION
+      bookkeeping.refresh_financial_statements(
+          _subaccounts VARCHAR[],
+          _period_intervals VARCHAR[],
+          _periods VARCHAR[]
+      ) RETURNS VOID AS $$
+      BEGIN
+
+      DELETE FROM bookkeeping.financial_statement_lines lines
+        USING unnest(_subaccounts, _period_intervals, _periods)
+          AS keys(subaccount, period_interval, period)
+        WHERE lines.subaccount = keys.subaccount
+          AND lines.period_interval = keys.period_interval
+          AND lines.period = keys.period;
+
+      INSERT INTO bookkeeping.financial_statement_lines
+        (period_interval, period, statement, element, subaccount,
+          net_changes, net_balance)
+      SELECT tb.period_interval, tb.period,
+             bookkeeping.financial_statement(lineage.element),
+             lineage.element, tb.subaccount,
+             tb.net_changes, tb.net_balance
+        FROM (SELECT DISTINCT * FROM unnest(_subaccounts,
+                                            _period_intervals, _periods)
+              ) AS keys(subaccount, period_interval, period)
+        JOIN bookkeeping.trial_balances tb
+          ON tb.subaccount = keys.subaccount
+            AND tb.period_interval = keys.period_interval
+            AND tb.period = keys.period
+        JOIN bookkeeping.subaccount_lineage lineage
+          ON lineage.subaccount = tb.subaccount
+        WHERE CASE bookkeeping.financial_statement(lineage.element)
+                WHEN 'Income Statement' THEN tb.net_changes != 0
+                WHEN 'Balance Sheet' THEN tb.net_balance != 0
+                ELSE FALSE
+              END;
+
+      DELETE FROM bookkeeping.financial_statement_totals totals
+        USING unnest(_period_intervals, _periods)
+          AS keys(period_interval, period)
+        WHERE totals.period_interval = keys.period_interval
+          AND totals.period = keys.period;
+
+      INSERT INTO bookkeeping.financial_statement_totals
+        (period_interval, period, net_income, net_equity)
+      SELECT lines.period_interval, lines.period,
+             sum(lines.net_changes)
+               FILTER (WHERE lines.statement = 'Income Statement'),
+             sum(lines.net_balance)
+               FILTER (WHERE lines.statement = 'Balance Sheet')
+        FROM bookkeeping.financial_statement_lines lines
+        JOIN (SELECT DISTINCT * FROM unnest(_period_intervals, _periods)
+              ) AS keys(period_interval, period)
+          ON lines.period_interval = keys.period_interval
+            AND lines.period = keys.period
+        GROUP BY 1, 2;
+
+      RETURN;
+      END;
+    $$
+    SECURITY DEFINER
+    LANGUAGE  plpgsql;
+    """)
+
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION
+      bookkeeping.rebuild_financial_statements() RETURNS VOID AS $$
+      BEGIN
+      TRUNCATE bookkeeping.financial_statement_lines,
+               bookkeeping.financial_statement_totals;
+      PERFORM bookkeeping.refresh_financial_statements(
+                array_agg(subaccount),
+                array_agg(period_interval),
+                array_agg(period))
+        FROM bookkeeping.trial_balances;
+      RETURN;
+      END;
+    $$
+    SECURITY DEFINER
+    LANGUAGE  plpgsql;
+    """)
+
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION bookkeeping.trial_balances_changed()
+        RETURNS trigger AS $$
+          BEGIN
+            IF TG_OP = 'INSERT' THEN
+              PERFORM bookkeeping.refresh_financial_statements(
+                    array_agg(subaccount),
+                    array_agg(period_interval),
+                    array_agg(period))
+                FROM new_balances;
+            ELSIF TG_OP = 'UPDATE' THEN
+              PERFORM bookkeeping.refresh_financial_statements(
+                    array_agg(subaccount),
+                    array_agg(period_interval),
+                    array_agg(period))
+                FROM (SELECT subaccount, period_interval, period
+                        FROM new_balances
+                      UNION
+                      SELECT subaccount, period_interval, period
+                        FROM old_balances) AS changes;
+            ELSIF TG_OP = 'DELETE' THEN
+              PERFORM bookkeeping.refresh_financial_statements(
+                    array_agg(subaccount),
+                    array_agg(period_interval),
+                    array_agg(period))
+                FROM old_balances;
+            END IF;
+            RETURN NULL;
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
         """)
 
+    create_trial_balances_triggers(db.engine)
+    # A plain SELECT is not autocommitted by the engine
+    with db.engine.begin() as connection:
+        connection.execute("""
+            SELECT bookkeeping.rebuild_financial_statements();
+            """)
+
+
+def create_trial_balances_triggers(connection):
+    connection.execute("""
+        DROP TRIGGER IF EXISTS trial_balances_insert_trigger
+            ON bookkeeping.trial_balances;
+        CREATE TRIGGER trial_balances_insert_trigger
+            AFTER INSERT
+            ON bookkeeping.trial_balances
+            REFERENCING NEW TABLE AS new_balances
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE bookkeeping.trial_balances_changed();
+
+        DROP TRIGGER IF EXISTS trial_balances_update_trigger
+            ON bookkeeping.trial_balances;
+        CREATE TRIGGER trial_balances_update_trigger
+            AFTER UPDATE
+            ON bookkeeping.trial_balances
+            REFERENCING OLD TABLE AS old_balances NEW TABLE AS new_balances
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE bookkeeping.trial_balances_changed();
+
+        DROP TRIGGER IF EXISTS trial_balances_delete_trigger
+            ON bookkeeping.trial_balances;
+        CREATE TRIGGER trial_balances_delete_trigger
+            AFTER DELETE
+            ON bookkeeping.trial_balances
+            REFERENCING OLD TABLE AS old_balances
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE bookkeeping.trial_balances_changed();
+        """)
+    create_table_version_trigger(connection, 'bookkeeping.trial_balances')
+
+
+def alter_connection_responses():
+    # Responses used to be stored as text; keep them readable as bytes.
+    # A DO block is not autocommitted by the engine
+    with db.engine.begin() as connection:
+        connection.execute("""
+            DO $$
+              BEGIN
+                IF EXISTS (SELECT 1 FROM information_schema.columns
+                             WHERE table_schema = 'admin'
+                               AND table_name = 'connection_responses'
+                               AND column_name = 'response'
+                               AND data_type != 'bytea') THEN
+                  ALTER TABLE admin.connection_responses
+                    ALTER COLUMN response TYPE BYTEA
+                    USING convert_to(response, 'UTF8');
+                END IF;
+              END;
+            $$;
+            """)
+
+    db.engine.execute("""
+        ALTER TABLE admin.connection_responses
+          ADD COLUMN IF NOT EXISTS status VARCHAR,
+          ADD COLUMN IF NOT EXISTS response_size INTEGER,
+          ADD COLUMN IF NOT EXISTS response_sha256 VARCHAR
+            REFERENCES admin.response_blobs (sha256);
+        CREATE INDEX IF NOT EXISTS ix_admin_connection_responses_response_sha256
+          ON admin.connection_responses (response_sha256);
+        """)
+
+
+def alter_connections():
+    db.engine.execute("""
+        ALTER TABLE admin.connections
+          ADD COLUMN IF NOT EXISTS watermark_date TIMESTAMP WITH TIME ZONE,
+          ADD COLUMN IF NOT EXISTS watermark_fitid VARCHAR;
+        CREATE INDEX IF NOT EXISTS stmttrn_acctfrom_id_dtposted_index
+          ON ofx.stmttrn (acctfrom_id, dtposted DESC, fitid DESC);
+        """)
+
+
+def create_ofx_description_trigger_function():
+    db.engine.execute("""
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        ALTER TABLE ofx.stmttrn
+          ADD COLUMN IF NOT EXISTS description_lc VARCHAR;
+        """)
+
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION ofx.stmttrn_description_lc()
+        RETURNS trigger AS $$
+          BEGIN
+            new.description_lc := lower(concat(new.name, new.memo));
+            RETURN new;
+          END;
+        $$
+        LANGUAGE  plpgsql;
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS stmttrn_description_lc_trigger
+            ON ofx.stmttrn;
+        CREATE TRIGGER stmttrn_description_lc_trigger
+            BEFORE INSERT OR UPDATE OF name, memo
+            ON ofx.stmttrn
+            FOR EACH ROW
+            EXECUTE PROCEDURE ofx.stmttrn_description_lc();
+        """)
+
+    db.engine.execute("""
+        UPDATE ofx.stmttrn
+          SET description_lc = lower(concat(name, memo))
+          WHERE description_lc IS DISTINCT FROM lower(concat(name, memo));
+        CREATE INDEX IF NOT EXISTS stmttrn_description_lc_trgm_index
+          ON ofx.stmttrn USING gin (description_lc gin_trgm_ops);
+        """)
+
+
+def create_ofx_transaction_key_trigger_function():
+    # Journal entries refer to statement transactions by this key. The
+    # account id comes first and is all digits, so the first ':' always
+    # ends it, whatever the FITID holds, and the key is unique like
+    # (fitid, acctfrom_id).
+    db.engine.execute("""
+        ALTER TABLE ofx.stmttrn
+          ADD COLUMN IF NOT EXISTS transaction_key TEXT;
+        """)
+
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION ofx.stmttrn_transaction_key()
+        RETURNS trigger AS $$
+          BEGIN
+            new.transaction_key := new.acctfrom_id || ':' || new.fitid;
+            RETURN new;
+          END;
+        $$
+        LANGUAGE  plpgsql;
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS stmttrn_transaction_key_trigger
+            ON ofx.stmttrn;
+        CREATE TRIGGER stmttrn_transaction_key_trigger
+            BEFORE INSERT OR UPDATE OF fitid, acctfrom_id
+            ON ofx.stmttrn
+            FOR EACH ROW
+            EXECUTE PROCEDURE ofx.stmttrn_transaction_key();
+        """)
+
+    # Keys used to be concat(fitid, acctfrom_id), which fitid '12' of
+    # account 3 and fitid '1' of account 23 share. Journal entries still
+    # holding an old key are moved to the new one, those with an ambiguous
+    # old key have to be remapped by hand first.
+    with db.engine.begin() as connection:
+        connection.execute("""
+            UPDATE ofx.stmttrn
+              SET transaction_key = acctfrom_id || ':' || fitid
+              WHERE transaction_key IS DISTINCT FROM acctfrom_id || ':' || fitid;
+            CREATE TEMPORARY TABLE old_transaction_keys ON COMMIT DROP AS
+              SELECT journal_entries.id, min(stmttrn.transaction_key) AS transaction_key,
+                     count(*) AS matches
+                FROM bookkeeping.journal_entries
+                JOIN ofx.stmttrn
+                  ON concat(stmttrn.fitid, stmttrn.acctfrom_id)
+                       = journal_entries.transaction_id
+                WHERE journal_entries.transaction_source = 'ofx'
+                  AND NOT EXISTS (SELECT 1 FROM ofx.stmttrn AS keyed
+                                    WHERE keyed.transaction_key
+                                            = journal_entries.transaction_id)
+                GROUP BY journal_entries.id;
+            """)
+        ambiguous_ids = [str(journal_entry_id) for journal_entry_id, in connection.execute("""
+            SELECT id FROM old_transaction_keys WHERE matches > 1 ORDER BY id;
+            """)]
+        if ambiguous_ids:
+            raise ValueError('OFX journal entries match several statement transactions, '
+                             'remap them first: {0}'.format(', '.join(ambiguous_ids)))
+        connection.execute("""
+            UPDATE bookkeeping.journal_entries
+              SET transaction_id = old_transaction_keys.transaction_key
+              FROM old_transaction_keys
+              WHERE journal_entries.id = old_transaction_keys.id;
+            DROP INDEX IF EXISTS ofx.stmttrn_transaction_key_lookup_index;
+            CREATE UNIQUE INDEX IF NOT EXISTS stmttrn_transaction_key_index
+              ON ofx.stmttrn (transaction_key);
+            """)
+
 
 def create_ofx_views():
+    # The views are not ordered, list pages sort and page on these
+    db.engine.execute("""
+        CREATE INDEX IF NOT EXISTS stmttrn_dtposted_transaction_key_index
+          ON ofx.stmttrn (dtposted, transaction_key);
+        CREATE INDEX IF NOT EXISTS invtran_dttrade_id_index
+          ON ofx.invtran (dttrade, id);
+        """)
+
     db.engine.execute("""
     CREATE OR REPLACE VIEW ofx.transactions
       AS SELECT
-        concat(ofx.stmttrn.fitid, ofx.stmttrn.acctfrom_id) AS id,
+        ofx.stmttrn.transaction_key AS id,
         ofx.stmttrn.dtposted AS date,
         ofx.stmttrn.trnamt AS amount,
         concat(ofx.stmttrn.name, ofx.stmttrn.memo) AS description,
@@ -159,15 +887,15 @@ def create_ofx_views():
         ofx.stmttrn.acctfrom_id AS account_id,
         bookkeeping.journal_entries.id AS journal_entry_id,
         bookkeeping.journal_entries.debit_subaccount AS debit_subaccount,
-        bookkeeping.journal_entries.credit_subaccount AS credit_subaccount
+        bookkeeping.journal_entries.credit_subaccount AS credit_subaccount,
+        ofx.stmttrn.description_lc AS description_lc
       FROM ofx.stmttrn
       LEFT OUTER JOIN bookkeeping.journal_entries
         ON bookkeeping.journal_entries.transaction_id
-              = concat(ofx.stmttrn.fitid, ofx.stmttrn.acctfrom_id)
+              = ofx.stmttrn.transaction_key
           AND bookkeeping.journal_entries.transaction_source = 'ofx'
       JOIN ofx.acctfrom
-        ON ofx.acctfrom.id = ofx.stmttrn.acctfrom_id
-      ORDER BY ofx.stmttrn.dtposted DESC;
+        ON ofx.acctfrom.id = ofx.stmttrn.acctfrom_id;
     """)
 
     db.engine.execute("""
@@ -212,45 +940,265 @@ def create_ofx_views():
           ON sellmf_secinfo.id = ofx.sellmf.secinfo_id
         LEFT OUTER JOIN ofx.secinfo reinvest_secinfo
           ON reinvest_secinfo.id = ofx.reinvest.secinfo_id
-        JOIN ofx.acctfrom ON acctfrom.id = ofx.invtran.acctfrom_id
-        ORDER BY ofx.invtran.dttrade DESC;
+        JOIN ofx.acctfrom ON acctfrom.id = ofx.invtran.acctfrom_id;
+    """)
+
+    # Replaced by the investments.position_snapshots table
+    db.engine.execute("""
+        DROP VIEW IF EXISTS ofx.cost_bases;
+    """)
+
+
+# Investment transaction tables whose units and totals add up to the
+# position snapshots, as in ofx.investment_transactions
+POSITION_TRANSACTION_TABLES = ['ofx.buymf',
+                               'ofx.sellmf',
+                               'ofx.reinvest']
+
+
+def create_position_snapshots_trigger_function():
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION
+      investments.price_position_snapshots(_tickers VARCHAR[])
+      RETURNS VOID AS $$
+        UPDATE investments.position_snapshots
+          SET "close" = prices.adjusted_close,
+              price_date = prices.date,
+              market_value = prices.adjusted_close
+                               * position_snapshots.total_units,
+              pnl = prices.adjusted_close * position_snapshots.total_units
+                      - position_snapshots.cost_basis,
+              pnl_percent = (prices.adjusted_close
+                               * position_snapshots.total_units
+                               - position_snapshots.cost_basis)
+                            / NULLIF(position_snapshots.cost_basis, 0)
+          FROM (
+            SELECT tickers.ticker,
+                   latest_prices.date,
+                   latest_prices.adjusted_close
+              FROM (SELECT DISTINCT unnest(_tickers)) AS tickers(ticker)
+              LEFT JOIN investments.latest_prices
+                ON latest_prices.ticker = tickers.ticker
+          ) AS prices
+          WHERE position_snapshots.ticker = prices.ticker;
+    $$
+    LANGUAGE sql;
     """)
 
     db.engine.execute("""
-        CREATE OR REPLACE VIEW ofx.cost_bases AS SELECT
-            investment_transactions.secname,
-            sum(investment_transactions.units) AS total_units,
-            sum(investment_transactions.total) AS cost_basis,
-            q1.ticker,
-            q1.adjusted_close AS "close",
-            q1.adjusted_close
-                  * sum(investment_transactions.units) AS market_value,
-            (q1.adjusted_close
-                  * sum(investment_transactions.units)
-                  - sum(investment_transactions.total)) AS pnl,
-            (q1.adjusted_close
-                  * sum(investment_transactions.units)
-                  - sum(investment_transactions.total))
-              / sum(investment_transactions.total) AS pnl_percent,
-            q2.date AS price_date
-
-        FROM ofx.investment_transactions
-        JOIN (SELECT ticker, max(date) AS date
-                FROM investments.security_prices
-                GROUP BY ticker) AS q2
-          ON q2.ticker = investment_transactions.ticker
-        JOIN investments.security_prices q1
-          ON q1.ticker = ofx.investment_transactions.ticker
-            AND q2.date = q1.date
-        GROUP BY investment_transactions.secname,
-                 q1.ticker,
-                 q2.date,
-                 q1.adjusted_close
-        ORDER BY sum(investment_transactions.total);
+    CREATE OR REPLACE FUNCTION
+      investments.apply_position_deltas(
+          _secinfo_ids INTEGER[],
+          _units NUMERIC[],
+          _costs NUMERIC[]
+      ) RETURNS VOID AS $$
+      BEGIN
+
+      INSERT INTO investments.position_snapshots
+        (ticker, secname, total_units, cost_basis)
+      SELECT secinfo.ticker,
+             max(secinfo.secname),
+             sum(deltas.units),
+             sum(deltas.cost)
+        FROM unnest(_secinfo_ids, _units, _costs)
+          AS deltas(secinfo_id, units, cost)
+        JOIN ofx.secinfo ON secinfo.id = deltas.secinfo_id
+        WHERE secinfo.ticker IS NOT NULL
+        GROUP BY secinfo.ticker
+      ON CONFLICT (ticker) DO UPDATE
+        SET secname = excluded.secname,
+            total_units = investments.position_snapshots.total_units
+                            + excluded.total_units,
+            cost_basis = investments.position_snapshots.cost_basis
+                           + excluded.cost_basis;
+
+      PERFORM investments.price_position_snapshots(array_agg(secinfo.ticker))
+        FROM ofx.secinfo
+        WHERE secinfo.id = ANY(_secinfo_ids);
+
+      RETURN;
+      END;
+    $$
+    SECURITY DEFINER
+    LANGUAGE  plpgsql;
     """)
 
+    # The cost basis is the negated total, as in ofx.cost_bases before it
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION investments.investment_transactions_changed()
+        RETURNS trigger AS $$
+          BEGIN
+            IF TG_OP = 'INSERT' THEN
+              PERFORM investments.apply_position_deltas(
+                    array_agg(changes.secinfo_id),
+                    array_agg(changes.units),
+                    array_agg(-changes.total))
+                FROM new_transactions AS changes;
+            ELSIF TG_OP = 'UPDATE' THEN
+              PERFORM investments.apply_position_deltas(
+                    array_agg(changes.secinfo_id),
+                    array_agg(changes.units),
+                    array_agg(changes.cost))
+                FROM (SELECT secinfo_id, units, -total AS cost
+                        FROM new_transactions
+                      UNION ALL
+                      SELECT secinfo_id, -units, total
+                        FROM old_transactions) AS changes;
+            ELSIF TG_OP = 'DELETE' THEN
+              PERFORM investments.apply_position_deltas(
+                    array_agg(changes.secinfo_id),
+                    array_agg(-changes.units),
+                    array_agg(changes.total))
+                FROM old_transactions AS changes;
+            END IF;
+            RETURN NULL;
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
+        """)
+
+    for table_name in POSITION_TRANSACTION_TABLES:
+        db.engine.execute("""
+            DROP TRIGGER IF EXISTS position_snapshots_insert_trigger
+                ON {0};
+            CREATE TRIGGER position_snapshots_insert_trigger
+                AFTER INSERT
+                ON {0}
+                REFERENCING NEW TABLE AS new_transactions
+                FOR EACH STATEMENT
+                EXECUTE PROCEDURE investments.investment_transactions_changed();
+
+            DROP TRIGGER IF EXISTS position_snapshots_update_trigger
+                ON {0};
+            CREATE TRIGGER position_snapshots_update_trigger
+                AFTER UPDATE
+                ON {0}
+                REFERENCING OLD TABLE AS old_transactions NEW TABLE AS new_transactions
+                FOR EACH STATEMENT
+                EXECUTE PROCEDURE investments.investment_transactions_changed();
+
+            DROP TRIGGER IF EXISTS position_snapshots_delete_trigger
+                ON {0};
+            CREATE TRIGGER position_snapshots_delete_trigger
+                AFTER DELETE
+                ON {0}
+                REFERENCING OLD TABLE AS old_transactions
+                FOR EACH STATEMENT
+                EXECUTE PROCEDURE investments.investment_transactions_changed();
+            """.format(table_name))
+
+    # Each changed ticker's latest price is one backward scan of the
+    # security_prices_unique_constraint index
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION investments.security_prices_changed()
+        RETURNS trigger AS $$
+          DECLARE
+            _tickers VARCHAR[];
+          BEGIN
+            IF TG_OP = 'INSERT' THEN
+              SELECT array_agg(DISTINCT ticker) INTO _tickers
+                FROM new_prices;
+            ELSIF TG_OP = 'UPDATE' THEN
+              SELECT array_agg(DISTINCT ticker) INTO _tickers
+                FROM (SELECT ticker FROM new_prices
+                      UNION ALL
+                      SELECT ticker FROM old_prices) AS changes;
+            ELSIF TG_OP = 'DELETE' THEN
+              SELECT array_agg(DISTINCT ticker) INTO _tickers
+                FROM old_prices;
+            END IF;
+
+            INSERT INTO investments.latest_prices
+              (ticker, date, adjusted_close)
+            SELECT tickers.ticker, latest.date, latest.adjusted_close
+              FROM unnest(_tickers) AS tickers(ticker)
+              CROSS JOIN LATERAL (
+                SELECT security_prices.date, security_prices.adjusted_close
+                  FROM investments.security_prices
+                  WHERE security_prices.ticker = tickers.ticker
+                  ORDER BY security_prices.date DESC
+                  LIMIT 1
+              ) AS latest
+            ON CONFLICT (ticker) DO UPDATE
+              SET date = excluded.date,
+                  adjusted_close = excluded.adjusted_close;
+
+            DELETE FROM investments.latest_prices
+              WHERE latest_prices.ticker = ANY(_tickers)
+                AND NOT EXISTS (SELECT 1
+                                  FROM investments.security_prices
+                                  WHERE security_prices.ticker
+                                          = latest_prices.ticker);
+
+            PERFORM investments.price_position_snapshots(_tickers);
+            RETURN NULL;
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS security_prices_insert_trigger
+            ON investments.security_prices;
+        CREATE TRIGGER security_prices_insert_trigger
+            AFTER INSERT
+            ON investments.security_prices
+            REFERENCING NEW TABLE AS new_prices
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE investments.security_prices_changed();
+
+        DROP TRIGGER IF EXISTS security_prices_update_trigger
+            ON investments.security_prices;
+        CREATE TRIGGER security_prices_update_trigger
+            AFTER UPDATE
+            ON investments.security_prices
+            REFERENCING OLD TABLE AS old_prices NEW TABLE AS new_prices
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE investments.security_prices_changed();
+
+        DROP TRIGGER IF EXISTS security_prices_delete_trigger
+            ON investments.security_prices;
+        CREATE TRIGGER security_prices_delete_trigger
+            AFTER DELETE
+            ON investments.security_prices
+            REFERENCING OLD TABLE AS old_prices
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE investments.security_prices_changed();
+        """)
+
+    # Backfill from the existing transactions and prices
+    db.engine.execute("""
+        TRUNCATE investments.latest_prices, investments.position_snapshots;
+
+        INSERT INTO investments.latest_prices (ticker, date, adjusted_close)
+        SELECT DISTINCT ON (ticker) ticker, date, adjusted_close
+          FROM investments.security_prices
+          ORDER BY ticker, date DESC;
+
+        SELECT investments.apply_position_deltas(
+                 array_agg(changes.secinfo_id),
+                 array_agg(changes.units),
+                 array_agg(-changes.total))
+          FROM (SELECT secinfo_id, units, total FROM ofx.buymf
+                UNION ALL
+                SELECT secinfo_id, units, total FROM ofx.sellmf
+                UNION ALL
+                SELECT secinfo_id, units, total FROM ofx.reinvest) AS changes;
+        """)
+
 
 def create_amazon_views():
+    # Journal entries refer to items by their id as text, the joins below
+    # must cast it exactly like this index does to use it
+    db.engine.execute("""
+        CREATE INDEX IF NOT EXISTS items_transaction_key_index
+          ON amazon.items ((CAST(id AS VARCHAR)));
+        CREATE INDEX IF NOT EXISTS items_shipment_date_id_index
+          ON amazon.items (shipment_date, id);
+        """)
+
     db.engine.execute("""
     CREATE OR REPLACE VIEW amazon.amazon_transactions
     AS SELECT
@@ -258,14 +1206,18 @@ def create_amazon_views():
       bookkeeping.journal_entries.id AS journal_entry_id
     FROM amazon.items
     LEFT OUTER JOIN bookkeeping.journal_entries
-      ON cast(amazon.items.id AS CHARACTER VARYING) = bookkeeping.journal_entries.transaction_id
-        AND bookkeeping.journal_entries.transaction_source = 'amazon'
-    ORDER BY amazon.items.shipment_date DESC;
+      ON CAST(amazon.items.id AS VARCHAR) = bookkeeping.journal_entries.transaction_id
+        AND bookkeeping.journal_entries.transaction_source = 'amazon';
     """)
 
 
 
 def create_bookkeeping_views():
+    db.engine.execute("""
+        CREATE INDEX IF NOT EXISTS journal_entries_timestamp_id_index
+          ON bookkeeping.journal_entries ("timestamp", id);
+        """)
+
     db.engine.execute("""
     CREATE OR REPLACE VIEW bookkeeping.detailed_journal_entries
     AS SELECT
@@ -282,64 +1234,203 @@ def create_bookkeeping_views():
         END AS description
     FROM bookkeeping.journal_entries
     LEFT OUTER JOIN ofx.stmttrn
-      ON concat(ofx.stmttrn.fitid, ofx.stmttrn.acctfrom_id)
+      ON ofx.stmttrn.transaction_key
                   = bookkeeping.journal_entries.transaction_id
       AND bookkeeping.journal_entries.transaction_source = 'ofx'
     LEFT OUTER JOIN amazon.items
-      ON cast(amazon.items.id AS CHARACTER VARYING)
+      ON CAST(amazon.items.id AS VARCHAR)
                   = bookkeeping.journal_entries.transaction_id
       AND bookkeeping.journal_entries.transaction_source = 'amazon'
     LEFT OUTER JOIN ofx.acctfrom
-      ON ofx.acctfrom.id = ofx.stmttrn.acctfrom_id
-    ORDER BY bookkeeping.journal_entries."timestamp" DESC;
+      ON ofx.acctfrom.id = ofx.stmttrn.acctfrom_id;
+    """)
+
+
+def create_mapping_overlaps_trigger_function():
+    # DO blocks and plain SELECTs are not autocommitted by the engine
+    with db.engine.begin() as connection:
+        connection.execute("""
+            DO $$
+              BEGIN
+                IF EXISTS (SELECT 1 FROM pg_views
+                             WHERE schemaname = 'admin'
+                               AND viewname = 'mapping_overlaps') THEN
+                  DROP VIEW admin.mapping_overlaps;
+                END IF;
+              END;
+            $$;
+            """)
+    MappingOverlaps.__table__.create(db.engine, checkfirst=True)
+
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION admin.mapping_pattern(_keyword VARCHAR)
+      RETURNS VARCHAR AS $$
+        SELECT '%%' || array_to_string(regexp_split_to_array(
+                          lower(_keyword), E'\\\s+'
+                          ), '%%') || '%%';
+    $$
+    LANGUAGE sql IMMUTABLE;
     """)
 
+    db.engine.execute("""
+    CREATE OR REPLACE FUNCTION
+      admin.refresh_mapping_overlaps(_mapping_id INTEGER)
+      RETURNS VOID AS $$
+      BEGIN
+
+      DELETE FROM admin.mapping_overlaps
+        WHERE mapping_id_1 = _mapping_id
+          OR mapping_id_2 = _mapping_id;
+
+      INSERT INTO admin.mapping_overlaps
+        (description, mapping_id_1, mapping_keyword_1,
+          mapping_id_2, mapping_keyword_2, source)
+      SELECT DISTINCT concat(ofx.stmttrn.name, ofx.stmttrn.memo),
+             pairs.mapping_id_1, pairs.mapping_keyword_1,
+             pairs.mapping_id_2, pairs.mapping_keyword_2,
+             'ofx'
+        FROM admin.mappings changed
+        JOIN ofx.stmttrn
+          ON ofx.stmttrn.description_lc
+            LIKE admin.mapping_pattern(changed.keyword)
+        JOIN admin.mappings other
+          ON ofx.stmttrn.description_lc
+            LIKE admin.mapping_pattern(other.keyword)
+          AND other.keyword != changed.keyword
+          AND other.source = 'ofx'
+        CROSS JOIN LATERAL (VALUES
+            (changed.id, changed.keyword, other.id, other.keyword),
+            (other.id, other.keyword, changed.id, changed.keyword)
+          ) AS pairs(mapping_id_1, mapping_keyword_1,
+                     mapping_id_2, mapping_keyword_2)
+        WHERE changed.id = _mapping_id
+          AND changed.source = 'ofx'
+      ON CONFLICT DO NOTHING;
 
-def create_mappings_views():
-    db.engine.execute("""
-    CREATE OR REPLACE VIEW admin.mapping_overlaps
-    AS SELECT DISTINCT
-      concat(ofx.stmttrn.name, ofx.stmttrn.memo) AS description,
-      mappings_table_1.id AS mapping_id_1,
-      mappings_table_1.keyword AS mapping_keyword_1,
-      mappings_table_2.id AS mapping_id_2,
-      mappings_table_2.keyword AS mapping_keyword_2,
-      mappings_table_2.source AS source
-    FROM ofx.stmttrn
-    JOIN admin.mappings mappings_table_1
-      ON lower(concat(ofx.stmttrn.name, ofx.stmttrn.memo))
-        LIKE '%%' || array_to_string(regexp_split_to_array(
-                        lower(mappings_table_1.keyword), E'\\\s+'
-                        ), '%%') || '%%'
-        AND mappings_table_1.source = 'ofx'
-    JOIN admin.mappings mappings_table_2
-      ON lower(concat(ofx.stmttrn.name, ofx.stmttrn.memo))
-        LIKE '%%' || array_to_string(regexp_split_to_array(
-                        lower(mappings_table_2.keyword), E'\\\s+'
-                        ), '%%')  || '%%'
-        AND mappings_table_1.keyword != mappings_table_2.keyword
-        AND mappings_table_2.source = 'ofx'
-    ORDER BY description;
+      RETURN;
+      END;
+    $$
+    SECURITY DEFINER
+    LANGUAGE  plpgsql;
     """)
 
-    # Todo: have view updates propagate to underlying physical tables
-    # try:
-    #     db.engine.execute('DROP RULE admin.ofx_mapping_overlaps_keyword_1_update_rule')
-    # except ProgrammingError:
-    #     pass
-    # db.engine.execute("""
-    # CREATE RULE ofx_mapping_overlaps_keyword_1_update_rule AS
-    # ON UPDATE TO admin.ofx_mapping_overlaps WHERE NEW.mapping_keyword_1 <> OLD.mapping_keyword_1
-    #     DO INSTEAD UPDATE admin.mappings SET keyword = NEW.mapping_keyword_1 WHERE id = NEW.mapping_id_1;
-    # """)
-    #
-    # try:
-    #     db.engine.execute('DROP RULE admin.ofx_mapping_overlaps_keyword_2_update_rule')
-    # except ProgrammingError:
-    #     pass
-    # db.engine.execute("""
-    # CREATE RULE ofx_mapping_overlaps_keyword_2_update_rule AS
-    # ON UPDATE TO admin.ofx_mapping_overlaps WHERE NEW.mapping_keyword_2 <> OLD.mapping_keyword_2
-    #     DO INSTEAD UPDATE admin.mappings SET keyword = NEW.mapping_keyword_2 WHERE id = NEW.mapping_id_2;
-    # """)
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION admin.mappings_changed()
+        RETURNS trigger AS $$
+          BEGIN
+            IF TG_OP = 'DELETE' THEN
+              DELETE FROM admin.mapping_overlaps
+                WHERE mapping_id_1 = old.id
+                  OR mapping_id_2 = old.id;
+            ELSE
+              PERFORM admin.refresh_mapping_overlaps(new.id);
+            END IF;
+            RETURN NULL;
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS mappings_overlaps_trigger
+            ON admin.mappings;
+        CREATE TRIGGER mappings_overlaps_trigger
+            AFTER INSERT OR DELETE OR UPDATE OF keyword, source
+            ON admin.mappings
+            FOR EACH ROW
+            EXECUTE PROCEDURE admin.mappings_changed();
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS stmttrn_mapping_overlaps_trigger
+            ON ofx.stmttrn;
+        DROP FUNCTION IF EXISTS ofx.stmttrn_inserted();
+        """)
+
+    # Overlaps are kept per description, those of the old rows go once no
+    # statement transaction has the description any more
+    db.engine.execute("""
+        CREATE OR REPLACE FUNCTION ofx.stmttrn_changed()
+        RETURNS trigger AS $$
+          BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+              DELETE FROM admin.mapping_overlaps
+                USING (SELECT DISTINCT concat(old_transactions.name,
+                                              old_transactions.memo)
+                         FROM old_transactions
+                      ) AS changes(description)
+                WHERE mapping_overlaps.description = changes.description
+                  AND mapping_overlaps.source = 'ofx'
+                  AND NOT EXISTS (
+                    SELECT 1
+                      FROM ofx.stmttrn
+                      WHERE ofx.stmttrn.description_lc
+                              = lower(changes.description)
+                        AND concat(ofx.stmttrn.name, ofx.stmttrn.memo)
+                              = changes.description);
+            END IF;
+
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+              INSERT INTO admin.mapping_overlaps
+                (description, mapping_id_1, mapping_keyword_1,
+                  mapping_id_2, mapping_keyword_2, source)
+              SELECT DISTINCT concat(new_transactions.name,
+                                     new_transactions.memo),
+                     mappings_table_1.id, mappings_table_1.keyword,
+                     mappings_table_2.id, mappings_table_2.keyword,
+                     'ofx'
+                FROM new_transactions
+                JOIN admin.mappings mappings_table_1
+                  ON new_transactions.description_lc
+                    LIKE admin.mapping_pattern(mappings_table_1.keyword)
+                  AND mappings_table_1.source = 'ofx'
+                JOIN admin.mappings mappings_table_2
+                  ON new_transactions.description_lc
+                    LIKE admin.mapping_pattern(mappings_table_2.keyword)
+                  AND mappings_table_1.keyword != mappings_table_2.keyword
+                  AND mappings_table_2.source = 'ofx'
+              ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+          END;
+        $$
+        SECURITY DEFINER
+        LANGUAGE  plpgsql;
+        """)
+
+    db.engine.execute("""
+        DROP TRIGGER IF EXISTS stmttrn_mapping_overlaps_insert_trigger
+            ON ofx.stmttrn;
+        CREATE TRIGGER stmttrn_mapping_overlaps_insert_trigger
+            AFTER INSERT
+            ON ofx.stmttrn
+            REFERENCING NEW TABLE AS new_transactions
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE ofx.stmttrn_changed();
+
+        DROP TRIGGER IF EXISTS stmttrn_mapping_overlaps_update_trigger
+            ON ofx.stmttrn;
+        CREATE TRIGGER stmttrn_mapping_overlaps_update_trigger
+            AFTER UPDATE
+            ON ofx.stmttrn
+            REFERENCING OLD TABLE AS old_transactions NEW TABLE AS new_transactions
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE ofx.stmttrn_changed();
+
+        DROP TRIGGER IF EXISTS stmttrn_mapping_overlaps_delete_trigger
+            ON ofx.stmttrn;
+        CREATE TRIGGER stmttrn_mapping_overlaps_delete_trigger
+            AFTER DELETE
+            ON ofx.stmttrn
+            REFERENCING OLD TABLE AS old_transactions
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE ofx.stmttrn_changed();
+        """)
 
+    with db.engine.begin() as connection:
+        connection.execute("""
+            SELECT admin.refresh_mapping_overlaps(id)
+              FROM admin.mappings
+              WHERE source = 'ofx';
+            """)
@@ -1,4 +1,5 @@
 from flask_admin import Admin
+from flask_cache import Cache
 from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
 
@@ -9,4 +10,6 @@ admin = Admin(url='/',
 
 mail = Mail()
 
+cache = Cache()
+
 db = SQLAlchemy()
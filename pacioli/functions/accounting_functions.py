@@ -0,0 +1,210 @@
+from __future__ import print_function
+
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from time import time
+
+from dateutil.relativedelta import relativedelta
+from flask import current_app
+from sqlalchemy import text
+
+from pacioli import database, db
+from pacioli.database.sql_views import bump_table_version
+from pacioli.models import JournalEntries
+
+PERIOD_INTERVALS = ['YYYY', 'YYYY-Q', 'YYYY-MM', 'YYYY-WW', 'YYYY-MM-DD']
+
+PERIOD_KEYS = {'YYYY': JournalEntries.period_year,
+               'YYYY-Q': JournalEntries.period_quarter,
+               'YYYY-MM': JournalEntries.period_month,
+               'YYYY-WW': JournalEntries.period_week,
+               'YYYY-MM-DD': JournalEntries.period_day}
+
+
+def period_range(period_interval, period):
+    """
+    Return the [start, end) timestamps covered by a period string, as
+    produced by to_char(timestamp, period_interval).
+    """
+    if period_interval == 'YYYY':
+        start = datetime(int(period), 1, 1)
+        end = start + relativedelta(years=1)
+    elif period_interval == 'YYYY-Q':
+        year, quarter = period.split('-')
+        start = datetime(int(year), 3 * int(quarter) - 2, 1)
+        end = start + relativedelta(months=3)
+    elif period_interval == 'YYYY-MM':
+        year, month = period.split('-')
+        start = datetime(int(year), int(month), 1)
+        end = start + relativedelta(months=1)
+    elif period_interval == 'YYYY-WW':
+        # WW weeks start on January 1st, the last one is cut short
+        year, week = period.split('-')
+        start = datetime(int(year), 1, 1) + timedelta(weeks=int(week) - 1)
+        end = min(start + timedelta(weeks=1), datetime(int(year) + 1, 1, 1))
+    elif period_interval == 'YYYY-MM-DD':
+        start = datetime.strptime(period, '%Y-%m-%d')
+        end = start + timedelta(days=1)
+    else:
+        raise ValueError('Unrecognized period interval: {0}'.format(period_interval))
+    return start, end
+
+
+# Each leg reads only the shard's own entries through the
+# (debit_subaccount, ...) and (credit_subaccount, ...) indexes
+build_shard_query = text('''
+    INSERT INTO bookkeeping.trial_balances_rebuild
+      (subaccount, period_interval, period,
+        debit_balance, credit_balance, net_balance,
+        debit_changes, credit_changes, net_changes)
+    SELECT changes.subaccount, changes.period_interval, changes.period,
+           sum(changes.debit_changes) OVER running,
+           sum(changes.credit_changes) OVER running,
+           sum(changes.debit_changes - changes.credit_changes) OVER running,
+           changes.debit_changes,
+           changes.credit_changes,
+           changes.debit_changes - changes.credit_changes
+      FROM (
+        SELECT legs.subaccount,
+               periods.period_interval,
+               periods.period,
+               sum(legs.debit_amount) AS debit_changes,
+               sum(legs.credit_amount) AS credit_changes
+          FROM (
+            SELECT debit_subaccount AS subaccount,
+                   functional_amount AS debit_amount,
+                   0 AS credit_amount,
+                   period_year, period_quarter, period_month,
+                   period_week, period_day
+              FROM bookkeeping.journal_entries
+              WHERE debit_subaccount = ANY(:subaccounts)
+            UNION ALL
+            SELECT credit_subaccount,
+                   0,
+                   functional_amount,
+                   period_year, period_quarter, period_month,
+                   period_week, period_day
+              FROM bookkeeping.journal_entries
+              WHERE credit_subaccount = ANY(:subaccounts)
+          ) AS legs
+          CROSS JOIN LATERAL (VALUES
+              ('YYYY', legs.period_year),
+              ('YYYY-Q', legs.period_quarter),
+              ('YYYY-MM', legs.period_month),
+              ('YYYY-WW', legs.period_week),
+              ('YYYY-MM-DD', legs.period_day)
+            ) AS periods(period_interval, period)
+          GROUP BY 1, 2, 3
+      ) AS changes
+    WINDOW running AS (PARTITION BY changes.subaccount,
+                                    changes.period_interval
+                       ORDER BY changes.period);
+''')
+
+
+def build_trial_balances_shard(engine, shard_number, subaccounts):
+    start = time()
+    with engine.begin() as connection:
+        result = connection.execute(build_shard_query,
+                                    subaccounts=subaccounts)
+    return shard_number, len(subaccounts), result.rowcount, time() - start
+
+
+def build_trial_balances_shard_worker(shard):
+    shard_number, subaccounts = shard
+    return build_trial_balances_shard(database.worker_engine, shard_number, subaccounts)
+
+
+def refresh_trial_balances(processes=1, shards=None):
+    """
+    Rebuild bookkeeping.trial_balances from the journal.
+
+    The balances are built into a shadow table, split into subaccount
+    shards that can run on a process pool, and then copied over the old
+    rows within a single transaction so readers never see a partial
+    table. The table itself is kept, with its grants, indexes and
+    triggers. Writers to the journal wait for the copy. The financial
+    statements are rebuilt from the new balances in the same
+    transaction.
+    """
+    start = time()
+    shards = shards or processes
+
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    pool = None
+    try:
+        connection.execute('''
+            LOCK TABLE bookkeeping.journal_entries IN SHARE MODE;
+        ''')
+
+        subaccounts = [subaccount for subaccount, in connection.execute('''
+            SELECT debit_subaccount FROM bookkeeping.journal_entries
+            UNION
+            SELECT credit_subaccount FROM bookkeeping.journal_entries
+            ORDER BY 1;
+        ''')]
+        shard_list = [(shard_number, subaccounts[shard_number::shards])
+                      for shard_number in range(shards)
+                      if subaccounts[shard_number::shards]]
+
+        with db.engine.begin() as shadow_connection:
+            shadow_connection.execute('''
+                DROP TABLE IF EXISTS bookkeeping.trial_balances_rebuild;
+                CREATE UNLOGGED TABLE bookkeeping.trial_balances_rebuild
+                  (LIKE bookkeeping.trial_balances INCLUDING DEFAULTS);
+            ''')
+        print('Rebuilding trial balances for {0} subaccounts '
+              'in {1} shards'.format(len(subaccounts), len(shard_list)))
+
+        if processes > 1:
+            pool = Pool(processes,
+                        initializer=database.init_worker,
+                        initargs=(current_app.config['SQLALCHEMY_DATABASE_URI'],))
+            results = pool.imap_unordered(build_trial_balances_shard_worker,
+                                          shard_list)
+        else:
+            results = (build_trial_balances_shard(db.engine, *shard)
+                       for shard in shard_list)
+
+        row_count = 0
+        for completed, result in enumerate(results, 1):
+            shard_number, subaccount_count, shard_row_count, seconds = result
+            row_count += shard_row_count
+            print('[{0}/{1}] Shard {2}: {3} subaccounts, {4} rows '
+                  'in {5:.2f}s'.format(completed, len(shard_list), shard_number,
+                                       subaccount_count, shard_row_count,
+                                       seconds))
+
+        # The statement lines are rebuilt once below instead of per row
+        # by the trial balance triggers
+        swap_start = time()
+        connection.execute('''
+            LOCK TABLE bookkeeping.trial_balances IN ACCESS EXCLUSIVE MODE;
+            ALTER TABLE bookkeeping.trial_balances DISABLE TRIGGER USER;
+            TRUNCATE bookkeeping.trial_balances;
+            INSERT INTO bookkeeping.trial_balances
+              SELECT * FROM bookkeeping.trial_balances_rebuild;
+            ALTER TABLE bookkeeping.trial_balances ENABLE TRIGGER USER;
+        ''')
+        bump_table_version(connection, 'bookkeeping.trial_balances')
+        connection.execute('''
+            SELECT bookkeeping.rebuild_financial_statements();
+        ''')
+        transaction.commit()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if transaction.is_active:
+            transaction.rollback()
+        connection.close()
+        with db.engine.begin() as shadow_connection:
+            shadow_connection.execute('''
+                DROP TABLE IF EXISTS bookkeeping.trial_balances_rebuild;
+            ''')
+
+    print('Swapped in {0} trial balance rows in {1:.2f}s'.format(
+        row_count, time() - swap_start))
+    print('Rebuilt trial balances in {0:.2f}s'.format(time() - start))
+    return row_count
@@ -1,79 +1,128 @@
+from __future__ import print_function
+
 import csv
+from decimal import Decimal
 import email
 import imaplib
+import io
 from datetime import datetime, timedelta
+from multiprocessing import Pool
+import os
+import sys
+from time import time
 
-from sqlalchemy import func
-from sqlalchemy.orm.exc import NoResultFound
+from dateutil.tz import tzlocal
+from flask import current_app
+from sqlalchemy import and_, cast, func, Integer, Numeric, String
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql.elements import or_
-from sqlalchemy import inspect
-from sqlalchemy.exc import IntegrityError
 # import mechanize
 
-from pacioli.models import (db, AmazonItems, Subaccounts, Mappings,
+from pacioli import database
+from pacioli.functions.bookkeeping_functions import write_journal_entries
+from pacioli.functions.mapping_functions import MappingMatcher, mapping_precedence
+from pacioli.functions.ofx_functions import file_sha256, format_exception
+from pacioli.models import (db, AmazonItems, Mappings,
                             JournalEntries, Connections, AmazonCategories,
-                            AmazonOrders)
-
-
-def apply_all_mappings():
-    for mapping in db.session.query(Mappings).all():
-        matches = (db.session.query(AmazonItems)
-                   .outerjoin(JournalEntries, JournalEntries.transaction_id == str(AmazonItems.id))
-                   .filter(JournalEntries.transaction_id.is_(None))
-                   .filter(or_(func.lower(AmazonItems.title).like('%' + mapping.keyword.lower() + '%'),
-                               func.lower(AmazonItems.category_id).like('%' + mapping.keyword.lower() + '%')))
-                   .order_by(AmazonItems.shipment_date.desc()).all())
-        for match in matches:
-            new_journal_entry = JournalEntries()
-            new_journal_entry.transaction_id = match.id
-            new_journal_entry.transaction_source = 'amazon'
-            new_journal_entry.timestamp = match.shipment_date
-            if match.amount > 0:
-                try:
-                    db.session.query(Subaccounts).filter(Subaccounts.name == mapping.positive_debit_subaccount_id).one()
-                except NoResultFound:
-                    new_subaccount = Subaccounts()
-                    new_subaccount.name = mapping.positive_debit_subaccount_id
-                    new_subaccount.parent = 'Discretionary Costs'
-                    db.session.add(new_subaccount)
-                    db.session.commit()
-                new_journal_entry.debit_subaccount = mapping.positive_debit_subaccount_id
-                new_journal_entry.credit_subaccount = mapping.positive_credit_subaccount_id
-            else:
-                raise Exception()
-            new_journal_entry.functional_amount = match.item_total
-            new_journal_entry.functional_currency = 'USD'
-            new_journal_entry.source_amount = match.item_total
-            new_journal_entry.source_currency = 'USD'
-            db.session.add(new_journal_entry)
-            db.session.commit()
+                            AmazonOrders, ImportedFiles)
+
+
+def unmapped_amazon_items():
+    # Cast exactly like the amazon.items expression index so the anti-join
+    # can use it
+    return (db.session.query(AmazonItems)
+            .outerjoin(JournalEntries,
+                       and_(JournalEntries.transaction_id == cast(AmazonItems.id, String),
+                            JournalEntries.transaction_source == 'amazon'))
+            .filter(JournalEntries.id.is_(None)))
+
+
+def amazon_journal_entry(item, mapping):
+    return dict(transaction_id=str(item.id),
+                transaction_source='amazon',
+                mapping_id=mapping.id,
+                timestamp=item.shipment_date,
+                debit_subaccount=mapping.positive_debit_subaccount_id,
+                credit_subaccount=mapping.positive_credit_subaccount_id,
+                functional_amount=item.item_total,
+                functional_currency='USD',
+                source_amount=item.item_total,
+                source_currency='USD')
+
+
+def amazon_mapping_matcher(mappings):
+    """
+    Return a function picking an item's mapping out of mappings: the
+    mapping whose keyword is the item's category, otherwise the one its
+    title matches.
+    """
+    category_mappings = {}
+    for mapping in sorted((mapping for mapping in mappings if mapping.keyword),
+                          key=mapping_precedence):
+        category_mappings.setdefault(mapping.keyword.strip().lower(), mapping)
+    matcher = MappingMatcher(mappings)
+
+    def match(item):
+        return (category_mappings.get((item.category_id or '').lower())
+                or matcher.match(item.title))
+    return match
+
+
+def bookable_amazon_item(item):
+    # Refunds and free items have nothing to book
+    return bool(item.item_total) and item.item_total > 0
+
+
+def apply_all_mappings(batch_size=1000):
+    """
+    Book every unmapped item in one scan. An item whose category is a
+    mapping keyword takes that mapping, otherwise its title is matched
+    against all the keywords at once.
+    """
+    mappings = (db.session.query(Mappings)
+                .filter(Mappings.source == 'amazon')
+                .all())
+    match = amazon_mapping_matcher(mappings)
+
+    new_journal_entries = []
+    mapped_subaccounts = set()
+    for item in unmapped_amazon_items().yield_per(batch_size):
+        mapping = match(item)
+        if mapping is None or not bookable_amazon_item(item):
+            continue
+        new_journal_entries.append(amazon_journal_entry(item, mapping))
+        mapped_subaccounts.add(mapping.positive_debit_subaccount_id)
+
+    return write_journal_entries(new_journal_entries, mapped_subaccounts,
+                                 batch_size=batch_size)
 
 
 def apply_single_amazon_mapping(mapping_id):
+    """
+    Book the unmapped items a new mapping takes. The keyword narrows the
+    items down in SQL, then each one is matched against every Amazon
+    mapping like in apply_all_mappings, so an item only goes to this
+    mapping when a full run would book it there too.
+    """
     mapping = db.session.query(Mappings).filter(Mappings.id == mapping_id).one()
-    matches = (db.session.query(AmazonItems)
-               .outerjoin(JournalEntries, JournalEntries.transaction_id == str(AmazonItems.id))
-               .filter(JournalEntries.transaction_id.is_(None))
-               .filter(or_(func.lower(AmazonItems.title).like('%' + mapping.keyword.lower() + '%'),
-                           func.lower(AmazonItems.category_id).like('%' + mapping.keyword.lower() + '%')))
-               .order_by(AmazonItems.shipment_date.desc()).all())
-    for match in matches:
-        new_journal_entry = JournalEntries()
-        new_journal_entry.transaction_id = match.id
-        new_journal_entry.mapping_id = mapping_id
-        new_journal_entry.transaction_source = 'amazon'
-        new_journal_entry.timestamp = match.shipment_date
-        if match.item_total > 0:
-            new_journal_entry.debit_subaccount = mapping.positive_debit_subaccount_id
-            new_journal_entry.credit_subaccount = mapping.positive_credit_subaccount_id
-        else:
-            raise Exception()
-        new_journal_entry.functional_amount = match.item_total
-        new_journal_entry.functional_currency = 'USD'
-        new_journal_entry.source_amount = match.item_total
-        new_journal_entry.source_currency = 'USD'
-        db.session.add(new_journal_entry)
-        db.session.commit()
+    if mapping.source != 'amazon' or not mapping.keyword or not mapping.keyword.split():
+        raise ValueError('Mapping {0} is not an Amazon keyword mapping'.format(mapping_id))
+    keyword = mapping.keyword.strip().lower()
+    candidates = (unmapped_amazon_items()
+                  .filter(or_(func.lower(AmazonItems.category_id) == keyword,
+                              func.lower(AmazonItems.title).like('%' + '%'.join(keyword.split()) + '%')))
+                  .order_by(AmazonItems.shipment_date.desc()))
+    match = amazon_mapping_matcher(db.session.query(Mappings)
+                                   .filter(Mappings.source == 'amazon')
+                                   .all())
+    new_journal_entries = []
+    for item in candidates:
+        matched_mapping = match(item)
+        if matched_mapping is None or matched_mapping.id != mapping.id or not bookable_amazon_item(item):
+            continue
+        new_journal_entries.append(amazon_journal_entry(item, mapping))
+    mapped_subaccounts = [mapping.positive_debit_subaccount_id] if new_journal_entries else []
+    return write_journal_entries(new_journal_entries, mapped_subaccounts)
 
 
 def request_amazon_report():
@@ -147,45 +196,175 @@ def fetch_amazon_email_download():
     br['email'], br['password'] = (db.session.query(Connections.user, Connections.password)
                                    .filter(Connections.source == 'amazon').first())
     csv_file = br.submit()
-    reader = csv.DictReader(csv_file)
+    return load_amazon_csv(csv_file)
+
+
+def amazon_column_name(header):
+    column_name = header.lower().replace('/', '_').replace(' ', '_').replace('&', 'and')
+    if column_name == 'category':
+        return 'category_id'
+    return column_name
+
+
+def to_numeric(value):
+    return Decimal(value.replace('$', '').replace(',', ''))
+
+
+def amazon_csv_plan(header):
+    """
+    Map an order history report's header to amazon.items columns once,
+    as (position, column, converter) with None for columns kept as text.
+    """
+    columns = AmazonItems.__table__.columns
+    plan = []
+    for position, column_name in enumerate(amazon_column_name(column) for column in header):
+        if column_name == 'id' or column_name not in columns:
+            continue
+        column_type = columns[column_name].type
+        if isinstance(column_type, Numeric):
+            converter = to_numeric
+        elif isinstance(column_type, Integer):
+            converter = int
+        else:
+            converter = None
+        plan.append((position, column_name, converter))
+    return plan
+
+
+def load_amazon_csv(csv_file, batch_size=1000, engine=None):
+    """
+    Stream an order history report into amazon.categories, amazon.orders
+    and amazon.items, one transaction and one multi-row INSERT ... ON
+    CONFLICT DO NOTHING per table and batch. Returns the number of report
+    rows read and of new items.
+
+    Each batch writes its keys in sorted order, so reports with
+    overlapping date ranges can load concurrently without deadlocking.
+    """
+    engine = engine or db.engine
+    reader = csv.reader(csv_file)
+    header = next(reader, None)
+    if not header:
+        return 0, 0
+    plan = amazon_csv_plan(header)
+    order_date_position = [amazon_column_name(column) for column in header].index('order_date')
+
+    rows = 0
+    inserted = 0
+    categories = set()
+    orders = {}
+    items = []
     for row in reader:
-        new_amazon_item = AmazonItems()
-        for key in row:
-            row[key.lower().replace('/', '_').replace(' ', '_').replace('&', 'and')] = row.pop(key)
-        if not row['category']:
-            row['category'] = 'Other'
-        for column in inspect(AmazonItems).attrs:
-            if column.key == 'category_id':
-                new_amazon_category = AmazonCategories()
-                new_amazon_category.name = row['category']
-                try:
-                    db.session.add(new_amazon_category)
-                    db.session.commit()
-                except IntegrityError:
-                    db.session.rollback()
-                setattr(new_amazon_item, column.key, row['category'])
-            elif column.key == 'order_id':
-                new_amazon_order = AmazonOrders()
-                new_amazon_order.id = row['order_id']
-                new_amazon_order.order_date = row['order_date']
-                try:
-                    db.session.add(new_amazon_order)
-                    db.session.commit()
-                except IntegrityError:
-                    db.session.rollback()
-                setattr(new_amazon_item, column.key, row[column.key])
-            elif column.key in ['id', 'order', 'category']:
-                continue
-            else:
-                assert len(column.columns) == 1
-                if str(column.columns[0].type) == 'NUMERIC':
-                    if row[column.key].startswith('$'):
-                        row[column.key] = row[column.key].replace('$', '').replace(',', '')
-                if not row[column.key]:
-                    row[column.key] = None
-                setattr(new_amazon_item, column.key, row[column.key])
-        try:
-            db.session.add(new_amazon_item)
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
+        if not row:
+            continue
+        item = {}
+        for position, column_name, converter in plan:
+            value = row[position] if position < len(row) else ''
+            if not value:
+                value = None
+            elif converter is not None:
+                value = converter(value)
+            item[column_name] = value
+        item['category_id'] = item.get('category_id') or 'Other'
+        categories.add(item['category_id'])
+        orders[item['order_id']] = row[order_date_position] or None
+        items.append(item)
+        rows += 1
+        if len(items) == batch_size:
+            inserted += insert_amazon_items(engine, categories, orders, items)
+            categories, orders, items = set(), {}, []
+    if items:
+        inserted += insert_amazon_items(engine, categories, orders, items)
+    return rows, inserted
+
+
+def insert_amazon_items(engine, categories, orders, items):
+    items = sorted(items, key=lambda item: (item['order_id'] or '', item['title'] or ''))
+    with engine.begin() as connection:
+        connection.execute(insert(AmazonCategories.__table__)
+                           .values([dict(name=category) for category in sorted(categories)])
+                           .on_conflict_do_nothing(index_elements=['name']))
+        connection.execute(insert(AmazonOrders.__table__)
+                           .values([dict(id=order_id, order_date=order_date)
+                                    for order_id, order_date in sorted(orders.items())])
+                           .on_conflict_do_nothing(index_elements=['id']))
+        result = connection.execute(insert(AmazonItems.__table__)
+                                    .values(items)
+                                    .on_conflict_do_nothing(constraint='amazon_items_unique_constraint')
+                                    .returning(AmazonItems.__table__.c.id))
+        return len(result.fetchall())
+
+
+def open_amazon_csv(path):
+    if sys.version_info[0] < 3:
+        return open(path, 'rb')
+    return io.open(path, 'r', encoding='utf-8-sig', newline='')
+
+
+def import_amazon_csv_file(imported_file):
+    path, sha256 = imported_file
+    engine = database.worker_engine or db.engine
+    start = time()
+    try:
+        with open_amazon_csv(path) as csv_file:
+            rows, inserted = load_amazon_csv(csv_file, engine=engine)
+        with engine.begin() as connection:
+            connection.execute(insert(ImportedFiles.__table__)
+                               .values(sha256=sha256,
+                                       file_name=os.path.basename(path),
+                                       imported_at=datetime.now(tzlocal()),
+                                       transactions=rows)
+                               .on_conflict_do_nothing(index_elements=['sha256']))
+    except Exception as exception:
+        return path, sha256, format_exception(exception), 0, 0, time() - start
+    return path, sha256, None, rows, inserted, time() - start
+
+
+def import_amazon_csv_files(paths, processes=1):
+    """
+    Load order history reports on a process pool, skipping files whose
+    content was imported before. Items that appear in several reports
+    with overlapping date ranges are only inserted once. Prints a report
+    of files, rows and rows per second.
+    """
+    report = dict(files=len(paths), skipped=0, imported=0, failed=0,
+                  rows=0, items=0)
+    start = time()
+    if processes > 1:
+        pool = Pool(processes, initializer=database.init_worker,
+                    initargs=(current_app.config['SQLALCHEMY_DATABASE_URI'],))
+        map_function = pool.imap_unordered
+    else:
+        pool = None
+        map_function = map
+
+    hashes = dict((sha256, path) for path, sha256 in
+                  sorted(map_function(file_sha256, paths), reverse=True))
+    imported_hashes = set(sha256 for sha256, in
+                          (db.session.query(ImportedFiles.sha256)
+                           .filter(ImportedFiles.sha256.in_(list(hashes)))))
+    new_files = sorted((path, sha256) for sha256, path in hashes.items()
+                       if sha256 not in imported_hashes)
+    report['skipped'] = len(paths) - len(new_files)
+
+    load_start = time()
+    for path, sha256, error, rows, inserted, seconds in map_function(import_amazon_csv_file, new_files):
+        if error is None:
+            report['imported'] += 1
+            report['rows'] += rows
+            report['items'] += inserted
+            print('{0}: {1} rows, {2} new items in {3:.2f}s'.format(path, rows, inserted, seconds))
+        else:
+            report['failed'] += 1
+            print('{0}: {1}'.format(path, error))
+    if pool:
+        pool.close()
+        pool.join()
+    report['load_seconds'] = time() - load_start
+    report['total_seconds'] = time() - start
+    report['rows_per_second'] = report['rows'] / report['load_seconds'] if report['load_seconds'] else 0
+
+    print('{files} files: {imported} imported, {skipped} already imported, {failed} failed'.format(**report))
+    print('{rows} rows, {items} new items in {load_seconds:.2f}s ({rows_per_second:.0f} rows/s), '
+          'total {total_seconds:.2f}s'.format(**report))
+    return report
@@ -0,0 +1,32 @@
+from sqlalchemy.dialects.postgresql import insert
+
+from pacioli.models import db, JournalEntries, Subaccounts
+
+
+def write_journal_entries(journal_entries, subaccounts=(),
+                          subaccount_parent='Discretionary Costs',
+                          batch_size=1000):
+    """
+    Insert journal entries in one transaction and return the number of
+    entries created and skipped.
+
+    Missing subaccounts are created under subaccount_parent first. Entries
+    for a transaction that is already in the journal are skipped.
+    """
+    subaccounts = set(subaccount for subaccount in subaccounts if subaccount)
+    if subaccounts:
+        db.session.execute(insert(Subaccounts.__table__)
+                           .values([dict(name=subaccount, parent=subaccount_parent)
+                                    for subaccount in sorted(subaccounts)])
+                           .on_conflict_do_nothing(index_elements=['name']))
+
+    created = 0
+    for offset in range(0, len(journal_entries), batch_size):
+        # Each multi-row INSERT fires the trial balance trigger once
+        result = db.session.execute(insert(JournalEntries.__table__)
+                                    .values(journal_entries[offset:offset + batch_size])
+                                    .on_conflict_do_nothing(constraint='journal_entries_unique_constraint')
+                                    .returning(JournalEntries.__table__.c.id))
+        created += len(result.fetchall())
+    db.session.commit()
+    return created, len(journal_entries) - created
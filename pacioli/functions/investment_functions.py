@@ -1,35 +1,191 @@
+from __future__ import print_function
+
 import csv
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import partial
+import io
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+from time import time
+
+from flask import current_app
+from ofxtools.ofxalchemy import models as ofx_models
+from sqlalchemy.dialects.postgresql import insert
 
-from matplotlib.finance import fetch_historical_yahoo
-from sqlalchemy import inspect
-from sqlalchemy.exc import IntegrityError
+try:
+    import pandas
+except ImportError:
+    pandas = None
 
 from pacioli import db
-from pacioli.views.ofx_views import Securities
-from pacioli.models import SecurityPrices
-
-
-def update_ticker_prices():
-    for ticker, in db.session.query(Securities.ticker).all():
-        start_date = datetime.now() - timedelta(days=7)
-        end_date = datetime.now()
-        data = fetch_historical_yahoo(ticker, start_date, end_date)
-        reader = csv.DictReader(data)
-        for row in reader:
-            new_record = SecurityPrices()
-            for key in list(row.keys()):
-                key_name = key.lower().replace('adj close', 'adjusted_close')
-                row[key_name] = row.pop(key)
-            for column in inspect(SecurityPrices).attrs:
-                if column.key == 'id':
+from pacioli.models import LatestPrices, SecurityPrices
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'adjusted_close', 'volume']
+
+
+def price_column_name(header):
+    return header.strip().lower().replace('adj close', 'adjusted_close').replace(' ', '_')
+
+
+def price_value(value):
+    if value is None or value in ('', 'null'):
+        return None
+    return Decimal(str(value))
+
+
+class PriceProvider(object):
+    """
+    A source of daily security prices. fetch returns a ticker's rows
+    between start and end inclusive, as dicts of security_prices columns,
+    and raises LookupError for a ticker it has no prices for.
+    """
+    def fetch(self, ticker, start, end):
+        raise NotImplementedError
+
+    @staticmethod
+    def in_range(price_date, start, end):
+        return (start is None or price_date >= start) and price_date <= end
+
+
+class CSVDirectoryProvider(PriceProvider):
+    """
+    Prices from one <TICKER>.csv file per ticker in a directory, with the
+    Date, Open, High, Low, Close, Adj Close and Volume columns of Yahoo
+    Finance's historical data downloads.
+    """
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            raise ValueError('Price directory not found: {0}'.format(os.path.abspath(directory)))
+        self.directory = directory
+
+    def fetch(self, ticker, start, end):
+        path = os.path.join(self.directory, ticker + '.csv')
+        if not os.path.exists(path):
+            raise LookupError('No price file {0}'.format(path))
+        if sys.version_info[0] < 3:
+            csv_file = open(path, 'rb')
+        else:
+            csv_file = io.open(path, 'r', encoding='utf-8-sig', newline='')
+        with csv_file:
+            reader = csv.reader(csv_file)
+            header = [price_column_name(column) for column in next(reader)]
+            rows = []
+            for values in reader:
+                if not values:
+                    continue
+                row = dict(zip(header, values))
+                price_date = datetime.strptime(row['date'], '%Y-%m-%d').date()
+                if not self.in_range(price_date, start, end):
                     continue
-                elif column.key == 'ticker':
-                    setattr(new_record, column.key, ticker)
-                else:
-                    setattr(new_record, column.key, row[column.key])
-            try:
-                db.session.add(new_record)
-                db.session.commit()
-            except IntegrityError:
-                db.session.rollback()
+                price = dict(ticker=ticker, date=price_date)
+                for column in PRICE_COLUMNS:
+                    price[column] = price_value(row.get(column))
+                rows.append(price)
+        return rows
+
+
+class ParquetDirectoryProvider(CSVDirectoryProvider):
+    """
+    Prices from one <TICKER>.parquet file per ticker in a directory, with
+    the same columns as CSVDirectoryProvider. Needs pandas and a Parquet
+    engine, both in instance-requirements.txt.
+    """
+    def __init__(self, directory):
+        if pandas is None:
+            raise ImportError('ParquetDirectoryProvider requires pandas')
+        super(ParquetDirectoryProvider, self).__init__(directory)
+
+    def fetch(self, ticker, start, end):
+        path = os.path.join(self.directory, ticker + '.parquet')
+        if not os.path.exists(path):
+            raise LookupError('No price file {0}'.format(path))
+        frame = pandas.read_parquet(path)
+        frame.columns = [price_column_name(column) for column in frame.columns]
+        rows = []
+        for record in frame.to_dict('records'):
+            price_date = pandas.Timestamp(record['date']).date()
+            if not self.in_range(price_date, start, end):
+                continue
+            price = dict(ticker=ticker, date=price_date)
+            for column in PRICE_COLUMNS:
+                value = record.get(column)
+                price[column] = None if pandas.isnull(value) else price_value(value)
+            rows.append(price)
+        return rows
+
+
+PRICE_PROVIDERS = {'csv': CSVDirectoryProvider,
+                   'parquet': ParquetDirectoryProvider}
+
+
+def price_provider():
+    provider_class = PRICE_PROVIDERS[current_app.config['PRICE_PROVIDER']]
+    return provider_class(current_app.config['PRICE_DIRECTORY'])
+
+
+def fetch_prices(request, provider):
+    ticker, start, end = request
+    fetch_start = time()
+    try:
+        rows = provider.fetch(ticker, start, end)
+        error = None
+    except Exception as exception:
+        rows = []
+        error = '{0}: {1}'.format(type(exception).__name__, exception)
+    return ticker, rows, error, time() - fetch_start
+
+
+def upsert_security_prices(rows):
+    table = SecurityPrices.__table__
+    statement = insert(table).values(rows)
+    db.session.execute(statement.on_conflict_do_update(
+        constraint='security_prices_unique_constraint',
+        set_=dict((column, getattr(statement.excluded, column)) for column in PRICE_COLUMNS)))
+
+
+def update_ticker_prices(provider=None, workers=None, batch_size=1000):
+    """
+    Fetch the prices missing since each security's latest stored date,
+    for all tickers concurrently, and upsert them in batches. Returns a
+    (ticker, rows, status, fetch seconds) row per ticker.
+    """
+    provider = provider or price_provider()
+    workers = workers or current_app.config['PRICE_SYNC_WORKERS']
+
+    tickers = [ticker for ticker, in (db.session.query(ofx_models.SECINFO.ticker)
+                                      .filter(ofx_models.SECINFO.ticker.isnot(None))
+                                      .distinct())]
+    latest_dates = dict(db.session.query(LatestPrices.ticker, LatestPrices.date))
+    end = date.today()
+    requests = []
+    for ticker in sorted(tickers):
+        start = latest_dates.get(ticker)
+        if start is not None:
+            start += timedelta(days=1)
+            if start > end:
+                continue
+        requests.append((ticker, start, end))
+
+    summary = []
+    if requests:
+        batch = {}
+        pool = ThreadPool(min(workers, len(requests)))
+        for ticker, rows, error, seconds in pool.imap_unordered(partial(fetch_prices, provider=provider),
+                                                                requests):
+            summary.append((ticker, len(rows), error or 'OK', seconds))
+            for row in rows:
+                batch[(row['ticker'], row['date'])] = row
+                if len(batch) == batch_size:
+                    upsert_security_prices(list(batch.values()))
+                    batch = {}
+        pool.close()
+        pool.join()
+        if batch:
+            upsert_security_prices(list(batch.values()))
+        db.session.commit()
+
+    for ticker, row_count, status, seconds in summary:
+        print('{0}: {1} prices, {2} ({3:.2f}s)'.format(ticker, row_count, status, seconds))
+    return summary
@@ -0,0 +1,59 @@
+import re
+
+# Python 2's re module refuses patterns with more than 100 groups
+MAX_GROUPS_PER_PATTERN = 99
+
+
+def keyword_pattern(keyword):
+    """
+    Translate a mapping keyword into a regular expression matching the
+    same lowercased descriptions as
+    LIKE '%' || array_to_string(words, '%') || '%'.
+    """
+    words = []
+    for word in keyword.lower().split():
+        words.append(''.join('.*' if character == '%' else
+                             '.' if character == '_' else
+                             re.escape(character)
+                             for character in word))
+    return '.*?' + '.*'.join(words)
+
+
+def mapping_precedence(mapping):
+    """
+    When several keywords match a description the most specific mapping
+    wins: more words first, then the longer keyword, then the older
+    mapping.
+    """
+    return -len(mapping.keyword.split()), -len(mapping.keyword), mapping.id
+
+
+class MappingMatcher(object):
+    """
+    Match descriptions against every mapping of a source in one pass.
+
+    The keywords are compiled into anchored alternations ordered by
+    mapping_precedence, so the first alternative that matches is the
+    mapping the description belongs to.
+    """
+    def __init__(self, mappings):
+        mappings = sorted((mapping for mapping in mappings
+                           if mapping.keyword and mapping.keyword.split()),
+                          key=mapping_precedence)
+        self.patterns = []
+        for offset in range(0, len(mappings), MAX_GROUPS_PER_PATTERN):
+            chunk = mappings[offset:offset + MAX_GROUPS_PER_PATTERN]
+            alternatives = ['(?P<m{0}>{1})'.format(index, keyword_pattern(mapping.keyword))
+                            for index, mapping in enumerate(chunk)]
+            pattern = re.compile('^(?:' + '|'.join(alternatives) + ')', re.DOTALL)
+            self.patterns.append((pattern, chunk))
+
+    def match(self, description):
+        if not description:
+            return None
+        description = description.lower()
+        for pattern, chunk in self.patterns:
+            match = pattern.match(description)
+            if match:
+                return chunk[int(match.lastgroup[1:])]
+        return None
@@ -1,51 +1,252 @@
 from __future__ import print_function
 
-from datetime import datetime, date
+import codecs
+from contextlib import closing
+from datetime import datetime, date, timedelta
+from functools import partial
+import hashlib
+import io
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import os
+import pkg_resources
+import re
+from tempfile import SpooledTemporaryFile
+from threading import BoundedSemaphore
+from time import time
+from xml.etree import ElementTree
+import zlib
 
-from dateutil.tz import tzlocal
+try:
+    from urllib.parse import urlparse
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+    from urlparse import urlparse
+
+from dateutil.tz import tzlocal, tzutc
 from flask import current_app
-from sqlalchemy import func
-from sqlalchemy.orm.exc import NoResultFound
 
 from ofxtools import OFXClient
 from ofxtools.Client import CcAcct, BankAcct
-from ofxtools.ofxalchemy import OFXParser, get_session
+from ofxtools.ofxalchemy import OFXParser
+from ofxtools.ofxalchemy import models as ofx_models
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import undefer
 from pacioli import db
+from pacioli.database import OFXSession, init_worker, ofx_session as get_ofx_session
+from pacioli.functions.bookkeeping_functions import write_journal_entries
 from pacioli.functions.email_reports import send_error_message
-from pacioli.models import (Subaccounts, Mappings, JournalEntries,
-                            Connections, ConnectionResponses, Transactions,
-                            AccountsFrom, CreditCardAccounts, BankAccounts)
-
-
-def fix_ofx_file(ofx_file_path):
-    old_file = open(ofx_file_path, 'r')
-    if 'verisightprod' not in old_file.read():
-        return ofx_file_path
-    old_file.seek(0)
-    new_file = open(ofx_file_path + ' fixed.ofx', 'w')
-    for line in old_file.readlines():
+from pacioli.functions.mapping_functions import MappingMatcher
+from pacioli.models import (Mappings, ImportedFiles,
+                            Connections, ConnectionResponses, ResponseBlobs,
+                            Transactions, AccountsFrom)
+
+# instantiate_ofx and prepare_ofx_request use ofxtools internals
+# (Element._flatten, _do_origcurrency and extra_attributes,
+# OFXTree.statements, OFXClient.ofxheader) which are only known to work
+# with this release
+OFXTOOLS_REQUIREMENT = 'ofxtools==0.3.8'
+pkg_resources.require(OFXTOOLS_REQUIREMENT)
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# STATUS aggregates of the signon and transaction responses, and their
+# elements, with or without OFX 2 closing tags
+STATUS_PATTERN = re.compile(r'<(SONRS|\w+TRNRS)>.*?<STATUS>(.*?)</STATUS>', re.DOTALL)
+STATUS_ELEMENT_PATTERN = re.compile(r'<(CODE|SEVERITY|MESSAGE)>([^<]*)')
+
+
+def fix_ofx_lines(lines):
+    """
+    Close the <SECID> aggregates that verisightprod statements leave open,
+    in a single pass over the lines.
+    """
+    for line in lines:
         if line.startswith('</SECID>'):
             continue
         elif line.startswith('<TICKER>'):
-            new_file.write(line)
-            new_file.write('</SECID>\n')
+            yield line
+            yield '</SECID>\n'
         elif line.startswith('<HELDINACCT>'):
-            new_file.write('</SECID>\n')
-            new_file.write(line)
+            yield '</SECID>\n'
+            yield line
         else:
-            new_file.write(line)
-    old_file.close()
-    new_file.close()
-    return ofx_file_path + ' fixed.ofx'
-
-
-def sync_ofx():
-    for connection in (db.session.query(Connections)
-                       .filter(Connections.source == 'ofx')
-                       .all()):
-        success = sync_ofx_connection(connection)
-        if not success:
-            break
+            yield line
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as ofx_file:
+        for chunk in iter(partial(ofx_file.read, DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return path, digest.hexdigest()
+
+
+def import_ofx_file(imported_file):
+    """
+    Parse one OFX file and load it in a single transaction, together with
+    its admin.imported_files row. Returns
+    (path, sha256, error, transactions, parse seconds, load seconds).
+    """
+    path, sha256 = imported_file
+    ofx_session = OFXSession
+    parse_start = time()
+    try:
+        with io.open(path, 'r', encoding='utf-8', errors='replace') as ofx_file:
+            source = ofx_file.read()
+        if 'verisightprod' in source:
+            source = ''.join(fix_ofx_lines(source.splitlines(True)))
+        parser = OFXParser()
+        parser.parse(io.StringIO(source))
+        del source
+        load_start = time()
+        transactions = instantiate_ofx(parser, ofx_session)
+        ofx_session.execute(insert(ImportedFiles.__table__)
+                            .values(sha256=sha256,
+                                    file_name=os.path.basename(path),
+                                    imported_at=datetime.now(tzlocal()),
+                                    transactions=transactions)
+                            .on_conflict_do_nothing(index_elements=['sha256']))
+        ofx_session.commit()
+    except Exception as exception:
+        ofx_session.rollback()
+        return path, sha256, format_exception(exception), 0, time() - parse_start, 0
+    return path, sha256, None, transactions, load_start - parse_start, time() - load_start
+
+
+def import_ofx_files(paths, processes=1):
+    """
+    Import OFX files, skipping any whose content was imported before.
+
+    Files are hashed and then parsed and loaded on a process pool, one
+    transaction per file. Files that fail in the pool, typically by racing
+    another file to create the same account or security, are retried
+    serially. Prints a report of files, rows and time per phase.
+    """
+    report = dict(files=len(paths), skipped=0, imported=0, failed=0,
+                  transactions=0, parse_seconds=0, load_seconds=0)
+    start = time()
+    if processes > 1:
+        pool = Pool(processes, initializer=init_worker,
+                    initargs=(current_app.config['SQLALCHEMY_DATABASE_URI'],))
+        map_function = pool.imap_unordered
+    else:
+        pool = None
+        get_ofx_session()
+        map_function = map
+
+    hashes = dict((sha256, path) for path, sha256 in
+                  sorted(map_function(file_sha256, paths), reverse=True))
+    imported_hashes = set(sha256 for sha256, in
+                          (db.session.query(ImportedFiles.sha256)
+                           .filter(ImportedFiles.sha256.in_(list(hashes)))))
+    new_files = sorted((path, sha256) for sha256, path in hashes.items()
+                       if sha256 not in imported_hashes)
+    report['skipped'] = len(paths) - len(new_files)
+    report['hash_seconds'] = time() - start
+
+    import_start = time()
+    failed_files = []
+    results = map_function(import_ofx_file, new_files)
+    for path, sha256, error, transactions, parse_seconds, load_seconds in results:
+        report['parse_seconds'] += parse_seconds
+        report['load_seconds'] += load_seconds
+        if error is None:
+            report['imported'] += 1
+            report['transactions'] += transactions
+        else:
+            failed_files.append((path, sha256))
+    if pool:
+        pool.close()
+        pool.join()
+    report['import_seconds'] = time() - import_start
+
+    retry_start = time()
+    if failed_files:
+        get_ofx_session()
+    results = map(import_ofx_file, failed_files)
+    for path, sha256, error, transactions, parse_seconds, load_seconds in results:
+        if error is None:
+            report['imported'] += 1
+            report['transactions'] += transactions
+        else:
+            report['failed'] += 1
+            print('{0}: {1}'.format(path, error))
+    report['retry_seconds'] = time() - retry_start
+    report['total_seconds'] = time() - start
+
+    print('{files} files: {imported} imported, {skipped} already imported, {failed} failed'.format(**report))
+    print('{transactions} new statement transactions'.format(**report))
+    print('Hashing {hash_seconds:.2f}s, importing {import_seconds:.2f}s '
+          '(parsing {parse_seconds:.2f}s, loading {load_seconds:.2f}s across workers), '
+          'retries {retry_seconds:.2f}s, total {total_seconds:.2f}s'.format(**report))
+    return report
+
+
+def sync_ofx(workers=None, host_concurrency=None, timeout=None, overlap_days=None):
+    """
+    Download statements for every OFX connection concurrently, then parse
+    and store the responses one at a time in the calling thread.
+
+    Downloads run on a bounded thread pool, with at most host_concurrency
+    requests in flight per institution host. Each request only covers the
+    days since the connection's watermark, less overlap_days. A failing or
+    slow connection is reported and does not stop the others. Returns a
+    (connection, status, download seconds, write seconds) row per
+    connection.
+    """
+    workers = workers or current_app.config['OFX_SYNC_WORKERS']
+    host_concurrency = host_concurrency or current_app.config['OFX_SYNC_HOST_CONCURRENCY']
+    timeout = timeout or current_app.config['OFX_SYNC_TIMEOUT']
+    if overlap_days is None:
+        overlap_days = current_app.config['OFX_SYNC_OVERLAP_DAYS']
+
+    connections = dict((connection.id, connection) for connection in
+                       (db.session.query(Connections)
+                        .filter(Connections.source == 'ofx')
+                        .all()))
+    summary = []
+    prepared_requests = []
+    for connection in connections.values():
+        try:
+            if connection.watermark_date is None:
+                # Connections synced before watermarks existed start from the
+                # transactions already loaded, new accounts get their full history
+                update_watermark(connection)
+                db.session.commit()
+            prepared_requests.append(prepare_ofx_request(connection, overlap_days))
+        except Exception as exception:
+            db.session.rollback()
+            summary.append((connection, format_exception(exception), 0, 0))
+
+    if prepared_requests:
+        host_semaphores = dict((urlparse(prepared_request['url']).netloc,
+                                BoundedSemaphore(host_concurrency))
+                               for prepared_request in prepared_requests)
+        pool = ThreadPool(min(workers, len(prepared_requests)))
+        downloads = pool.imap_unordered(partial(download_ofx,
+                                                host_semaphores=host_semaphores,
+                                                timeout=timeout),
+                                        prepared_requests)
+        for connection_id, response, error, download_seconds in downloads:
+            connection = connections[connection_id]
+            write_start = time()
+            if error is None:
+                try:
+                    error = save_ofx_response(connection, response)
+                except Exception as exception:
+                    db.session.rollback()
+                    error = format_exception(exception)
+            summary.append((connection, error or 'OK', download_seconds,
+                            time() - write_start))
+        pool.close()
+        pool.join()
+
+    for connection, status, download_seconds, write_seconds in summary:
+        print('{0}: {1} (download {2:.2f}s, write {3:.2f}s)'.format(
+            connection, status, download_seconds, write_seconds))
 
     for account in (db.session.query(AccountsFrom)
                     .filter(AccountsFrom.name.is_(None))
@@ -53,47 +254,63 @@ def sync_ofx():
         account.name = ''
         db.session.commit()
 
+    return summary
+
+
+def format_exception(exception):
+    return '{0}: {1}'.format(type(exception).__name__, exception)
 
-def sync_ofx_connection(connection):
+
+def connection_account(connection):
     if connection.type in ['Checking', 'Savings']:
-        filter_boolean = BankAccounts.acctid == connection.account_number
-        account = BankAcct(connection.routing_number,
-                           connection.account_number,
-                           connection.type)
+        return (ofx_models.BANKACCTFROM,
+                BankAcct(connection.routing_number,
+                         connection.account_number,
+                         connection.type))
     elif connection.type == 'Credit Card':
-        filter_boolean = CreditCardAccounts.acctid == connection.account_number
-        account = CcAcct(connection.account_number)
+        return ofx_models.CCACCTFROM, CcAcct(connection.account_number)
     else:
         raise Exception('Unrecognized account/'
                         'connection type: {0}'.format(connection.type))
 
-    start, = (db.session.query(Transactions.date)
-              .filter(filter_boolean)
-              .order_by(Transactions.date.desc())
-              .first())
-    if start:
-        start = start.date()
-        end = date.today()
-    else:
-        start = None
-        end = None
-
-
-    # start = start.join(AccountsFrom,
-    #                    Transactions.account_id == AccountsFrom.id)
-
-    # elif connection.type == 'Credit Card':
-    #     start = db.session.query(Transactions.date)
-    #     start = start.join(AccountsFrom, Transactions.account_id == AccountsFrom.id)
-    #     start = start.filter(CreditCardAccounts.acctid == connection.account_number)
-    #     start = start.order_by(Transactions.date.desc())
-    #     start, = start.first()
-    #     if start:
-    #         start = start.date()
-    #         end = date.today()
-    #     else:
-    #         start = None
-    #         end = None
+
+def latest_statement_transaction(connection):
+    """
+    The (dtposted, fitid) of the latest statement transaction loaded for
+    the connection's account, read from ofx.stmttrn by index.
+    """
+    acctfrom_model = connection_account(connection)[0]
+    stmttrn = ofx_models.STMTTRN
+    return (db.session.query(stmttrn.dtposted, stmttrn.fitid)
+            .join(acctfrom_model, acctfrom_model.id == stmttrn.acctfrom_id)
+            .filter(acctfrom_model.acctid == connection.account_number)
+            .order_by(stmttrn.dtposted.desc(), stmttrn.fitid.desc())
+            .first())
+
+
+def update_watermark(connection):
+    latest_transaction = latest_statement_transaction(connection)
+    if latest_transaction:
+        latest_date, latest_fitid = latest_transaction
+        # ofxtools stores posted dates in UTC without a time zone
+        connection.watermark_date = latest_date.replace(tzinfo=tzutc())
+        connection.watermark_fitid = latest_fitid
+
+
+def statement_window(connection, overlap_days=0):
+    """
+    The (start, end) dates of the statement to request: from overlap_days
+    before the watermark until today, or (None, None) for the account's
+    full history.
+    """
+    if connection.watermark_date is None:
+        return None, None
+    return connection.watermark_date.date() - timedelta(days=overlap_days), date.today()
+
+
+def prepare_ofx_request(connection, overlap_days=0):
+    account = connection_account(connection)[1]
+    start, end = statement_window(connection, overlap_days)
 
     ofx_client = OFXClient(connection.url, connection.org, connection.fid,
                            version=220, appid='QWIN', appver='2500')
@@ -108,81 +325,305 @@ def sync_ofx_connection(connection):
     else:
         statement_request = ofx_client.statement_request(connection.user,
                                                          connection.password,
-                                                         connection.clientuid,
-                                                         [account])
-    response = ofx_client.download(statement_request)
+                                                         [account],
+                                                         clientuid=connection.clientuid)
+    # Same request OFXClient.download sends, built here so that the
+    # download itself can run outside of the application and session
+    body = ofx_client.ofxheader + ElementTree.tostring(statement_request).decode()
+    mimetype = 'application/x-ofx'
+    return dict(connection_id=connection.id,
+                url=connection.url,
+                body=body.encode(),
+                headers={'Content-type': mimetype,
+                         'Accept': '*/*, {0}'.format(mimetype)})
+
+
+class SpooledResponse(object):
+    """
+    An OFX response as it streams in: the raw bytes are spooled to a
+    temporary file for the parser and a gzip copy is kept for storage, so
+    the body is never held in memory as a whole.
+    """
+    error_marker = b'<SEVERITY>ERROR'
 
+    def __init__(self, max_size=SPOOL_MAX_SIZE):
+        self.source = SpooledTemporaryFile(max_size=max_size, mode='w+b')
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.digest = hashlib.sha256()
+        self.compressed_chunks = []
+        self.size = 0
+        self.has_error = False
+        self.tail = b''
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        self.digest.update(chunk)
+        self.compressed_chunks.append(self.compressor.compress(chunk))
+        # Carry the end of the previous chunk so a marker split across
+        # two chunks is still found
+        window = self.tail + chunk
+        self.has_error = self.has_error or self.error_marker in window
+        self.tail = window[1 - len(self.error_marker):]
+        self.source.write(chunk)
+
+    def finish(self):
+        self.compressed_chunks.append(self.compressor.flush())
+        self.source.seek(0)
+
+    def reader(self):
+        """
+        The response decoded as UTF-8, read from the start of the spool.
+        """
+        self.source.seek(0)
+        return codecs.getreader('utf-8')(self.source, 'replace')
+
+    def close(self):
+        self.source.close()
+
+    @property
+    def compressed(self):
+        return b''.join(self.compressed_chunks)
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+
+def response_text(response):
+    if response is None:
+        return None
+    response = bytes(response)
+    if response.startswith(b'\x1f\x8b'):
+        response = zlib.decompress(response, 16 + zlib.MAX_WBITS)
+    return response.decode('utf-8', 'replace')
+
+
+def response_status(text):
+    """
+    The CODE and MESSAGE of each signon or transaction STATUS of a
+    response that is not INFO, e.g. 'SONRS 15500: Signon invalid'.
+    """
+    statuses = []
+    for aggregate, status in STATUS_PATTERN.findall(text):
+        elements = dict((tag, value.strip()) for tag, value in STATUS_ELEMENT_PATTERN.findall(status))
+        if elements.get('SEVERITY') == 'INFO':
+            continue
+        status = '{0} {1}'.format(aggregate, elements.get('CODE', ''))
+        if elements.get('MESSAGE'):
+            status += ': ' + elements['MESSAGE']
+        statuses.append(status)
+    return '; '.join(statuses) or 'Unrecognized error response'
+
+
+def download_ofx(prepared_request, host_semaphores, timeout):
+    start = time()
+    try:
+        with host_semaphores[urlparse(prepared_request['url']).netloc]:
+            http_request = Request(prepared_request['url'],
+                                   prepared_request['body'],
+                                   prepared_request['headers'])
+            with closing(urlopen(http_request, timeout=timeout)) as http_response:
+                response = SpooledResponse()
+                for chunk in iter(partial(http_response.read, DOWNLOAD_CHUNK_SIZE), b''):
+                    response.write(chunk)
+                response.finish()
+        error = None
+    except Exception as exception:
+        response = None
+        error = format_exception(exception)
+    return prepared_request['connection_id'], response, error, time() - start
+
+
+def store_response_blob(sha256, size, compressed):
+    """
+    Store a compressed response unless the same content is already
+    stored. Returns True if it was new.
+    """
+    result = db.session.execute(insert(ResponseBlobs.__table__)
+                                .values(sha256=sha256, size=size, content=compressed)
+                                .on_conflict_do_nothing(index_elements=['sha256'])
+                                .returning(ResponseBlobs.__table__.c.sha256))
+    return result.first() is not None
+
+
+def save_ofx_response(connection, response):
+    store_response_blob(response.sha256, response.size, response.compressed)
     new_response = ConnectionResponses()
     new_response.connection_id = connection.id
     new_response.connected_at = datetime.now(tzlocal())
-    new_response.response = response.read()
+    new_response.response_sha256 = response.sha256
+    new_response.response_size = response.size
     db.session.add(new_response)
     db.session.commit()
 
-    if '<SEVERITY>ERROR' in new_response.response:
-        status = new_response.response.lower().title()
+    if response.has_error:
+        status = response_status(response.reader().read())
+        response.close()
+        new_response.status = status
+        db.session.commit()
         send_error_message(status)
-        return False
+        return status
 
-    response.seek(0)
-    ofx_session = get_session(current_app.config['SQLALCHEMY_DATABASE_URI'], 'ofx')
-    parser = OFXParser()
-    parser.parse(response)
-    parser.instantiate()
-    ofx_session.commit()
+    ofx_session = get_ofx_session()
+    try:
+        parser = OFXParser()
+        parser.parse(response.reader())
+        instantiate_ofx(parser, ofx_session)
+        ofx_session.commit()
+    except Exception as exception:
+        ofx_session.rollback()
+        new_response.status = format_exception(exception)
+        db.session.commit()
+        raise
+    finally:
+        response.close()
+    new_response.status = 'OK'
     connection.synced_at = datetime.now(tzlocal())
+    update_watermark(connection)
     db.session.commit()
+    return None
+
+
+def archive_connection_responses(batch_size=100):
+    """
+    Move inline responses into response_blobs, one batch per transaction.
+    Returns the number of responses archived and of new blobs stored.
+    """
+    archived = 0
+    stored = 0
+    while True:
+        connection_responses = (db.session.query(ConnectionResponses)
+                                .options(undefer('response'))
+                                .filter(ConnectionResponses.response.isnot(None))
+                                .limit(batch_size)
+                                .all())
+        if not connection_responses:
+            break
+        for connection_response in connection_responses:
+            content = response_text(connection_response.response).encode('utf-8')
+            sha256 = hashlib.sha256(content).hexdigest()
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed = compressor.compress(content) + compressor.flush()
+            stored += store_response_blob(sha256, len(content), compressed)
+            connection_response.response_sha256 = sha256
+            connection_response.response_size = len(content)
+            connection_response.response = None
+        db.session.commit()
+        archived += len(connection_responses)
+    return archived, stored
 
-    return True
 
+def instantiate_ofx(parser, ofx_session, batch_size=1000):
+    """
+    Instantiate a parsed OFX response, loading bank and credit card
+    statement transactions with multi-row INSERT ... ON CONFLICT DO NOTHING
+    instead of one get-or-create query per transaction. Returns the number
+    of new transactions loaded that way.
+
+    Transactions carrying payee or transfer account aggregates are left to
+    the parser, since those are separate related objects.
+    """
+    inserted = 0
+    statements = []
+    for statement_path, account_tag in (('BANKMSGSRSV1/STMTTRNRS/STMTRS', 'BANKACCTFROM'),
+                                        ('CREDITCARDMSGSRSV1/CCSTMTTRNRS/CCSTMTRS', 'CCACCTFROM')):
+        for stmtrs in parser.findall(statement_path):
+            tranlist = stmtrs.find('BANKTRANLIST')
+            if tranlist is None:
+                continue
+            transactions = [transaction for transaction in tranlist.findall('STMTTRN')
+                            if all(transaction.find(tag) is None
+                                   for tag in ('PAYEE', 'BANKACCTTO', 'CCACCTTO'))]
+            for transaction in transactions:
+                tranlist.remove(transaction)
+            statements.append((stmtrs.find(account_tag), transactions))
+
+    # OFXTree keeps its statements in a class level list that would
+    # otherwise grow with every file parsed in this process
+    parser.statements = []
+    parser.instantiate()
+    ofx_session.flush()
 
-def apply_all_mappings():
-    for mapping_id, in (db.session.query(Mappings.id)
-                        .filter(Mappings.source == 'ofx')
-                        .all()):
-        apply_single_ofx_mapping(mapping_id)
+    stmttrn = ofx_models.STMTTRN.__table__
+    for acctfrom, transactions in statements:
+        account = acctfrom.instantiate()
+        ofx_session.flush()
+        rows = []
+        for transaction in transactions:
+            transaction.extra_attributes = {}
+            transaction._do_origcurrency()
+            row = transaction._flatten()
+            row.update(transaction.extra_attributes)
+            row['acctfrom_id'] = account.id
+            rows.append(dict((key, value) for key, value in row.items()
+                             if key in stmttrn.c))
+        # A multi-row VALUES needs the same columns in every row
+        columns = set(key for row in rows for key in row)
+        rows = [dict((column, values.get(column)) for column in columns) for values in rows]
+        for offset in range(0, len(rows), batch_size):
+            result = ofx_session.execute(insert(stmttrn)
+                                         .values(rows[offset:offset + batch_size])
+                                         .on_conflict_do_nothing(index_elements=['fitid', 'acctfrom_id'])
+                                         .returning(stmttrn.c.fitid))
+            inserted += len(result.fetchall())
+    return inserted
+
+
+def apply_all_mappings(batch_size=1000):
+    mappings = (db.session.query(Mappings)
+                .filter(Mappings.source == 'ofx')
+                .all())
+    matcher = MappingMatcher(mappings)
+    unmapped_transactions = (db.session.query(Transactions)
+                             .filter(Transactions.journal_entry_id.is_(None))
+                             .yield_per(batch_size))
+    new_journal_entries = []
+    mapped_subaccounts = set()
+    for transaction in unmapped_transactions:
+        mapping = matcher.match(transaction.description_lc)
+        if mapping is None:
+            continue
+        new_journal_entries.append(ofx_journal_entry(transaction, mapping))
+        if transaction.amount > 0:
+            mapped_subaccounts.add(mapping.positive_credit_subaccount_id)
+        else:
+            mapped_subaccounts.add(mapping.negative_debit_subaccount_id)
+
+    return write_journal_entries(new_journal_entries, mapped_subaccounts,
+                                 batch_size=batch_size)
+
+
+def ofx_journal_entry(transaction, mapping):
+    new_journal_entry = dict(transaction_id=transaction.id,
+                             transaction_source='ofx',
+                             mapping_id=mapping.id,
+                             timestamp=transaction.date)
+    if transaction.amount > 0:
+        new_journal_entry['debit_subaccount'] = transaction.account
+        new_journal_entry['credit_subaccount'] = mapping.positive_credit_subaccount_id
+    elif transaction.amount < 0:
+        new_journal_entry['debit_subaccount'] = mapping.negative_debit_subaccount_id
+        new_journal_entry['credit_subaccount'] = transaction.account
+    else:
+        raise Exception()
+    new_journal_entry['functional_amount'] = abs(transaction.amount)
+    new_journal_entry['functional_currency'] = 'USD'
+    new_journal_entry['source_amount'] = abs(transaction.amount)
+    new_journal_entry['source_currency'] = 'USD'
+    return new_journal_entry
 
 
 def apply_single_ofx_mapping(mapping_id):
     mapping = db.session.query(Mappings).filter(Mappings.id == mapping_id).one()
     matched_transactions = (db.session.query(Transactions)
-                            .outerjoin(JournalEntries, JournalEntries.transaction_id == Transactions.id)
-                            .filter(JournalEntries.transaction_id.is_(None))
-                            .filter(func.lower(Transactions.description).like('%' + '%'.join(mapping.keyword.lower().split()) + '%'))
+                            .filter(Transactions.journal_entry_id.is_(None))
+                            .filter(Transactions.description_lc.like('%' + '%'.join(mapping.keyword.lower().split()) + '%'))
                             .order_by(Transactions.date.desc()).all())
-    for transaction in matched_transactions:
-        new_journal_entry = JournalEntries()
-        new_journal_entry.transaction_id = transaction.id
-        new_journal_entry.transaction_source = 'ofx'
-        new_journal_entry.timestamp = transaction.date
-        if transaction.amount > 0:
-            new_journal_entry.debit_subaccount = transaction.account
-            try:
-                db.session.query(Subaccounts).filter(Subaccounts.name == mapping.positive_credit_subaccount_id).one()
-            except NoResultFound:
-                new_subaccount = Subaccounts()
-                new_subaccount.name = mapping.positive_credit_subaccount_id
-                new_subaccount.parent = 'Discretionary Costs'
-                db.session.add(new_subaccount)
-                db.session.commit()
-            new_journal_entry.credit_subaccount = mapping.positive_credit_subaccount_id
-        elif transaction.amount < 0:
-            new_journal_entry.credit_subaccount = transaction.account
-            try:
-                db.session.query(Subaccounts).filter(Subaccounts.name == mapping.negative_debit_subaccount_id).one()
-            except NoResultFound:
-                new_subaccount = Subaccounts()
-                new_subaccount.name = mapping.negative_debit_subaccount_id
-                new_subaccount.parent = 'Discretionary Costs'
-                db.session.add(new_subaccount)
-                db.session.commit()
-            new_journal_entry.debit_subaccount = mapping.negative_debit_subaccount_id
-
-        else:
-            raise Exception()
-        new_journal_entry.functional_amount = abs(transaction.amount)
-        new_journal_entry.functional_currency = 'USD'
-        new_journal_entry.source_amount = abs(transaction.amount)
-        new_journal_entry.source_currency = 'USD'
-        db.session.add(new_journal_entry)
-        db.session.commit()
+    new_journal_entries = [ofx_journal_entry(transaction, mapping)
+                           for transaction in matched_transactions]
+    mapped_subaccounts = set()
+    if any(transaction.amount > 0 for transaction in matched_transactions):
+        mapped_subaccounts.add(mapping.positive_credit_subaccount_id)
+    if any(transaction.amount < 0 for transaction in matched_transactions):
+        mapped_subaccounts.add(mapping.negative_debit_subaccount_id)
+    return write_journal_entries(new_journal_entries, mapped_subaccounts)
@@ -61,6 +61,11 @@ class Connections(db.Model):
     created_at = db.Column(db.DateTime(timezone=True))
     synced_at = db.Column(db.DateTime(timezone=True))
 
+    # Posted date and FITID of the latest statement transaction loaded for
+    # the account
+    watermark_date = db.Column(db.DateTime(timezone=True))
+    watermark_fitid = db.Column(db.String)
+
     def __repr__(self):
         return '{0} - {1}'.format(self.source, self.type)
 
@@ -74,7 +79,45 @@ class ConnectionResponses(db.Model):
     connection = db.relationship('Connections')
 
     connected_at = db.Column(db.DateTime(timezone=True))
-    response = db.Column(db.String)
+    status = db.Column(db.String)
+    response_size = db.Column(db.Integer)
+    response_sha256 = db.Column(db.String, db.ForeignKey('admin.response_blobs.sha256'), index=True)
+    response_blob = db.relationship('ResponseBlobs')
+    # Inline responses from before response_blobs, moved there by
+    # manage.py archive_connection_responses
+    response = db.deferred(db.Column(db.LargeBinary))
+
+
+# OFX responses stored once per distinct content, gzip compressed and
+# addressed by the SHA-256 of the uncompressed bytes
+class ResponseBlobs(db.Model):
+    __table_args__ = {'schema': 'admin'}
+    __tablename__ = 'response_blobs'
+
+    sha256 = db.Column(db.String, primary_key=True)
+    size = db.Column(db.Integer)
+    content = db.deferred(db.Column(db.LargeBinary))
+
+
+class TableVersions(db.Model):
+    __table_args__ = {'schema': 'admin'}
+    __tablename__ = 'table_versions'
+
+    # Maintained by the admin.bump_table_version trigger, a table has
+    # changed when its set of versions has
+    table_name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+
+
+class ImportedFiles(db.Model):
+    __table_args__ = {'schema': 'admin'}
+    __tablename__ = 'imported_files'
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String, unique=True, nullable=False)
+    file_name = db.Column(db.String)
+    imported_at = db.Column(db.DateTime(timezone=True))
+    transactions = db.Column(db.Integer)
 
 
 class Mappings(db.Model):
@@ -103,8 +146,26 @@ class Mappings(db.Model):
         return '{0} - {1}'.format(self.source, self.keyword)
 
 
+class MappingOverlaps(db.Model):
+    __table_args__ = (db.UniqueConstraint('description', 'mapping_id_1', 'mapping_id_2',
+                                          name='mapping_overlaps_unique_constraint'),
+                      db.Index('mapping_overlaps_mapping_id_1_index', 'mapping_id_1'),
+                      db.Index('mapping_overlaps_mapping_id_2_index', 'mapping_id_2'),
+                      {'schema': 'admin'})
+    __tablename__ = 'mapping_overlaps'
+
+    # Maintained by the admin.mappings_changed and ofx.stmttrn_changed triggers
+    id = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String)
+    mapping_id_1 = db.Column(db.Integer, db.ForeignKey('admin.mappings.id', ondelete='CASCADE'))
+    mapping_keyword_1 = db.Column(db.String)
+    mapping_id_2 = db.Column(db.Integer, db.ForeignKey('admin.mappings.id', ondelete='CASCADE'))
+    mapping_keyword_2 = db.Column(db.String)
+    source = db.Column(db.String)
+
+
 class TrialBalances(db.Model):
-    __table_args__ = (db.UniqueConstraint('subaccount', 'period', 'period_interval',
+    __table_args__ = (db.UniqueConstraint('subaccount', 'period_interval', 'period',
                                           name='trial_balances_unique_constraint'),
                       {'schema': 'bookkeeping'})
     __tablename__ = 'trial_balances'
@@ -121,6 +182,39 @@ class TrialBalances(db.Model):
     net_changes = db.Column(db.Numeric, nullable=False, default=0)
 
 
+class FinancialStatementLines(db.Model):
+    __table_args__ = (db.UniqueConstraint('period_interval', 'period', 'element', 'subaccount',
+                                          name='financial_statement_lines_unique_constraint'),
+                      db.Index('financial_statement_lines_statement_index',
+                               'statement', 'period_interval', 'period'),
+                      {'schema': 'bookkeeping'})
+    __tablename__ = 'financial_statement_lines'
+
+    # Maintained by the bookkeeping.trial_balances_changed trigger
+    id = db.Column(db.Integer, primary_key=True)
+    period_interval = db.Column(db.String, nullable=False)
+    period = db.Column(db.String, nullable=False)
+    statement = db.Column(db.String, nullable=False)
+    element = db.Column(db.String, nullable=False)
+    subaccount = db.Column(db.String, nullable=False)
+    net_changes = db.Column(db.Numeric, nullable=False, default=0)
+    net_balance = db.Column(db.Numeric, nullable=False, default=0)
+
+
+class FinancialStatementTotals(db.Model):
+    __table_args__ = (db.UniqueConstraint('period_interval', 'period',
+                                          name='financial_statement_totals_unique_constraint'),
+                      {'schema': 'bookkeeping'})
+    __tablename__ = 'financial_statement_totals'
+
+    # Maintained by the bookkeeping.trial_balances_changed trigger
+    id = db.Column(db.Integer, primary_key=True)
+    period_interval = db.Column(db.String, nullable=False)
+    period = db.Column(db.String, nullable=False)
+    net_income = db.Column(db.Numeric)
+    net_equity = db.Column(db.Numeric)
+
+
 class Accruals(db.Model):
     __table_args__ = (db.UniqueConstraint('id', 'name', 'start_date', 'end_date',
                                           name='accruals_unique_constraint'),
@@ -156,8 +250,20 @@ class JournalEntries(db.Model):
     source_amount = db.Column(db.Numeric, nullable=False)
     source_currency = db.Column(db.String, nullable=False)
 
+    # Maintained by the bookkeeping.journal_entry_period_keys trigger
+    period_year = db.Column(db.String)
+    period_quarter = db.Column(db.String)
+    period_month = db.Column(db.String)
+    period_week = db.Column(db.String)
+    period_day = db.Column(db.String)
+
     __table_args__ = (db.UniqueConstraint('transaction_id', 'transaction_source',
                                           name='journal_entries_unique_constraint'),
+                      db.Index('journal_entries_timestamp_index', 'timestamp'),
+                      db.Index('journal_entries_debit_subaccount_timestamp_index',
+                               'debit_subaccount', 'timestamp'),
+                      db.Index('journal_entries_credit_subaccount_timestamp_index',
+                               'credit_subaccount', 'timestamp'),
                       db.CheckConstraint(functional_amount >= 0, name='check_functional_amount_positive'),
                       db.CheckConstraint(source_amount >= 0, name='check_source_amount_positive'),
                       {'schema': 'bookkeeping'})
@@ -168,7 +274,7 @@ class Subaccounts(db.Model):
     __tablename__ = 'subaccounts'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String)
+    name = db.Column(db.String, unique=True)
     description = db.Column(db.String)
     parent = db.Column(db.String, db.ForeignKey('bookkeeping.accounts.name'))
     tax_tags = db.relationship('TaxTags', backref='subaccounts', secondary='tax.subaccounts_tax_tags')
@@ -177,6 +283,19 @@ class Subaccounts(db.Model):
         return '{0} - {1}'.format(self.parent, self.name)
 
 
+class SubaccountLineage(db.Model):
+    __table_args__ = (db.Index('subaccount_lineage_element_index', 'element'),
+                      {'schema': 'bookkeeping'})
+    __tablename__ = 'subaccount_lineage'
+
+    # Maintained by the bookkeeping.chart_of_accounts_changed trigger
+    subaccount = db.Column(db.String, primary_key=True)
+    account = db.Column(db.String)
+    classification = db.Column(db.String)
+    element = db.Column(db.String)
+    cash_source = db.Column(db.String)
+
+
 class TaxTags(db.Model):
     __table_args__ = {'schema': 'tax'}
     __tablename__ = 'tax_tags'
@@ -328,6 +447,33 @@ class SecurityPrices(db.Model):
     volume = db.Column(db.Numeric)
 
 
+class LatestPrices(db.Model):
+    __table_args__ = {'schema': 'investments'}
+    __tablename__ = 'latest_prices'
+
+    # Maintained by the investments.security_prices_changed trigger
+    ticker = db.Column(db.String, primary_key=True)
+    date = db.Column(db.Date)
+    adjusted_close = db.Column(db.Numeric)
+
+
+class PositionSnapshots(db.Model):
+    __table_args__ = {'schema': 'investments'}
+    __tablename__ = 'position_snapshots'
+
+    # Maintained by the investments.investment_transactions_changed and
+    # investments.security_prices_changed triggers
+    ticker = db.Column(db.String, primary_key=True)
+    secname = db.Column(db.String)
+    total_units = db.Column(db.Numeric, nullable=False)
+    cost_basis = db.Column(db.Numeric, nullable=False)
+    close = db.Column(db.Numeric)
+    market_value = db.Column(db.Numeric)
+    pnl = db.Column(db.Numeric)
+    pnl_percent = db.Column(db.Numeric)
+    price_date = db.Column(db.Date)
+
+
 class Paystubs(db.Model):
     __table_args__ = (db.UniqueConstraint('employer_name', 'period_beginning', 'period_ending',
                                           name='paystubs_unique_constraint'),
@@ -376,15 +522,9 @@ def register_views():
                             views=True,
                             only=view_names)
     manual_constraints = [
-        {'view_name': 'admin.mapping_overlaps',
-         'columns': ['description', 'mapping_id_1', 'mapping_id_2'],
-         'constraint_name': 'mapping_overlaps_pk'},
         {'view_name': 'amazon.amazon_transactions',
          'columns': ['id', ],
          'constraint_name': 'amazon_transactions_pk'},
-        {'view_name': 'ofx.cost_bases',
-         'columns': ['ticker', ],
-         'constraint_name': 'cost_bases_pk'},
         {'view_name': 'ofx.investment_transactions',
          'columns': ['id', ],
          'constraint_name': 'investment_transactions_pk'},
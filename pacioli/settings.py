@@ -49,12 +49,26 @@ class Config(object):
     MAIL_ASCII_ATTACHMENTS = False
 
     CACHE_TYPE = 'simple'
+    # List views show the planner's row estimate instead of counting
+    # exactly when it is above this
+    COUNT_ESTIMATE_THRESHOLD = 100000
+
+    # OFX connection sync
+    OFX_SYNC_WORKERS = 8
+    OFX_SYNC_HOST_CONCURRENCY = 2
+    OFX_SYNC_TIMEOUT = 60
+    # Days before the watermark that are downloaded again, to catch
+    # transactions that post late
+    OFX_SYNC_OVERLAP_DAYS = 7
+
+    # Security prices, 'csv' or 'parquet' files per ticker
+    PRICE_PROVIDER = 'csv'
+    PRICE_DIRECTORY = os.path.join('configuration_files', 'prices')
+    PRICE_SYNC_WORKERS = 8
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-    MODEL_MAP = {'admin': {'mapping_overlaps': 'MappingOverlaps',
-                           },
-                 'amazon': {'amazon_transactions': 'AmazonTransactions',
+    MODEL_MAP = {'amazon': {'amazon_transactions': 'AmazonTransactions',
                             },
                  'ofx': {'acctfrom': 'AccountsFrom',
                          'availbal': 'AvailableBalances',
@@ -64,7 +78,6 @@ class Config(object):
                          'invbal': 'InvestmentBalances',
                          'invpos': 'InvestmentPositions',
                          'investment_transactions': 'InvestmentTransactions',
-                         'cost_bases': 'CostBases',
                          'secinfo': 'Securities',
                          'transactions': 'Transactions',
                          },
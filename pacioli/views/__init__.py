@@ -1,6 +1,15 @@
-from flask import url_for, redirect, request, abort
+import hashlib
+import json
+
+from flask import current_app, url_for, redirect, request, abort
+from flask_admin._compat import string_types
 from flask_admin.contrib import sqla
 from flask_security import current_user
+from sqlalchemy import and_, asc, desc, or_, text, tuple_
+from sqlalchemy.orm import joinedload
+
+from pacioli.extensions import cache
+from pacioli.models import TableVersions
 
 
 class PrivateModelView(sqla.ModelView):
@@ -23,3 +32,185 @@ class PrivateModelView(sqla.ModelView):
     can_view_details = True
     column_display_pk = True
     column_display_all_relations = False
+
+    # Page through the default sort with a cursor on the last row shown
+    # instead of an OFFSET, for views too large to count and skip through
+    keyset_pagination = False
+    # Table whose planner statistics stand in for COUNT(*) on unfiltered
+    # pages
+    estimated_count_table = None
+    # Tables whose writes change the rows of the view, list counts are
+    # cached until one of them changes
+    count_tables = ()
+
+    def keyset_order(self, sort_column):
+        if not self.keyset_pagination or sort_column is not None:
+            return None
+        default_order = list(self._get_default_order())
+        if len(default_order) != 1:
+            return None
+        sort_field, sort_joins, sort_desc = default_order[0]
+        if sort_joins:
+            return None
+        return sort_field, getattr(self.model, self._primary_key), sort_desc
+
+    def _apply_sorting(self, query, joins, sort_column, sort_desc):
+        keyset_order = self.keyset_order(sort_column)
+        if keyset_order is None:
+            return super(PrivateModelView, self)._apply_sorting(query, joins, sort_column, sort_desc)
+        sort_field, primary_key, sort_desc = keyset_order
+        anchor = self.keyset_anchor(sort_field, primary_key)
+        if anchor:
+            query = query.filter(self.keyset_filter(sort_field, primary_key, sort_desc, *anchor))
+        direction = desc if sort_desc else asc
+        return query.order_by(direction(sort_field), direction(primary_key)), joins
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        """
+        Flask-Admin's get_list, counting the rows through get_cached_count.
+        """
+        joins = {}
+        count_joins = {}
+
+        query = self.get_query()
+        count_query = self.get_count_query() if not self.simple_list_pager else None
+
+        # Ignore eager-loaded relations (prevent unnecessary joins)
+        if hasattr(query, '_join_entities'):
+            for entity in query._join_entities:
+                for table in entity.tables:
+                    joins[table] = None
+
+        if self._search_supported and search:
+            query, count_query, joins, count_joins = self._apply_search(query, count_query, joins,
+                                                                        count_joins, search)
+
+        if filters and self._filters:
+            query, count_query, joins, count_joins = self._apply_filters(query, count_query, joins,
+                                                                         count_joins, filters)
+
+        count = self.get_cached_count(count_query) if count_query else None
+
+        for join in self._auto_joins:
+            query = query.options(joinedload(join))
+
+        query, joins = self._apply_sorting(query, joins, sort_column, sort_desc)
+        query = self._apply_pagination(query, page, page_size)
+
+        if execute:
+            query = query.all()
+
+        return count, query
+
+    def get_cached_count(self, count_query):
+        """
+        Count the rows of a list page, caching the result until one of
+        count_tables is written to. Results estimated above
+        COUNT_ESTIMATE_THRESHOLD rows show the estimate, from the table
+        statistics for unfiltered pages and from the planner otherwise.
+        """
+        cache_key = self.count_cache_key(count_query)
+        if cache_key is not None:
+            count = cache.get(cache_key)
+            if count is not None:
+                return count
+
+        count = None
+        if count_query.whereclause is None:
+            count = self.get_estimated_count()
+        if count is None:
+            count = self.get_planned_count(count_query)
+        if count is None or count <= current_app.config['COUNT_ESTIMATE_THRESHOLD']:
+            count = count_query.scalar()
+
+        if cache_key is not None:
+            cache.set(cache_key, count)
+        return count
+
+    def count_cache_key(self, count_query):
+        if not self.count_tables:
+            return None
+        # Every committed write leaves a version no earlier key has seen
+        versions = (self.session.query(TableVersions.table_name, TableVersions.version)
+                    .filter(TableVersions.table_name.in_(self.count_tables))
+                    .order_by(TableVersions.table_name, TableVersions.version)
+                    .all())
+        # The statement carries the search, the filters and the view
+        # arguments the query was built from
+        statement = count_query.statement.compile(dialect=self.session.bind.dialect)
+        key = repr((self.endpoint, str(statement), sorted(statement.params.items()),
+                    [tuple(version) for version in versions]))
+        return 'count:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_planned_count(self, count_query):
+        """
+        The planner's estimate of the rows a count query aggregates.
+        """
+        statement = count_query.statement.compile(dialect=self.session.bind.dialect)
+        plan = self.session.connection().execute('EXPLAIN (FORMAT JSON) ' + str(statement),
+                                                 statement.params).scalar()
+        if isinstance(plan, string_types):
+            plan = json.loads(plan)
+        node = plan[0]['Plan']
+        processes = 1
+        while node['Node Type'] in ('Aggregate', 'Gather', 'Gather Merge'):
+            if not node.get('Plans'):
+                return None
+            if node['Node Type'] != 'Aggregate':
+                # Rows below a Gather are estimated per process
+                processes = node.get('Workers Planned', 0) + 1
+            node = node['Plans'][0]
+        return int(node['Plan Rows'] * processes)
+
+    def keyset_anchor(self, sort_field, primary_key):
+        """
+        The (sort value, key) of the row named by the after argument. None
+        starts from the first page, also when after is not a valid key.
+        """
+        after = request.args.get('after')
+        if not after:
+            return None
+        try:
+            after = primary_key.type.python_type(after)
+        except (NotImplementedError, TypeError, ValueError):
+            return None
+        return (self.session.query(sort_field, primary_key)
+                .filter(primary_key == after)
+                .first())
+
+    @staticmethod
+    def keyset_filter(sort_field, primary_key, sort_desc, value, key):
+        """
+        Rows after (value, key) in the sort order. Postgres sorts NULLs as
+        larger than any value, so they come first in descending order.
+        """
+        if sort_desc:
+            if value is None:
+                return or_(and_(sort_field.is_(None), primary_key < key),
+                           sort_field.isnot(None))
+            return tuple_(sort_field, primary_key) < tuple_(value, key)
+        if value is None:
+            return and_(sort_field.is_(None), primary_key > key)
+        return or_(tuple_(sort_field, primary_key) > tuple_(value, key),
+                   sort_field.is_(None))
+
+    def get_estimated_count(self):
+        if not self.estimated_count_table:
+            return None
+        estimate = self.session.execute(text('SELECT reltuples FROM pg_class '
+                                             'WHERE oid = to_regclass(:table_name)'),
+                                        dict(table_name=self.estimated_count_table)).scalar()
+        # Tables that were never analyzed have no estimate
+        if not estimate or estimate < 0:
+            return None
+        return int(estimate)
+
+    def keyset_url(self, after=None):
+        args = request.args.to_dict(flat=False)
+        args.pop('page', None)
+        args.pop('after', None)
+        if after is not None:
+            args['after'] = after
+        args.update(request.view_args)
+        return url_for(request.endpoint, **args)
@@ -1,12 +1,12 @@
-from flask import url_for, redirect, request
+from flask import request
 from flask_admin import expose
 from pacioli.extensions import admin
-from pacioli.models import (db, JournalEntries, Subaccounts,
-                            Accounts, Classifications, Elements, TrialBalances)
+from pacioli.models import (db, FinancialStatementLines,
+                            FinancialStatementTotals, TrialBalances)
 from pacioli.views import PrivateModelView
 from pacioli.views.utilities import (currency_formatter, fs_currency_format,
                                      fs_linked_currency_formatter)
-from sqlalchemy import text, func
+from sqlalchemy import func
 
 
 class TrialBalancesView(PrivateModelView):
@@ -18,6 +18,7 @@ class TrialBalancesView(PrivateModelView):
     #                        'sort_desc': True,
     #                        'absolute_value': False}
     column_default_sort = ('period', True)
+    count_tables = ('bookkeeping.trial_balances',)
     column_searchable_list = ['subaccount']
     column_filters = column_list
     column_sortable_list = column_list
@@ -32,44 +33,6 @@ class TrialBalancesView(PrivateModelView):
     can_delete = False
     can_export = True
 
-    @expose('/refresh_subaccounts/')
-    def refresh_all_subaccounts(self):
-        connection = db.engine.connect()
-        transaction = connection.begin()
-        connection.execute('''
-            TRUNCATE bookkeeping.trial_balances
-            RESTART IDENTITY CASCADE;
-        ''')
-        transaction.commit()
-        transaction.close()
-        query_text = text('''
-            SELECT bookkeeping.update_trial_balance(
-                :debit_subaccount,
-                :credit_subaccount,
-                :period_interval_name,
-                :period_name);
-        ''')
-        subaccounts_query = db.session.query(
-            JournalEntries.debit_subaccount,
-            JournalEntries.credit_subaccount).distinct()
-        for debit_subaccount, credit_subaccount in subaccounts_query:
-            for period_interval_name in ['YYYY', 'YYYY-Q', 'YYYY-MM',
-                                         'YYYY-WW', 'YYYY-MM-DD']:
-                for period_name in db.session.query(
-                        db.func.to_char(JournalEntries.timestamp,
-                                        period_interval_name)).distinct():
-                    transaction = connection.begin()
-
-                    params = dict(debit_subaccount=debit_subaccount,
-                                  credit_subaccount=credit_subaccount,
-                                  period_interval_name=period_interval_name,
-                                  period_name=period_name)
-                    connection.execute(query_text, **params)
-                    transaction.commit()
-                    transaction.close()
-        connection.close()
-        return redirect(url_for('trialbalances.index_view'))
-
 
 admin.add_view(TrialBalancesView(TrialBalances, db.session,
                                  category='Accounting'))
@@ -82,6 +45,7 @@ class IncomeStatementsView(PrivateModelView):
     #                        'sort_desc': True,
     #                        'absolute_value': True}
     column_default_sort = ('net_changes', True)
+    count_tables = ('bookkeeping.financial_statement_lines',)
     column_searchable_list = ['subaccount']
     column_filters = column_list
     column_sortable_list = column_list
@@ -96,33 +60,14 @@ class IncomeStatementsView(PrivateModelView):
     page_size = 100
 
     def get_query(self):
-        return (self.session.query(self.model)
-                .join(Subaccounts)
-                .join(Accounts)
-                .join(Classifications)
-                .join(Elements)
-                .filter(self.model.net_changes != 0)
-                .filter(db.or_(Elements.name == 'Revenues',
-                               Elements.name == 'Expenses',
-                               Elements.name == 'Gains',
-                               Elements.name == 'Losses'))
-                .filter(self.model.period_interval ==
-                        request.view_args['period_interval'])
-                .filter(self.model.period == request.view_args['period']))
+        return self.filter_statement(self.session.query(self.model))
 
     def get_count_query(self):
-        return (self.session.query(func.count('*')).select_from(self.model)
-                .join(Subaccounts)
-                .join(Accounts)
-                .join(Classifications)
-                .join(Elements)
-                .filter(self.model.net_changes != 0)
-                .filter(db.or_(Elements.name == 'Revenues',
-                               Elements.name == 'Expenses',
-                               Elements.name == 'Gains',
-                               Elements.name == 'Losses'))
-                .filter(self.model.period_interval ==
-                        request.view_args['period_interval'])
+        return self.filter_statement(self.session.query(func.count('*')).select_from(self.model))
+
+    def filter_statement(self, query):
+        return (query.filter(self.model.statement == 'Income Statement')
+                .filter(self.model.period_interval == request.view_args['period_interval'])
                 .filter(self.model.period == request.view_args['period']))
 
     @expose('/')
@@ -132,46 +77,24 @@ class IncomeStatementsView(PrivateModelView):
         period_interval = request.view_args.get('period_interval', 'YYYY-MM')
         self._template_args['period_interval'] = period_interval
         request.view_args['period_interval'] = period_interval
+        periods = (self.session.query(FinancialStatementTotals)
+                   .filter(FinancialStatementTotals.period_interval == period_interval)
+                   .filter(FinancialStatementTotals.net_income.isnot(None))
+                   .order_by(FinancialStatementTotals.period.desc()))
         period = request.view_args.get('period', None)
-        if not period:
-            net_income, period = (self.session.query(func.sum(self.model.net_changes), self.model.period)
-                                  .join(Subaccounts)
-                                  .join(Accounts)
-                                  .join(Classifications)
-                                  .join(Elements)
-                                  .filter(self.model.net_changes != 0)
-                                  .filter(db.or_(Elements.name == 'Revenues', Elements.name == 'Expenses',
-                                                 Elements.name == 'Gains', Elements.name == 'Losses'))
-                                  .filter(self.model.period_interval == request.view_args['period_interval'])
-                                  .group_by(self.model.period)
-                                  .order_by(self.model.period.desc())
-                                  .first())
-            request.view_args['period'] = period
+        if period:
+            totals = periods.filter(FinancialStatementTotals.period == period).first()
         else:
-            net_income, = (self.session.query(func.sum(self.model.net_changes))
-                           .join(Subaccounts)
-                           .join(Accounts)
-                           .join(Classifications)
-                           .join(Elements)
-                           .filter(self.model.net_changes != 0)
-                           .filter(db.or_(Elements.name == 'Revenues', Elements.name == 'Expenses',
-                                          Elements.name == 'Gains', Elements.name == 'Losses'))
-                           .filter(self.model.period_interval == request.view_args['period_interval'])
-                           .filter(self.model.period == period)
-                           .first())
+            totals = periods.first()
+            period = totals.period if totals else None
+        request.view_args['period'] = period
         self._template_args['period'] = period
         self._template_args['period_intervals'] = [('YYYY', 'Annual'), ('YYYY-Q', 'Quarterly'), ('YYYY-MM', 'Monthly'), ('YYYY-MM-DD', 'Daily')]
-        self._template_args['periods'] = [period[0] for period in (self.session.query(self.model.period)
-                                                                   .order_by(self.model.period.desc())
-                                                                   .filter(self.model.net_changes != 0)
-                                                                   .filter(db.or_(Elements.name == 'Revenues', Elements.name == 'Expenses',
-                                                                                  Elements.name == 'Gains', Elements.name == 'Losses'))
-                                                                   .filter(self.model.period_interval == request.view_args['period_interval'])
-                                                                   .distinct().limit(10))]
-        net_income = fs_currency_format(-net_income)
+        self._template_args['periods'] = [row.period for row in periods.limit(10)]
+        net_income = fs_currency_format(-totals.net_income if totals else 0)
         self._template_args['footer_row'] = {'subaccount': 'Net Income', 'net_changes': net_income}
         return super(IncomeStatementsView, self).index_view()
-admin.add_view(IncomeStatementsView(TrialBalances, db.session, category='Accounting', name='Income Statements', endpoint='income-statements'))
+admin.add_view(IncomeStatementsView(FinancialStatementLines, db.session, category='Accounting', name='Income Statements', endpoint='income-statements'))
 
 
 class BalanceSheetView(PrivateModelView):
@@ -179,6 +102,7 @@ class BalanceSheetView(PrivateModelView):
     column_list = ('subaccount', 'net_balance')
     # column_default_sort = {'field': 'net_balance', 'sort_desc': True, 'absolute_value': True}
     column_default_sort = ('net_balance', True)
+    count_tables = ('bookkeeping.financial_statement_lines',)
     column_searchable_list = ['subaccount']
     column_filters = column_list
     column_sortable_list = column_list
@@ -193,26 +117,13 @@ class BalanceSheetView(PrivateModelView):
     page_size = 100
 
     def get_query(self):
-        return (self.session.query(self.model)
-                .join(Subaccounts)
-                .join(Accounts)
-                .join(Classifications)
-                .join(Elements)
-                .filter(self.model.net_balance != 0)
-                .filter(db.or_(Elements.name == 'Assets', Elements.name == 'Liabilities',
-                               Elements.name == 'Capital Contributions', Elements.name == 'Capital Distributions'))
-                .filter(self.model.period_interval == request.view_args['period_interval'])
-                .filter(self.model.period == request.view_args['period']))
+        return self.filter_statement(self.session.query(self.model))
 
     def get_count_query(self):
-        return (self.session.query(func.count('*')).select_from(self.model)
-                .join(Subaccounts)
-                .join(Accounts)
-                .join(Classifications)
-                .join(Elements)
-                .filter(self.model.net_balance != 0)
-                .filter(db.or_(Elements.name == 'Assets', Elements.name == 'Liabilities',
-                               Elements.name == 'Capital Contributions', Elements.name == 'Capital Distributions'))
+        return self.filter_statement(self.session.query(func.count('*')).select_from(self.model))
+
+    def filter_statement(self, query):
+        return (query.filter(self.model.statement == 'Balance Sheet')
                 .filter(self.model.period_interval == request.view_args['period_interval'])
                 .filter(self.model.period == request.view_args['period']))
 
@@ -225,34 +136,26 @@ class BalanceSheetView(PrivateModelView):
             period_interval = 'YYYY-MM'
         self._template_args['period_interval'] = period_interval
         request.view_args['period_interval'] = period_interval
-        self._template_args['period_interval'] = period_interval
+        periods = (self.session.query(FinancialStatementTotals)
+                   .filter(FinancialStatementTotals.period_interval == period_interval)
+                   .filter(FinancialStatementTotals.net_equity.isnot(None))
+                   .order_by(FinancialStatementTotals.period.desc()))
         period = request.view_args.get('period', None)
-        if not period:
-            period, = (self.session.query(db.func.to_char(JournalEntries.timestamp, period_interval))
-                       .order_by(db.func.to_char(JournalEntries.timestamp, period_interval).desc()).first())
+        if period:
+            totals = periods.filter(FinancialStatementTotals.period == period).first()
+        else:
+            totals = periods.first()
+            period = totals.period if totals else None
         self._template_args['period'] = period
         request.view_args['period'] = period
         self._template_args['period_intervals'] = [('YYYY', 'Annual'), ('YYYY-Q', 'Quarterly'),
                                                    ('YYYY-MM', 'Monthly'), ('YYYY-MM-DD', 'Daily')]
 
-        self._template_args['periods'] = (self.session.query(db.func.to_char(JournalEntries.timestamp,
-                                                                             self._template_args['period_interval']))
-                                          .order_by(db.func.to_char(JournalEntries.timestamp,
-                                                                    self._template_args['period_interval']).desc()).distinct().limit(30))
-        self._template_args['periods'] = [period[0] for period in self._template_args['periods']]
-        net_equity, = (self.session.query(func.sum(self.model.net_balance))
-                       .join(Subaccounts)
-                       .join(Accounts)
-                       .join(Classifications)
-                       .join(Elements)
-                       .filter(db.or_(Elements.name == 'Assets', Elements.name == 'Liabilities',
-                                      Elements.name == 'Capital Contributions', Elements.name == 'Capital Distributions'))
-                       .filter(self.model.period_interval == request.view_args['period_interval'])
-                       .filter(self.model.period == request.view_args['period']).one())
-        net_equity = fs_currency_format(-net_equity)
+        self._template_args['periods'] = [row.period for row in periods.limit(30)]
+        net_equity = fs_currency_format(-totals.net_equity if totals else 0)
         self._template_args['footer_row'] = {'subaccount': 'Net Equity', 'net_balance': net_equity}
         return super(BalanceSheetView, self).index_view()
 
 
-admin.add_view(BalanceSheetView(TrialBalances, db.session, category='Accounting',
+admin.add_view(BalanceSheetView(FinancialStatementLines, db.session, category='Accounting',
                                 name='Balance Sheet', endpoint='balance-sheet'))
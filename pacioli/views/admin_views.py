@@ -1,10 +1,10 @@
 from datetime import datetime
 
 from dateutil.tz import tzlocal
-from flask import url_for, redirect
+from flask import flash, url_for, redirect
 from flask_admin import expose
 from pacioli.extensions import admin
-from pacioli.functions.ofx_functions import sync_ofx
+from pacioli.functions.ofx_functions import response_text, sync_ofx
 from pacioli.models import (db, Users, Roles, Connections, Mappings, ConnectionResponses, MappingOverlaps)
 from pacioli.views import PrivateModelView
 from pacioli.views.utilities import date_formatter, link_mapping_formatter, link_transaction_search_formatter
@@ -42,7 +42,10 @@ class ConnectionsModelView(PrivateModelView):
 
     @expose('/sync_connections/')
     def sync_connections(self):
-        sync_ofx()
+        for connection, status, download_seconds, write_seconds in sync_ofx():
+            flash('{0}: {1} (download {2:.2f}s, write {3:.2f}s)'.format(connection, status,
+                                                                      download_seconds, write_seconds),
+                  'success' if status == 'OK' else 'error')
         return redirect(url_for('connections.index_view'))
 admin.add_view(ConnectionsModelView(Connections, db.session, category='Admin'))
 
@@ -53,12 +56,17 @@ class ConnectionResponsesView(PrivateModelView):
     can_edit = False
     # column_default_sort = {'field': 'connected_at', 'sort_desc': True, 'absolute_value': False}
     column_default_sort = ('connected_at', True)
-    column_list = ('id', 'connection', 'connected_at', 'response')
+    count_tables = ('admin.connection_responses',)
+    # The response body is only loaded in the details view
+    column_list = ('id', 'connection', 'connected_at', 'status', 'response_size')
+    column_details_list = column_list + ('response_sha256', 'response')
     column_sortable_list = column_list
     column_filters = column_list
-    column_labels = dict(id='ID')
-    column_display_actions = False
+    column_labels = dict(id='ID', response_size='Size (bytes)', response_sha256='SHA-256')
     column_formatters = dict(connected_at=date_formatter)
+    column_formatters_detail = dict(connected_at=date_formatter,
+                                    response=lambda view, context, model, name: response_text(
+                                        model.response_blob.content if model.response_blob else model.response))
 
 admin.add_view(ConnectionResponsesView(ConnectionResponses, db.session, category='Admin', endpoint='connection-responses'))
 
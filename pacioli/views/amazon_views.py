@@ -25,8 +25,11 @@ class AmazonItemView(PrivateModelView):
                    'payment_instrument_type', 'category_id', 'shipment_date')
     column_filters = column_list
     column_searchable_list = ('title', 'category_id')
-    # column_default_sort = {'field': 'id', 'sort_desc': True, 'absolute_value': False}
-    column_default_sort = ('id', True)
+    # column_default_sort = {'field': 'shipment_date', 'sort_desc': True, 'absolute_value': False}
+    column_default_sort = ('shipment_date', True)
+    keyset_pagination = True
+    estimated_count_table = 'amazon.items'
+    count_tables = ('amazon.items', 'bookkeeping.journal_entries')
     column_labels = dict(id='ID', journal_entry_id='JE', order_status='Status', quantity='#',
                          purchase_price_per_unit='Price', item_subtotal='Subtotal',
                          item_subtotal_tax='Tax', item_total='Total', payment_instrument_type='Payment',
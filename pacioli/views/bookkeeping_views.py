@@ -4,6 +4,7 @@ from sqlalchemy import func
 from wtforms import StringField
 
 from pacioli.extensions import admin
+from pacioli.functions.accounting_functions import PERIOD_KEYS, period_range
 from pacioli.models import (db, JournalEntries, Subaccounts,
                             Accounts, Classifications, Elements, DetailedJournalEntries)
 from pacioli.views import PrivateModelView
@@ -12,6 +13,8 @@ from pacioli.views.utilities import date_formatter, id_formatter, currency_forma
 
 
 class JournalEntriesView(PrivateModelView):
+    list_template = 'keyset_list.html'
+
     column_list = ('id',
                    'transaction_id',
                    'transaction_source',
@@ -30,6 +33,9 @@ class JournalEntriesView(PrivateModelView):
 
     # column_default_sort = dict(field='timestamp', sort_desc=True, absolute_value=False)
     column_default_sort = ('timestamp', True)
+    keyset_pagination = True
+    estimated_count_table = 'bookkeeping.journal_entries'
+    count_tables = ('bookkeeping.journal_entries', 'ofx.stmttrn', 'amazon.items')
     column_formatters = dict(transaction_id=id_formatter,
                              timestamp=date_formatter,
                              functional_amount=currency_formatter,
@@ -48,30 +54,21 @@ class JournalEntriesView(PrivateModelView):
     def get_query(self):
         if 'subaccount' not in request.view_args:
             return super(JournalEntriesView, self).get_query()
-        elif not request.view_args.get('cumulative', None):
-            return (self.session.query(self.model)
-                    .filter(db.or_(self.model.debit_subaccount == request.view_args['subaccount'],
-                                   self.model.credit_subaccount == request.view_args['subaccount']))
-                    .filter(db.func.to_char(self.model.timestamp, request.view_args['period_interval']) == request.view_args['period']))
-        else:
-            return (self.session.query(self.model)
-                    .filter(db.or_(self.model.debit_subaccount == request.view_args['subaccount'],
-                                   self.model.credit_subaccount == request.view_args['subaccount']))
-                    .filter(db.func.to_char(self.model.timestamp, request.view_args['period_interval']) <= request.view_args['period']))
+        return self.filter_period(self.session.query(self.model))
 
     def get_count_query(self):
         if 'subaccount' not in request.view_args:
             return super(JournalEntriesView, self).get_count_query()
-        elif not request.view_args.get('cumulative', None):
-            return (self.session.query(func.count('*')).select_from(self.model)
-                    .filter(db.or_(self.model.debit_subaccount == request.view_args['subaccount'],
-                                   self.model.credit_subaccount == request.view_args['subaccount']))
-                    .filter(db.func.to_char(self.model.timestamp, request.view_args['period_interval']) == request.view_args['period']))
-        else:
-            return (self.session.query(func.count('*')).select_from(self.model)
-                    .filter(db.or_(self.model.debit_subaccount == request.view_args['subaccount'],
-                                   self.model.credit_subaccount == request.view_args['subaccount']))
-                    .filter(db.func.to_char(self.model.timestamp, request.view_args['period_interval']) <= request.view_args['period']))
+        return self.filter_period(self.session.query(func.count('*')).select_from(self.model))
+
+    def filter_period(self, query):
+        start, end = period_range(request.view_args['period_interval'], request.view_args['period'])
+        query = (query.filter(db.or_(self.model.debit_subaccount == request.view_args['subaccount'],
+                                     self.model.credit_subaccount == request.view_args['subaccount']))
+                 .filter(self.model.timestamp < end))
+        if not request.view_args.get('cumulative', None):
+            query = query.filter(self.model.timestamp >= start)
+        return query
 
     @expose('/')
     @expose('/<subaccount>/')
@@ -80,17 +77,23 @@ class JournalEntriesView(PrivateModelView):
     @expose('/<subaccount>/<period_interval>/<period>/<cumulative>/')
     def index_view(self, subaccount=None, period_interval=None, period=None, cumulative=None):
         period_interval = request.view_args.get('period_interval', 'YYYY-MM')
+        period_key = PERIOD_KEYS[period_interval]
         if not request.view_args.get('period', None):
-            most_recent_period, = (self.session.query(db.func.to_char(JournalEntries.timestamp, period_interval))
-                       .order_by(db.func.to_char(JournalEntries.timestamp, period_interval).desc()).first())
+            most_recent_period, = (self.session.query(period_key)
+                                   .order_by(JournalEntries.timestamp.desc()).first())
             request.view_args['period'] = most_recent_period
 
         self._template_args['period_interval'] = period_interval
         self._template_args['period'] = request.view_args['period']
         self._template_args['period_intervals'] = [('YYYY', 'Annual'), ('YYYY-Q', 'Quarterly'), ('YYYY-MM', 'Monthly'), ('YYYY-MM-DD', 'Daily')]
-        self._template_args['periods'] = (self.session.query(db.func.to_char(JournalEntries.timestamp, self._template_args['period_interval']))
-                                          .order_by(db.func.to_char(JournalEntries.timestamp, self._template_args['period_interval'])
-                                                    .desc()).distinct().limit(30))
+        subaccount = request.view_args.get('subaccount', None)
+        if subaccount:
+            # A union of two (subaccount, period key) index scans
+            periods = (self.session.query(period_key).filter(JournalEntries.debit_subaccount == subaccount)
+                       .union(self.session.query(period_key).filter(JournalEntries.credit_subaccount == subaccount)))
+        else:
+            periods = self.session.query(period_key).distinct()
+        self._template_args['periods'] = periods.order_by(period_key.desc()).limit(30)
         self._template_args['periods'] = [p[0] for p in self._template_args['periods']]
         return super(JournalEntriesView, self).index_view()
 admin.add_view(JournalEntriesView(DetailedJournalEntries, db.session, category='Bookkeeping', endpoint='journalentries', name='Journal Entries'))
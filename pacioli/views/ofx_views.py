@@ -8,8 +8,8 @@ from wtforms import Form, HiddenField
 from pacioli.extensions import admin
 from pacioli.functions.ofx_functions import apply_all_mappings, apply_single_ofx_mapping
 from pacioli.models import (db, Subaccounts, Mappings, Transactions, AccountsFrom,
-                            BankAccounts, CreditCardAccounts, InvestmentTransactions, CostBases, InvestmentAccounts,
-                            InvestmentBalances, InvestmentPositions, Securities)
+                            BankAccounts, CreditCardAccounts, InvestmentTransactions, InvestmentAccounts,
+                            InvestmentBalances, InvestmentPositions, PositionSnapshots, Securities)
 from pacioli.views import PrivateModelView
 from pacioli.views.utilities import (account_formatter, date_formatter, currency_formatter,
                                      id_formatter, string_formatter, percent_formatter, link_journal_entry_formatter)
@@ -27,6 +27,9 @@ class TransactionsModelView(OFXModelView):
 
     # column_default_sort = dict(field='date', sort_desc=True, absolute_value=False)
     column_default_sort = ('date', True)
+    keyset_pagination = True
+    estimated_count_table = 'ofx.stmttrn'
+    count_tables = ('ofx.stmttrn', 'bookkeeping.journal_entries')
 
     column_list = ('id',
                    'date',
@@ -41,12 +44,13 @@ class TransactionsModelView(OFXModelView):
 
     column_filters = column_list
 
-    column_searchable_list = ('description',
+    column_searchable_list = ('description_lc',
                               )
 
     column_labels = dict(id='ID',
                          account='From Account',
                          date='Date Posted',
+                         description_lc='Description',
                          journal_entry_id='JE',
                          )
 
@@ -156,6 +160,7 @@ admin.add_view(OFXModelView(CreditCardAccounts, db.session,
 class InvestmentTransactionsView(OFXModelView):
     # column_default_sort = {'field': 'dttrade', 'sort_desc': True, 'absolute_value': False}
     column_default_sort = ('dttrade', True)
+    count_tables = ('ofx.invtran',)
     column_list = ('account_name', 'fitid', 'subclass', 'memo', 'dttrade', 'ticker', 'secname', 'units', 'unitprice', 'total')
     column_filters = column_list
     column_labels = dict(account_name='Account', fitid='ID', dttrade='Trade', secname='Security Name',
@@ -169,11 +174,14 @@ admin.add_view(InvestmentTransactionsView(InvestmentTransactions, db.session, na
 
 
 class CostBasesView(OFXModelView):
+    column_default_sort = 'cost_basis'
+    column_list = ('secname', 'total_units', 'cost_basis', 'ticker', 'close', 'market_value', 'pnl',
+                   'pnl_percent', 'price_date')
     column_labels = dict(secname='Security Name')
     column_formatters = dict(close=currency_formatter, market_value=currency_formatter, pnl=currency_formatter, pnl_percent=percent_formatter)
 
 
-admin.add_view(CostBasesView(CostBases, db.session, name='Cost Bases',
+admin.add_view(CostBasesView(PositionSnapshots, db.session, name='Cost Bases',
                              category='Investments', endpoint='investments/cost-bases'))
 
 
@@ -1,20 +1,40 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from functools import partial
+import hashlib
+import io
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
+import threading
+import time
 import unittest
 import uuid
 
-from dateutil.tz import tzlocal
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+
+from dateutil.tz import tzlocal, tzutc
+from ofxtools.ofxalchemy import models as ofx_models
 import psycopg2
 from decimal import Decimal
 
 from psycopg2._psycopg import ProgrammingError
+from sqlalchemy import func
 from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import IntegrityError
 
 from manage import createdb, populate_chart_of_accounts, create_admin
 from pacioli import create_app
 from pacioli.extensions import db
-from pacioli.models import (register_views, JournalEntries,
-                            TrialBalances, Subaccounts,
+from pacioli.models import (register_views, Connections, ConnectionResponses, JournalEntries,
+                            TrialBalances, Subaccounts, TableVersions,
+                            AmazonItems, AmazonOrders, Mappings, MappingOverlaps,
+                            LatestPrices, PositionSnapshots, ResponseBlobs, SecurityPrices,
                             remove_views_from_metadata)
 from pacioli.settings import Config
 
@@ -33,7 +53,7 @@ class TestConfig(Config):
     TESTING = True
 
 
-class TestCase(unittest.TestCase):
+class DatabaseTestCase(unittest.TestCase):
     def setUp(self):
         # self.tearDown()
         connection = psycopg2.connect("dbname=postgres")
@@ -113,6 +133,23 @@ class TestCase(unittest.TestCase):
         cursor.close()
         connection.close()
 
+
+class TestCase(DatabaseTestCase):
+    def add_bank_account(self, acctid='1234'):
+        account = ofx_models.BANKACCTFROM(bankid='021000021', acctid=acctid, accttype='CHECKING',
+                                          name='Chase Checking')
+        db.session.add(account)
+        db.session.commit()
+        return account
+
+    def add_statement_transaction(self, account, fitid, name, memo=None, trnamt=Decimal('-3'),
+                                  dtposted=datetime(2016, 1, 4)):
+        transaction = ofx_models.STMTTRN(acctfrom=account, fitid=fitid, trntype='DEBIT', dtposted=dtposted,
+                                         trnamt=trnamt, name=name, memo=memo)
+        db.session.add(transaction)
+        db.session.commit()
+        return transaction
+
     def test_create_admin(self):
         create_admin('test@localhost', test_user_password)
 
@@ -212,5 +249,1297 @@ class TestCase(unittest.TestCase):
         )
         self.assertEqual(current_month_balance.net_balance, Decimal('0'))
 
+    def test_backdated_entry(self):
+        today = datetime.now(tzlocal())
+        a_month_ago = today - timedelta(days=40)
+        expense_account = 'Rent'
+        cash_account = 'Chase Checking'
+        amount = Decimal('100')
+        currency = 'USD'
+
+        for timestamp in (today, a_month_ago):
+            expense_payment = JournalEntries()
+            expense_payment.timestamp = timestamp
+            expense_payment.debit_subaccount = expense_account
+            expense_payment.credit_subaccount = cash_account
+            expense_payment.functional_amount = amount
+            expense_payment.functional_currency = currency
+            expense_payment.source_amount = amount
+            expense_payment.source_currency = currency
+            db.session.add(expense_payment)
+            db.session.commit()
+
+        monthly_balances = (
+            db.session.query(TrialBalances)
+                .filter(TrialBalances.period_interval == 'YYYY-MM')
+                .filter(TrialBalances.subaccount == cash_account)
+                .order_by(TrialBalances.period.desc()).all()
+        )
+        current_month_balance, prior_month_balance = monthly_balances
+        self.assertEqual(prior_month_balance.net_changes, Decimal('-100'))
+        self.assertEqual(prior_month_balance.net_balance, Decimal('-100'))
+        self.assertEqual(current_month_balance.net_changes, Decimal('-100'))
+        self.assertEqual(current_month_balance.net_balance, Decimal('-200'))
+
+    def test_deleted_entry(self):
+        today = datetime.now(tzlocal())
+        expense_account = 'Rent'
+        cash_account = 'Chase Checking'
+        amount = Decimal('100')
+        currency = 'USD'
+
+        expense_payment = JournalEntries()
+        expense_payment.timestamp = today
+        expense_payment.debit_subaccount = expense_account
+        expense_payment.credit_subaccount = cash_account
+        expense_payment.functional_amount = amount
+        expense_payment.functional_currency = currency
+        expense_payment.source_amount = amount
+        expense_payment.source_currency = currency
+        db.session.add(expense_payment)
+        db.session.commit()
+
+        db.session.delete(expense_payment)
+        db.session.commit()
+
+        current_month_balance = (
+            db.session.query(TrialBalances)
+                .filter(TrialBalances.period_interval == 'YYYY-MM')
+                .filter(TrialBalances.subaccount == expense_account)
+                .order_by(TrialBalances.period.desc()).limit(1).first()
+        )
+        self.assertEqual(current_month_balance.net_changes, Decimal('0'))
+        self.assertEqual(current_month_balance.net_balance, Decimal('0'))
+
+    def test_refresh_trial_balances(self):
+        from pacioli.functions.accounting_functions import refresh_trial_balances
+
+        today = datetime.now(tzlocal())
+        a_month_ago = today - timedelta(days=40)
+        expense_account = 'Rent'
+        cash_account = 'Chase Checking'
+        amount = Decimal('100')
+        currency = 'USD'
+
+        for timestamp in (a_month_ago, today):
+            expense_payment = JournalEntries()
+            expense_payment.timestamp = timestamp
+            expense_payment.debit_subaccount = expense_account
+            expense_payment.credit_subaccount = cash_account
+            expense_payment.functional_amount = amount
+            expense_payment.functional_currency = currency
+            expense_payment.source_amount = amount
+            expense_payment.source_currency = currency
+            db.session.add(expense_payment)
+            db.session.commit()
+
+        def balances():
+            return [(tb.subaccount, tb.period_interval, tb.period,
+                     tb.net_balance, tb.net_changes)
+                    for tb in (db.session.query(TrialBalances)
+                               .order_by(TrialBalances.subaccount,
+                                         TrialBalances.period_interval,
+                                         TrialBalances.period))]
+
+        def trial_balances_version():
+            return (db.session.query(func.max(TableVersions.version))
+                    .filter(TableVersions.table_name == 'bookkeeping.trial_balances')
+                    .scalar())
+
+        incremental_balances = balances()
+        version = trial_balances_version()
+        db.session.commit()
+
+        db.engine.execute('CREATE INDEX trial_balances_period_index ON bookkeeping.trial_balances (period);')
+
+        refresh_trial_balances(processes=2)
+        self.assertEqual(balances(), incremental_balances)
+        self.assertGreater(trial_balances_version(), version)
+        # The table is refilled in place and the shadow table is dropped
+        self.assertIsNotNone(db.engine.execute(
+            "SELECT to_regclass('bookkeeping.trial_balances_period_index');").scalar())
+        self.assertIsNone(db.engine.execute(
+            "SELECT to_regclass('bookkeeping.trial_balances_rebuild');").scalar())
+
+    def test_refresh_trial_balances_failure(self):
+        from pacioli.functions import accounting_functions
+
+        def add_rent_payment():
+            db.session.add(JournalEntries(timestamp=datetime.now(tzlocal()), debit_subaccount='Rent',
+                                          credit_subaccount='Chase Checking', functional_amount=Decimal('5'),
+                                          functional_currency='USD', source_amount=Decimal('5'),
+                                          source_currency='USD'))
+            db.session.commit()
+
+        add_rent_payment()
+        incremental_balances = db.session.query(TrialBalances).count()
+        db.session.commit()
+
+        def failing_shard(*args):
+            raise RuntimeError('Shard failed')
+
+        build_trial_balances_shard = accounting_functions.build_trial_balances_shard
+        accounting_functions.build_trial_balances_shard = failing_shard
+        try:
+            with self.assertRaises(RuntimeError):
+                accounting_functions.refresh_trial_balances()
+        finally:
+            accounting_functions.build_trial_balances_shard = build_trial_balances_shard
+
+        # The journal lock is released and nothing is left behind
+        self.assertIsNone(db.engine.execute(
+            "SELECT to_regclass('bookkeeping.trial_balances_rebuild');").scalar())
+        self.assertEqual(db.session.query(TrialBalances).count(), incremental_balances)
+        add_rent_payment()
+
+    def test_period_keys(self):
+        from pacioli.functions.accounting_functions import PERIOD_KEYS, period_range
+
+        timestamp = datetime(2016, 12, 31, 15, 30)
+        expense_payment = JournalEntries()
+        expense_payment.timestamp = timestamp
+        expense_payment.debit_subaccount = 'Rent'
+        expense_payment.credit_subaccount = 'Chase Checking'
+        expense_payment.functional_amount = Decimal('100')
+        expense_payment.functional_currency = 'USD'
+        expense_payment.source_amount = Decimal('100')
+        expense_payment.source_currency = 'USD'
+        db.session.add(expense_payment)
+        db.session.commit()
+
+        for period_interval, period_key in PERIOD_KEYS.items():
+            period, expected_period = (
+                db.session.query(period_key,
+                                 db.func.to_char(JournalEntries.timestamp, period_interval))
+                    .filter(JournalEntries.id == expense_payment.id).one()
+            )
+            self.assertEqual(period, expected_period)
+            start, end = period_range(period_interval, period)
+            self.assertTrue(start <= timestamp < end)
+
+    def test_period_keys_backfill(self):
+        from pacioli.database.sql_views import (create_journal_entry_period_keys_trigger_function,
+                                                create_trial_balances_trigger_function)
+
+        entry = JournalEntries(timestamp=datetime(2016, 3, 1, 12), debit_subaccount='Rent',
+                               credit_subaccount='Chase Checking', functional_amount=Decimal('100'),
+                               functional_currency='USD', source_amount=Decimal('100'), source_currency='USD')
+        db.session.add(entry)
+        db.session.commit()
+        balances = db.session.query(TrialBalances.subaccount, TrialBalances.period, TrialBalances.net_balance).all()
+
+        # A journal from before the period keys, with the baseline row
+        # trigger in place of the statement triggers
+        db.engine.execute("""
+            ALTER TABLE bookkeeping.journal_entries DISABLE TRIGGER USER;
+            UPDATE bookkeeping.journal_entries
+              SET period_year = NULL, period_quarter = NULL, period_month = NULL,
+                  period_week = NULL, period_day = NULL;
+            ALTER TABLE bookkeeping.journal_entries ENABLE TRIGGER USER;
+            DROP TRIGGER journal_entries_insert_trigger ON bookkeeping.journal_entries;
+            DROP TRIGGER journal_entries_update_trigger ON bookkeeping.journal_entries;
+            DROP TRIGGER journal_entries_delete_trigger ON bookkeeping.journal_entries;
+            CREATE FUNCTION bookkeeping.subaccount_insert_triggered()
+            RETURNS trigger AS $$
+              BEGIN
+                RAISE EXCEPTION 'Baseline trigger fired';
+              END;
+            $$
+            LANGUAGE  plpgsql;
+            CREATE TRIGGER subaccount_insert_trigger
+                AFTER INSERT OR UPDATE
+                ON bookkeeping.journal_entries
+                FOR EACH ROW
+                EXECUTE PROCEDURE bookkeeping.subaccount_insert_triggered();
+            """)
+
+        create_journal_entry_period_keys_trigger_function()
+        create_trial_balances_trigger_function()
+        db.session.expire_all()
+        self.assertEqual((entry.period_year, entry.period_quarter, entry.period_month, entry.period_day),
+                         ('2016', '2016-1', '2016-03', '2016-03-01'))
+        self.assertEqual(db.session.query(TrialBalances.subaccount, TrialBalances.period,
+                                          TrialBalances.net_balance).all(), balances)
+
+    def test_financial_statements(self):
+        from pacioli.database.sql_views import create_financial_statements_trigger_function
+        from pacioli.models import FinancialStatementLines, FinancialStatementTotals
+
+        expense_payment = JournalEntries()
+        expense_payment.timestamp = datetime(2016, 6, 15, tzinfo=tzlocal())
+        expense_payment.debit_subaccount = 'Rent'
+        expense_payment.credit_subaccount = 'Chase Checking'
+        expense_payment.functional_amount = Decimal('100')
+        expense_payment.functional_currency = 'USD'
+        expense_payment.source_amount = Decimal('100')
+        expense_payment.source_currency = 'USD'
+        db.session.add(expense_payment)
+        db.session.commit()
+
+        lines = dict(
+            (line.subaccount, line) for line in
+            db.session.query(FinancialStatementLines)
+                .filter(FinancialStatementLines.period_interval == 'YYYY-MM')
+                .filter(FinancialStatementLines.period == '2016-06')
+        )
+        self.assertEqual(lines['Rent'].statement, 'Income Statement')
+        self.assertEqual(lines['Rent'].net_changes, Decimal('100'))
+        self.assertEqual(lines['Chase Checking'].statement, 'Balance Sheet')
+        self.assertEqual(lines['Chase Checking'].net_balance, Decimal('-100'))
+
+        totals = (db.session.query(FinancialStatementTotals)
+                  .filter(FinancialStatementTotals.period_interval == 'YYYY-MM')
+                  .filter(FinancialStatementTotals.period == '2016-06').one())
+        self.assertEqual(totals.net_income, Decimal('100'))
+        self.assertEqual(totals.net_equity, Decimal('-100'))
+
+        # createdb rebuilds the lines of an existing journal
+        line_count = db.session.query(FinancialStatementLines).count()
+        db.session.commit()
+        db.engine.execute('DELETE FROM bookkeeping.financial_statement_lines;')
+        create_financial_statements_trigger_function()
+        self.assertEqual(db.session.query(FinancialStatementLines).count(), line_count)
+
+        db.session.delete(expense_payment)
+        db.session.commit()
+        self.assertEqual(db.session.query(FinancialStatementLines).count(), 0)
+
+    def test_subaccount_lineage(self):
+        from pacioli.database.sql_views import create_subaccount_lineage_trigger_function
+        from pacioli.models import (Classifications, FinancialStatementLines,
+                                    SubaccountLineage)
+
+        # createdb backfills the lineage of existing subaccounts
+        db.engine.execute('DELETE FROM bookkeeping.subaccount_lineage;')
+        create_subaccount_lineage_trigger_function()
+
+        lineage = db.session.query(SubaccountLineage).get('Rent')
+        self.assertEqual((lineage.account, lineage.classification,
+                          lineage.element, lineage.cash_source),
+                         ('Rent Expense', 'Fixed Costs', 'Expenses', 'Operating'))
+
+        expense_payment = JournalEntries()
+        expense_payment.timestamp = datetime.now(tzlocal())
+        expense_payment.debit_subaccount = 'Rent'
+        expense_payment.credit_subaccount = 'Chase Checking'
+        expense_payment.functional_amount = Decimal('100')
+        expense_payment.functional_currency = 'USD'
+        expense_payment.source_amount = Decimal('100')
+        expense_payment.source_currency = 'USD'
+        db.session.add(expense_payment)
+        db.session.commit()
+
+        classification = db.session.query(Classifications).get('Fixed Costs')
+        classification.parent = 'Losses'
+        db.session.commit()
+
+        db.session.expire_all()
+        lineage = db.session.query(SubaccountLineage).get('Rent')
+        self.assertEqual(lineage.element, 'Losses')
+        elements = set(line.element for line in
+                       db.session.query(FinancialStatementLines)
+                           .filter(FinancialStatementLines.subaccount == 'Rent'))
+        self.assertEqual(elements, set(['Losses']))
+
+    def test_write_journal_entries(self):
+        from pacioli.functions.bookkeeping_functions import write_journal_entries
+
+        journal_entries = [dict(transaction_id=str(transaction_id),
+                                transaction_source='test',
+                                timestamp=datetime.now(tzlocal()),
+                                debit_subaccount='Coffee',
+                                credit_subaccount='Chase Checking',
+                                functional_amount=Decimal('3'),
+                                functional_currency='USD',
+                                source_amount=Decimal('3'),
+                                source_currency='USD')
+                           for transaction_id in range(3)]
+        self.assertEqual(write_journal_entries(journal_entries, ['Coffee']), (3, 0))
+        self.assertEqual(write_journal_entries(journal_entries, ['Coffee']), (0, 3))
+
+        coffee = db.session.query(Subaccounts).filter(Subaccounts.name == 'Coffee').one()
+        self.assertEqual(coffee.parent, 'Discretionary Costs')
+        self.assertEqual(db.session.query(JournalEntries).count(), 3)
+
+    def test_subaccounts_name_index(self):
+        from pacioli.database.sql_views import create_subaccounts_name_index
+
+        # As on a database created before subaccount names were unique
+        # and their lineage, which is keyed by name
+        db.engine.execute('ALTER TABLE bookkeeping.subaccounts DROP CONSTRAINT subaccounts_name_key CASCADE;')
+        db.engine.execute('ALTER TABLE bookkeeping.subaccounts DISABLE TRIGGER subaccount_lineage_trigger;')
+        db.engine.execute("INSERT INTO bookkeeping.subaccounts (name, parent) VALUES ('Rent', 'Rent Expense');")
+        with self.assertRaises(ValueError):
+            create_subaccounts_name_index()
+
+        db.engine.execute("DELETE FROM bookkeeping.subaccounts WHERE name = 'Rent' "
+                          "AND id = (SELECT max(id) FROM bookkeeping.subaccounts WHERE name = 'Rent');")
+        create_subaccounts_name_index()
+        db.engine.execute('ALTER TABLE bookkeeping.subaccounts ENABLE TRIGGER subaccount_lineage_trigger;')
+        with self.assertRaises(IntegrityError):
+            db.engine.execute("INSERT INTO bookkeeping.subaccounts (name, parent) VALUES ('Rent', 'Rent Expense');")
+
+    def test_mapping_overlaps(self):
+        def overlaps():
+            return sorted(db.session.query(MappingOverlaps.description, MappingOverlaps.mapping_keyword_1,
+                                           MappingOverlaps.mapping_keyword_2))
+
+        db.session.add(Mappings(source='ofx', keyword='coffee'))
+        db.session.add(Mappings(source='ofx', keyword='blue shop'))
+        db.session.commit()
+        account = self.add_bank_account()
+        transaction = self.add_statement_transaction(account, '1', 'Blue Coffee Shop')
+        self.add_statement_transaction(account, '2', 'Corner Coffee')
+        self.assertEqual(overlaps(), [('Blue Coffee Shop', 'blue shop', 'coffee'),
+                                      ('Blue Coffee Shop', 'coffee', 'blue shop')])
+
+        transaction.name = 'Blue Coffee'
+        db.session.commit()
+        self.assertEqual(overlaps(), [])
+
+        transaction.name = 'Blue Coffee Shop Two'
+        db.session.commit()
+        self.assertEqual(len(overlaps()), 2)
+
+        db.session.delete(transaction)
+        db.session.commit()
+        self.assertEqual(overlaps(), [])
+
+    def test_refresh_mapping_overlaps(self):
+        from pacioli.database.sql_views import create_mapping_overlaps_trigger_function
+
+        account = self.add_bank_account()
+        self.add_statement_transaction(account, '1', 'Blue Coffee Shop')
+        coffee = Mappings(source='ofx', keyword='coffee')
+        shop = Mappings(source='ofx', keyword='tea shop')
+        db.session.add_all([coffee, shop])
+        db.session.commit()
+        self.assertEqual(db.session.query(MappingOverlaps).count(), 0)
+
+        # Changing a keyword refreshes the overlaps of its mapping
+        shop.keyword = 'blue shop'
+        db.session.commit()
+        self.assertEqual(db.session.query(MappingOverlaps).count(), 2)
+
+        db.session.query(MappingOverlaps).delete()
+        db.session.commit()
+        with db.engine.begin() as connection:
+            connection.execute('SELECT admin.refresh_mapping_overlaps({0});'.format(coffee.id))
+        self.assertEqual(set(db.session.query(MappingOverlaps.mapping_id_1)), {(coffee.id,), (shop.id,)})
+
+        # createdb refreshes the overlaps of every OFX mapping, replacing
+        # the view of older databases with the table
+        db.session.query(MappingOverlaps).delete()
+        db.session.commit()
+        db.engine.execute('DROP TABLE admin.mapping_overlaps;')
+        db.engine.execute('CREATE VIEW admin.mapping_overlaps AS SELECT 1 AS mapping_id_1;')
+        create_mapping_overlaps_trigger_function()
+        self.assertEqual(db.session.query(MappingOverlaps).count(), 2)
+
+        db.session.delete(shop)
+        db.session.commit()
+        self.assertEqual(db.session.query(MappingOverlaps).count(), 0)
+
+    def test_apply_ofx_mappings(self):
+        from pacioli.functions.ofx_functions import apply_all_mappings, apply_single_ofx_mapping
+        from pacioli.models import Transactions
+
+        account = self.add_bank_account()
+        self.add_statement_transaction(account, '1', 'Blue Coffee Shop')
+        self.add_statement_transaction(account, '2', 'Corner Coffee', trnamt=Decimal('-4'))
+        self.add_statement_transaction(account, '3', 'Payroll', trnamt=Decimal('500'))
+        self.add_statement_transaction(account, '4', 'Green Tea', trnamt=Decimal('-6'))
+        for name in ('Cafes', 'Coffee'):
+            db.session.add(Subaccounts(name=name, parent='Discretionary Costs'))
+        coffee = Mappings(source='ofx', keyword='coffee', negative_debit_subaccount_id='Coffee')
+        blue_coffee = Mappings(source='ofx', keyword='blue coffee', negative_debit_subaccount_id='Cafes')
+        tea = Mappings(source='ofx', keyword='tea', negative_debit_subaccount_id='Coffee')
+        db.session.add_all([coffee, blue_coffee, tea,
+                            Mappings(source='ofx', keyword='payroll', positive_credit_subaccount_id='Salary'),
+                            Mappings(source='amazon', keyword='corner', negative_debit_subaccount_id='Cafes')])
+        db.session.commit()
+
+        # A journal entry from another source sharing the transaction's id
+        # does not count as its mapping
+        tea_transaction = db.session.query(Transactions).filter(Transactions.description == 'Green Tea').one()
+        db.session.add(JournalEntries(transaction_id=tea_transaction.id, transaction_source='test',
+                                      timestamp=datetime(2016, 1, 4, tzinfo=tzlocal()),
+                                      debit_subaccount='Coffee', credit_subaccount='Chase Checking',
+                                      functional_amount=Decimal('1'), functional_currency='USD',
+                                      source_amount=Decimal('1'), source_currency='USD'))
+        db.session.commit()
+
+        self.assertEqual(apply_single_ofx_mapping(tea.id), (1, 0))
+        self.assertEqual(apply_all_mappings(), (3, 0))
+        self.assertEqual(apply_all_mappings(), (0, 0))
+        entries = dict(db.session.query(JournalEntries.functional_amount,
+                                        JournalEntries.debit_subaccount + '/' + JournalEntries.credit_subaccount)
+                       .filter(JournalEntries.transaction_source == 'ofx'))
+        # The more specific keyword wins the blue coffee shop
+        self.assertEqual(entries, {Decimal('3'): 'Cafes/Chase Checking',
+                                   Decimal('4'): 'Coffee/Chase Checking',
+                                   Decimal('500'): 'Chase Checking/Salary',
+                                   Decimal('6'): 'Coffee/Chase Checking'})
+
+    def test_import_ofx_file(self):
+        import os
+        from pacioli.database import ofx_session
+        from pacioli.functions.ofx_functions import file_sha256, import_ofx_file
+        from pacioli.models import InvestmentTransactions
+
+        ofx_session()
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', 'statements.ofx')
+        path, sha256, error, transactions, parse_seconds, load_seconds = import_ofx_file(file_sha256(path))
+        self.assertIsNone(error)
+        # The transaction with a payee is instantiated by the parser
+        self.assertEqual(transactions, 2)
+
+        statement_transactions = (db.session.query(ofx_models.STMTTRN)
+                                  .order_by(ofx_models.STMTTRN.fitid).all())
+        self.assertEqual([(transaction.fitid, transaction.trnamt, transaction.name, transaction.memo)
+                          for transaction in statement_transactions],
+                         [('1001', Decimal('-3.00'), 'Blue Coffee', 'Shop #12'),
+                          ('1002', Decimal('500.00'), 'Payroll', None),
+                          ('1003', Decimal('-80.00'), None, None)])
+        self.assertEqual(statement_transactions[0].dtposted.date(), date(2016, 1, 4))
+        self.assertEqual(statement_transactions[0].acctfrom.acctid, '1234')
+        self.assertEqual(statement_transactions[2].payee.name, 'City Power')
+
+        investment_transaction = db.session.query(InvestmentTransactions).one()
+        self.assertEqual((investment_transaction.fitid, investment_transaction.subclass,
+                          investment_transaction.ticker, investment_transaction.units,
+                          investment_transaction.total),
+                         ('2001', 'buymf', 'EXIDX', Decimal('10.000'), Decimal('1000.00')))
+
+    def test_import_ofx_files(self):
+        import os
+        import shutil
+        import tempfile
+        from pacioli.functions.ofx_functions import import_ofx_files
+        from pacioli.models import ImportedFiles
+
+        fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', 'statements.ofx')
+        directory = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(directory, name) for name in ('january.ofx', 'january copy.ofx')]
+            shutil.copy(fixture, paths[0])
+            report = import_ofx_files(paths[:1])
+            self.assertEqual((report['imported'], report['skipped'], report['transactions']), (1, 0, 2))
+
+            # The same content under another name is skipped by its hash
+            shutil.copy(fixture, paths[1])
+            report = import_ofx_files(paths, processes=2)
+            self.assertEqual((report['imported'], report['skipped'], report['failed']), (0, 2, 0))
+
+            # Reloading transactions that are already there adds no rows
+            db.session.query(ImportedFiles).delete()
+            db.session.commit()
+            report = import_ofx_files(paths[:1])
+            self.assertEqual((report['imported'], report['transactions']), (1, 0))
+        finally:
+            shutil.rmtree(directory)
+
+        imported_file = db.session.query(ImportedFiles).one()
+        self.assertEqual((imported_file.file_name, imported_file.transactions), ('january.ofx', 0))
+        self.assertEqual(db.session.query(ofx_models.STMTTRN).count(), 3)
+        self.assertEqual(db.session.query(ofx_models.INVTRAN).count(), 1)
+
+    def test_ofx_session_engine(self):
+        import os
+        from multiprocessing import Pool
+        from flask import current_app
+        from pacioli import database
+
+        # The OFX paths reuse the application's engine and session
+        session = database.ofx_session()()
+        self.assertIs(session.get_bind(), db.engine)
+        self.assertIs(database.ofx_session()(), session)
+
+        pool = Pool(2, initializer=database.init_worker,
+                    initargs=(current_app.config['SQLALCHEMY_DATABASE_URI'],))
+        try:
+            bindings = pool.map(ofx_session_binding, range(4))
+        finally:
+            pool.close()
+            pool.join()
+        for pid, worker_bound, pool_size, database_name in bindings:
+            self.assertNotEqual(pid, os.getpid())
+            self.assertTrue(worker_bound)
+            self.assertEqual(pool_size, 1)
+            self.assertEqual(database_name, 'pacioli_test')
+        self.assertIs(database.ofx_session()().get_bind(), db.engine)
+
+    def test_transaction_key(self):
+        from pacioli.database.sql_views import create_ofx_transaction_key_trigger_function
+        from pacioli.models import Transactions
+
+        def add_account(account_id):
+            account = ofx_models.BANKACCTFROM(id=account_id, bankid='021000021', acctid=str(account_id),
+                                              accttype='CHECKING')
+            db.session.add(account)
+            db.session.commit()
+            return account
+
+        def add_journal_entry(transaction_id):
+            journal_entry = JournalEntries(transaction_id=transaction_id, transaction_source='ofx',
+                                           timestamp=datetime(2016, 1, 4, tzinfo=tzlocal()),
+                                           debit_subaccount='Rent', credit_subaccount='Chase Checking',
+                                           functional_amount=Decimal('3'), functional_currency='USD',
+                                           source_amount=Decimal('3'), source_currency='USD')
+            db.session.add(journal_entry)
+            db.session.commit()
+            return journal_entry
+
+        # Both used to get the key '123'
+        account, other_account = add_account(3), add_account(23)
+        self.add_statement_transaction(account, '12', 'Coffee')
+        self.add_statement_transaction(other_account, '1', 'Tea')
+        self.add_statement_transaction(account, '7', 'Cake')
+        self.assertEqual(sorted(db.session.query(Transactions.id, Transactions.description)),
+                         [('23:1', 'Tea'), ('3:12', 'Coffee'), ('3:7', 'Cake')])
+        db.session.commit()
+        with self.assertRaises(IntegrityError):
+            db.engine.execute("UPDATE ofx.stmttrn SET transaction_key = '3:12';")
+
+        # As on a database keyed before the separator
+        db.engine.execute('DROP INDEX ofx.stmttrn_transaction_key_index;')
+        db.engine.execute('UPDATE ofx.stmttrn SET transaction_key = concat(fitid, acctfrom_id);')
+        cake_entry = add_journal_entry('73')
+        ambiguous_entry = add_journal_entry('123')
+        with self.assertRaises(ValueError):
+            create_ofx_transaction_key_trigger_function()
+        db.session.expire_all()
+        self.assertEqual(cake_entry.transaction_id, '73')
+        db.session.commit()
+
+        db.session.delete(ambiguous_entry)
+        db.session.commit()
+        create_ofx_transaction_key_trigger_function()
+        db.session.expire_all()
+        self.assertEqual(cake_entry.transaction_id, '3:7')
+        cake = db.session.query(Transactions).filter(Transactions.id == '3:7').one()
+        self.assertEqual(cake.journal_entry_id, cake_entry.id)
+        with self.assertRaises(IntegrityError):
+            db.engine.execute("UPDATE ofx.stmttrn SET transaction_key = '3:12';")
+
+    def test_transactions_search(self):
+        from flask import current_app
+        from pacioli.extensions import admin
+
+        account = self.add_bank_account()
+        transaction = self.add_statement_transaction(account, '1', 'Blue Coffee', memo='Shop #12')
+        self.add_statement_transaction(account, '2', 'Corner Tea', dtposted=datetime(2016, 1, 5))
+        view = [view for view in admin._views if view.endpoint == 'banking/transactions'][0]
+
+        def search(term):
+            with current_app.test_request_context(view.url + '/'):
+                count, page = view.get_list(0, None, False, term, [], page_size=20)
+            return [row.description for row in page]
+
+        # The search box matches the lowercased name and memo, which the
+        # trigram index covers
+        self.assertEqual([column.name for column, joins in view._search_fields], ['description_lc'])
+        self.assertEqual(search('COFFEE shop'), ['Blue CoffeeShop #12'])
+        self.assertEqual(search('coffeeshop'), ['Blue CoffeeShop #12'])
+        self.assertEqual(search('tea'), ['Corner Tea'])
+
+        transaction.memo = 'Kiosk'
+        db.session.commit()
+        self.assertEqual(search('shop'), [])
+        self.assertEqual(search('KIOSK'), ['Blue CoffeeKiosk'])
+
+        with db.engine.connect() as connection:
+            connection.execute('SET enable_seqscan = off;')
+            plan = '\n'.join(row for row, in connection.execute(
+                "EXPLAIN SELECT * FROM ofx.stmttrn WHERE description_lc ILIKE '%%coffee%%';"))
+        self.assertIn('stmttrn_description_lc_trgm_index', plan)
+
+    def test_statement_window(self):
+        from pacioli.functions.ofx_functions import (prepare_ofx_request, statement_window, sync_ofx,
+                                                     update_watermark)
+
+        # Nothing listens on the connection's url, so syncing only sets up
+        # the watermark before its download fails
+        connection = Connections(source='ofx', type='Checking', routing_number='021000021',
+                                 account_number='1234', url='http://127.0.0.1:1/', org='Bank', fid='1',
+                                 user='user', password='password')
+        db.session.add(connection)
+        db.session.commit()
+        # Nothing loaded yet, the full history is requested
+        self.assertEqual(statement_window(connection, overlap_days=7), (None, None))
+        self.assertNotIn(b'<DTSTART>', prepare_ofx_request(connection, overlap_days=7)['body'])
+        sync_ofx(timeout=1)
+        self.assertIsNone(connection.watermark_date)
+
+        account = self.add_bank_account(acctid='1234')
+        self.add_statement_transaction(account, '1', 'Coffee', dtposted=datetime(2016, 1, 4))
+        self.add_statement_transaction(account, '2', 'Coffee', dtposted=datetime(2016, 1, 10, 12))
+        self.add_statement_transaction(account, '3', 'Coffee', dtposted=datetime(2016, 1, 10, 12))
+        other_account = self.add_bank_account(acctid='5678')
+        self.add_statement_transaction(other_account, '4', 'Coffee', dtposted=datetime(2016, 2, 1))
+
+        # Reading the window leaves the connection alone
+        self.assertEqual(statement_window(connection, overlap_days=7), (None, None))
+        self.assertFalse(db.session.dirty)
+
+        # The sync starts the watermark from the transactions already loaded
+        # for the account
+        sync_ofx(timeout=1)
+        db.session.expire_all()
+        self.assertEqual((connection.watermark_date, connection.watermark_fitid),
+                         (datetime(2016, 1, 10, 12, tzinfo=tzutc()), '3'))
+        self.assertEqual(statement_window(connection, overlap_days=7), (date(2016, 1, 3), date.today()))
+
+        self.add_statement_transaction(account, '5', 'Coffee', dtposted=datetime(2016, 1, 20, 12))
+        self.assertEqual(statement_window(connection, overlap_days=7), (date(2016, 1, 3), date.today()))
+        update_watermark(connection)
+        db.session.commit()
+        self.assertEqual(connection.watermark_fitid, '5')
+        self.assertEqual(statement_window(connection), (date(2016, 1, 20), date.today()))
+
+    def test_store_response_blob(self):
+        from pacioli.functions.ofx_functions import SpooledResponse, response_text, store_response_blob
+
+        body = b'<OFX><SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO'
+        response = SpooledResponse()
+        response.write(body)
+        response.finish()
+        self.assertTrue(store_response_blob(response.sha256, response.size, response.compressed))
+        self.assertFalse(store_response_blob(response.sha256, response.size, response.compressed))
+        db.session.commit()
+
+        blob = db.session.query(ResponseBlobs).one()
+        self.assertEqual(blob.size, len(body))
+        self.assertEqual(response_text(blob.content), body.decode('utf-8'))
+
+    def test_archive_connection_responses(self):
+        from pacioli.functions.ofx_functions import archive_connection_responses, response_text
+
+        connection = Connections(source='ofx', type='Checking')
+        db.session.add(connection)
+        bodies = [b'<OFX>first</OFX>', b'<OFX>second</OFX>', b'<OFX>first</OFX>']
+        for body in bodies:
+            db.session.add(ConnectionResponses(connection=connection, connected_at=datetime.now(tzlocal()),
+                                               response=body))
+        db.session.commit()
+
+        self.assertEqual(archive_connection_responses(batch_size=2), (3, 2))
+        self.assertEqual(archive_connection_responses(), (0, 0))
+        db.session.expire_all()
+        for connection_response, body in zip(db.session.query(ConnectionResponses)
+                                             .order_by(ConnectionResponses.id), bodies):
+            self.assertIsNone(connection_response.response)
+            self.assertEqual(connection_response.response_sha256, hashlib.sha256(body).hexdigest())
+            self.assertEqual(response_text(connection_response.response_blob.content), body.decode('utf-8'))
+        self.assertEqual(db.session.query(ResponseBlobs).count(), 2)
+
+    def test_keyset_filter(self):
+        from pacioli.functions.amazon_functions import load_amazon_csv
+        from pacioli.views import PrivateModelView
+
+        report = (u'Order Date,Order ID,Title,Category,Item Total,Quantity,Shipment Date\n'
+                  u'01/02/16,A1,Book,Books,$1.00,1,01/03/16\n'
+                  u'01/02/16,A1,Pen,Books,$1.00,1,\n'
+                  u'01/02/16,A1,Cup,Books,$1.00,1,01/03/16\n'
+                  u'01/05/16,A2,Mug,Books,$1.00,1,\n'
+                  u'01/05/16,A2,Lamp,Books,$1.00,1,01/01/16\n')
+        load_amazon_csv(io.StringIO(report))
+
+        # NULL shipment dates sort last ascending and first descending
+        for direction in (db.asc, db.desc):
+            order = (direction(AmazonItems.shipment_date), direction(AmazonItems.id))
+            expected = [item_id for item_id, in db.session.query(AmazonItems.id).order_by(*order)]
+            item_ids = []
+            anchor = None
+            while True:
+                query = db.session.query(AmazonItems.shipment_date, AmazonItems.id)
+                if anchor is not None:
+                    query = query.filter(PrivateModelView.keyset_filter(AmazonItems.shipment_date, AmazonItems.id,
+                                                                        direction is db.desc, *anchor))
+                page = query.order_by(*order).limit(2).all()
+                if not page:
+                    break
+                item_ids.extend(item_id for shipment_date, item_id in page)
+                anchor = page[-1]
+            self.assertEqual(item_ids, expected)
+
+    def test_keyset_pagination(self):
+        from flask import current_app
+        from pacioli.extensions import admin
+        from pacioli.functions.amazon_functions import load_amazon_csv
+
+        report = (u'Order Date,Order ID,Title,Category,Item Total,Quantity,Shipment Date\n'
+                  u'01/02/16,A1,Book,Books,$1.00,1,01/03/16\n'
+                  u'01/02/16,A1,Pen,Books,$1.00,1,\n'
+                  u'01/05/16,A2,Mug,Books,$1.00,1,01/06/16\n')
+        load_amazon_csv(io.StringIO(report))
+        view = [view for view in admin._views if view.endpoint == 'amazonitems'][0]
+        expected = [item_id for item_id, in db.session.query(AmazonItems.id)
+                    .order_by(AmazonItems.shipment_date.desc(), AmazonItems.id.desc())]
+
+        def page_ids(after):
+            with current_app.test_request_context(view.url + '/?after=' + after):
+                count, page = view.get_list(0, None, False, None, [], page_size=2)
+            return [item.id for item in page]
+
+        self.assertEqual(page_ids(''), expected[:2])
+        self.assertEqual(page_ids(str(expected[1])), expected[2:])
+        # Keys that are malformed or gone start over from the first page
+        self.assertEqual(page_ids('not-a-key'), expected[:2])
+        self.assertEqual(page_ids('0'), expected[:2])
+
+    def test_transactions_keyset_pages(self):
+        from flask import current_app
+        from pacioli.extensions import admin
+        from pacioli.models import Transactions
+
+        account = self.add_bank_account()
+        other_account = self.add_bank_account(acctid='5678')
+        # Ties on the sorted date are broken by the key
+        for day, fitids in ((4, ['1', '2', '3']), (5, ['4']), (6, ['5', '6'])):
+            for fitid in fitids:
+                self.add_statement_transaction(account, fitid, 'Coffee', dtposted=datetime(2016, 1, day))
+                self.add_statement_transaction(other_account, fitid, 'Tea', dtposted=datetime(2016, 1, day))
+        view = [view for view in admin._views if view.endpoint == 'banking/transactions'][0]
+        expected = [transaction_id for transaction_id, in db.session.query(Transactions.id)
+                    .order_by(Transactions.date.desc(), Transactions.id.desc())]
+
+        def page_ids(after=''):
+            with current_app.test_request_context(view.url + '/?after=' + after):
+                count, page = view.get_list(0, None, False, None, [], page_size=5)
+            return [transaction.id for transaction in page]
+
+        pages = [page_ids()]
+        # Rows added before the anchor do not shift the following pages
+        self.add_statement_transaction(account, '7', 'Coffee', dtposted=datetime(2016, 1, 7))
+        while pages[-1]:
+            pages.append(page_ids(pages[-1][-1]))
+        self.assertEqual([len(page) for page in pages], [5, 5, 2, 0])
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(page_ids(pages[0][-1]), pages[1])
+
+        # The order comes from the list query, not from the view
+        definition = db.engine.execute("SELECT pg_get_viewdef('ofx.transactions'::regclass);").scalar()
+        self.assertNotIn('ORDER BY', definition.upper())
+
+    def test_table_versions(self):
+        from pacioli.functions.bookkeeping_functions import write_journal_entries
+
+        def journal_entries_versions():
+            return [version for version, in db.session.query(TableVersions.version)
+                    .filter(TableVersions.table_name == 'bookkeeping.journal_entries')
+                    .order_by(TableVersions.version)]
+
+        versions = journal_entries_versions()
+        journal_entries = [dict(transaction_id=str(transaction_id),
+                                transaction_source='test',
+                                timestamp=datetime.now(tzlocal()),
+                                debit_subaccount='Coffee',
+                                credit_subaccount='Chase Checking',
+                                functional_amount=Decimal('3'),
+                                functional_currency='USD',
+                                source_amount=Decimal('3'),
+                                source_currency='USD')
+                           for transaction_id in range(3)]
+        write_journal_entries(journal_entries, ['Coffee'])
+        # Older versions are pruned as new ones are added
+        self.assertEqual(len(journal_entries_versions()), 1)
+        self.assertNotEqual(journal_entries_versions(), versions)
+        versions = journal_entries_versions()
+
+        db.session.query(JournalEntries).delete()
+        db.session.commit()
+        self.assertNotEqual(journal_entries_versions(), versions)
+        versions = journal_entries_versions()
+
+        def connection_responses_versions():
+            versions = [version for version, in db.session.query(TableVersions.version)
+                        .filter(TableVersions.table_name == 'admin.connection_responses')
+                        .order_by(TableVersions.version)]
+            db.session.commit()
+            return versions
+
+        # Concurrent writers of a table do not wait on each other's version,
+        # and each commit changes the versions of the table
+        connection = Connections(source='ofx', type='Checking')
+        db.session.add(connection)
+        db.session.commit()
+        versions = connection_responses_versions()
+        insert_response = ConnectionResponses.__table__.insert().values(connection_id=connection.id)
+        first_connection, second_connection = db.engine.connect(), db.engine.connect()
+        first_transaction, second_transaction = first_connection.begin(), second_connection.begin()
+        try:
+            second_connection.execute("SET LOCAL lock_timeout = '1s';")
+            first_connection.execute(insert_response)
+            second_connection.execute(insert_response)
+            second_transaction.commit()
+            second_versions = connection_responses_versions()
+            first_transaction.commit()
+        finally:
+            first_connection.close()
+            second_connection.close()
+        self.assertNotEqual(second_versions, versions)
+        self.assertNotEqual(connection_responses_versions(), second_versions)
+        self.assertEqual(db.session.query(ConnectionResponses).count(), 2)
+
+    def test_cached_list_count(self):
+        from flask import current_app
+        from pacioli.extensions import admin
+
+        view = [view for view in admin._views if view.endpoint == 'connection-responses'][0]
+        connection = Connections(source='ofx', type='Checking')
+        db.session.add(connection)
+        for _ in range(2):
+            db.session.add(ConnectionResponses(connection=connection, connected_at=datetime.now(tzlocal())))
+        db.session.commit()
+
+        def list_count():
+            with current_app.test_request_context(view.url + '/'):
+                return view.get_list(0, None, False, None, [])[0]
+
+        self.assertEqual(list_count(), 2)
+        # The insert bumps the table version, so the cached count is not reused
+        db.session.add(ConnectionResponses(connection=connection, connected_at=datetime.now(tzlocal())))
+        db.session.commit()
+        self.assertEqual(list_count(), 3)
+
+    def test_estimated_list_count(self):
+        from flask import current_app
+        from pacioli.extensions import admin, cache
+
+        view = [view for view in admin._views if view.endpoint == 'banking/transactions'][0]
+        account = self.add_bank_account()
+        for fitid in ('1', '2', '3'):
+            self.add_statement_transaction(account, fitid, 'Coffee')
+        db.engine.execute('ANALYZE ofx.stmttrn;')
+        for fitid in ('4', '5'):
+            self.add_statement_transaction(account, fitid, 'Coffee')
+
+        def list_count():
+            cache.clear()
+            with current_app.test_request_context(view.url + '/'):
+                return view.get_list(0, None, False, None, [])[0]
+
+        # Small tables are counted exactly, even unfiltered
+        self.assertEqual(list_count(), 5)
+        current_app.config['COUNT_ESTIMATE_THRESHOLD'] = 2
+        try:
+            self.assertEqual(list_count(), 3)
+        finally:
+            current_app.config['COUNT_ESTIMATE_THRESHOLD'] = TestConfig.COUNT_ESTIMATE_THRESHOLD
+
+    def test_load_amazon_csv(self):
+        from pacioli.functions.amazon_functions import load_amazon_csv
+
+        report = (u'Order Date,Order ID,Title,Category,Item Total,Quantity,Shipment Date\n'
+                  u'01/02/16,A1,Book,,"$1,234.50",2,01/03/16\n'
+                  u'01/02/16,A1,Pen,Office Product,$1.00,1,\n'
+                  u'01/05/16,A2,Cup,Kitchen,$3.00,1,01/06/16\n')
+        self.assertEqual(load_amazon_csv(io.StringIO(report), batch_size=2), (3, 3))
+        self.assertEqual(load_amazon_csv(io.StringIO(report), batch_size=2), (3, 0))
+
+        book = db.session.query(AmazonItems).filter(AmazonItems.title == 'Book').one()
+        self.assertEqual(book.category_id, 'Other')
+        self.assertEqual(book.item_total, Decimal('1234.50'))
+        self.assertEqual(db.session.query(AmazonOrders).count(), 2)
+
+    def test_apply_amazon_mappings(self):
+        from pacioli.functions.amazon_functions import apply_all_mappings, load_amazon_csv
+
+        report = (u'Order Date,Order ID,Title,Category,Item Total,Quantity,Shipment Date\n'
+                  u'01/02/16,A1,Cookbook,Books,$20.00,1,01/03/16\n'
+                  u'01/02/16,A1,Coffee Mug,Kitchen,$8.00,1,01/03/16\n'
+                  u'01/05/16,A2,Books Tote Bag,Apparel,$0.00,1,01/06/16\n'
+                  u'01/05/16,A2,Stapler,Office Product,$5.00,1,01/06/16\n')
+        load_amazon_csv(io.StringIO(report))
+        for name in ('Books', 'Kitchenware'):
+            db.session.add(Subaccounts(name=name, parent='Discretionary Costs'))
+        db.session.add(Mappings(source='amazon', keyword='books',
+                                positive_debit_subaccount_id='Books',
+                                positive_credit_subaccount_id='Chase Checking'))
+        db.session.add(Mappings(source='amazon', keyword='mug',
+                                positive_debit_subaccount_id='Kitchenware',
+                                positive_credit_subaccount_id='Chase Checking'))
+        db.session.add(Mappings(source='ofx', keyword='stapler',
+                                positive_debit_subaccount_id='Kitchenware',
+                                positive_credit_subaccount_id='Chase Checking'))
+        db.session.commit()
+
+        self.assertEqual(apply_all_mappings(), (2, 0))
+        self.assertEqual(apply_all_mappings(), (0, 0))
+        debits = dict(db.session.query(JournalEntries.functional_amount, JournalEntries.debit_subaccount))
+        self.assertEqual(debits, {Decimal('20.00'): 'Books', Decimal('8.00'): 'Kitchenware'})
+
+    def test_apply_single_amazon_mapping(self):
+        from pacioli.functions.amazon_functions import apply_single_amazon_mapping, load_amazon_csv
+
+        report = (u'Order Date,Order ID,Title,Category,Item Total,Quantity,Shipment Date\n'
+                  u'01/02/16,A1,Cookbook,Books,$20.00,1,01/03/16\n'
+                  u'01/02/16,A1,Coffee Mug Books,Kitchen,$8.00,1,01/03/16\n'
+                  u'01/05/16,A2,Books Tote Bag,Apparel,$0.00,1,01/06/16\n'
+                  u'01/05/16,A2,Stapler,Office Product,$5.00,1,01/06/16\n')
+        load_amazon_csv(io.StringIO(report))
+        for name in ('Books', 'Kitchenware'):
+            db.session.add(Subaccounts(name=name, parent='Discretionary Costs'))
+        books = Mappings(source='amazon', keyword='books',
+                         positive_debit_subaccount_id='Books',
+                         positive_credit_subaccount_id='Chase Checking')
+        stapler = Mappings(source='ofx', keyword='stapler',
+                           positive_debit_subaccount_id='Kitchenware',
+                           positive_credit_subaccount_id='Chase Checking')
+        db.session.add_all([books, stapler])
+        # The more specific keyword wins the mug like in apply_all_mappings
+        db.session.add(Mappings(source='amazon', keyword='coffee mug',
+                                positive_debit_subaccount_id='Kitchenware',
+                                positive_credit_subaccount_id='Chase Checking'))
+        db.session.commit()
+
+        # The free tote bag is skipped rather than failing the mapping
+        self.assertEqual(apply_single_amazon_mapping(books.id), (1, 0))
+        self.assertEqual(apply_single_amazon_mapping(books.id), (0, 0))
+        debits = dict(db.session.query(JournalEntries.functional_amount, JournalEntries.debit_subaccount))
+        self.assertEqual(debits, {Decimal('20.00'): 'Books'})
+        with self.assertRaises(ValueError):
+            apply_single_amazon_mapping(stapler.id)
+
+    def test_import_amazon_csv_files(self):
+        import os
+        import shutil
+        import tempfile
+        from pacioli.functions.amazon_functions import import_amazon_csv_files
+
+        header = 'Order Date,Order ID,Title,Category,Item Total,Quantity,Shipment Date\n'
+        reports = {'january.csv': header + '01/02/16,A1,Book,Books,$10.00,1,01/03/16\n'
+                                           '01/30/16,A2,Cup,Kitchen,$3.00,1,02/01/16\n',
+                   'february.csv': header + '01/30/16,A2,Cup,Kitchen,$3.00,1,02/01/16\n'
+                                            '02/10/16,A3,Pen,Office Product,$1.00,1,02/11/16\n'}
+        reports['january copy.csv'] = reports['january.csv']
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for file_name, report in reports.items():
+                paths.append(os.path.join(directory, file_name))
+                with open(paths[-1], 'w') as csv_file:
+                    csv_file.write(report)
+            report = import_amazon_csv_files(paths)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual(report['skipped'], 1)
+        self.assertEqual(report['items'], 3)
+        self.assertEqual(db.session.query(AmazonItems).count(), 3)
+
+    def test_update_ticker_prices(self):
+        from pacioli.functions.investment_functions import PriceProvider, update_ticker_prices
+
+        class StubPriceProvider(PriceProvider):
+            def __init__(self):
+                self.requests = []
+
+            def fetch(self, ticker, start, end):
+                self.requests.append((ticker, start, end))
+                if ticker == 'XYZ':
+                    raise LookupError('No price file XYZ.csv')
+                # Also resends a day that is already stored
+                return [dict(ticker=ticker, date=date(2016, 1, day), open=None, high=None, low=None,
+                             close=Decimal(price), adjusted_close=Decimal(price), volume=None)
+                        for day, price in ((5, '121'), (6, '130'))]
+
+        db.session.add_all([SecurityPrices(ticker='VTI', date=date(2016, 1, day), adjusted_close=Decimal(price))
+                            for day, price in ((4, '110'), (5, '120'))])
+        db.session.add_all([ofx_models.MFINFO(uniqueidtype='CUSIP', uniqueid=uniqueid, secname=ticker, ticker=ticker)
+                            for uniqueid, ticker in (('922908769', 'VTI'), ('123456789', 'ABC'),
+                                                     ('987654321', 'XYZ'))])
+        db.session.commit()
+
+        provider = StubPriceProvider()
+        summary = update_ticker_prices(provider, workers=2, batch_size=1)
+        # Only the gap after the latest stored price is fetched
+        self.assertEqual(sorted(provider.requests), [('ABC', None, date.today()),
+                                                     ('VTI', date(2016, 1, 6), date.today()),
+                                                     ('XYZ', None, date.today())])
+        self.assertEqual(dict((ticker, status) for ticker, rows, status, seconds in summary),
+                         {'ABC': 'OK', 'VTI': 'OK', 'XYZ': 'LookupError: No price file XYZ.csv'})
+        prices = dict(((price.ticker, price.date.day), price.adjusted_close)
+                      for price in db.session.query(SecurityPrices))
+        self.assertEqual(prices, {('VTI', 4): Decimal('110'), ('VTI', 5): Decimal('121'), ('VTI', 6): Decimal('130'),
+                                  ('ABC', 5): Decimal('121'), ('ABC', 6): Decimal('130')})
+        self.assertEqual(sorted(db.session.query(LatestPrices.ticker, LatestPrices.date)),
+                         [('ABC', date(2016, 1, 6)), ('VTI', date(2016, 1, 6))])
+
+        provider = StubPriceProvider()
+        update_ticker_prices(provider)
+        self.assertEqual(sorted(provider.requests), [('ABC', date(2016, 1, 7), date.today()),
+                                                     ('VTI', date(2016, 1, 7), date.today()),
+                                                     ('XYZ', None, date.today())])
+        self.assertEqual(db.session.query(SecurityPrices).count(), 5)
+
+    def test_position_snapshots(self):
+        db.session.add_all([SecurityPrices(ticker='VTI', date=datetime(2016, 1, day).date(),
+                                           adjusted_close=Decimal(price))
+                            for day, price in ((4, '110'), (5, '120'), (1, '90'))])
+        security = ofx_models.MFINFO(uniqueidtype='CUSIP', uniqueid='922908769',
+                                     secname='Total Stock Market', ticker='VTI')
+        account = ofx_models.INVACCTFROM(brokerid='vanguard.com', acctid='5678', name='Vanguard Brokerage')
+        db.session.add_all([security, account])
+        db.session.commit()
+
+        latest_price = db.session.query(LatestPrices).filter(LatestPrices.ticker == 'VTI').one()
+        self.assertEqual(latest_price.date, datetime(2016, 1, 5).date())
+
+        def snapshot():
+            db.session.expire_all()
+            return db.session.query(PositionSnapshots).filter(PositionSnapshots.ticker == 'VTI').one()
+
+        db.session.add(ofx_models.BUYMF(acctfrom=account, secinfo=security, fitid='1', buytype='BUY',
+                                        dttrade=datetime(2016, 1, 2), units=Decimal('10'),
+                                        unitprice=Decimal('100'), total=Decimal('-1000')))
+        db.session.commit()
+        position = snapshot()
+        self.assertEqual(position.secname, 'Total Stock Market')
+        self.assertEqual((position.total_units, position.cost_basis), (Decimal('10'), Decimal('1000')))
+        self.assertEqual(position.close, Decimal('120'))
+        self.assertEqual(position.price_date, datetime(2016, 1, 5).date())
+        self.assertEqual(position.market_value, Decimal('1200'))
+        self.assertEqual(position.pnl, Decimal('200'))
+
+        reinvestment = ofx_models.REINVEST(acctfrom=account, secinfo=security, fitid='2', incometype='DIV',
+                                           dttrade=datetime(2016, 1, 3), units=Decimal('1'),
+                                           unitprice=Decimal('100'), total=Decimal('-100'))
+        sale = ofx_models.SELLMF(acctfrom=account, secinfo=security, fitid='3', selltype='SELL',
+                                 dttrade=datetime(2016, 1, 4), units=Decimal('-5'),
+                                 unitprice=Decimal('120'), total=Decimal('600'))
+        db.session.add_all([reinvestment, sale])
+        db.session.commit()
+        position = snapshot()
+        self.assertEqual((position.total_units, position.cost_basis), (Decimal('6'), Decimal('500')))
+        self.assertEqual(position.market_value, Decimal('720'))
+
+        # Updates apply the difference between the old and the new rows
+        reinvestment.units = Decimal('2')
+        reinvestment.total = Decimal('-200')
+        db.session.commit()
+        position = snapshot()
+        self.assertEqual((position.total_units, position.cost_basis), (Decimal('7'), Decimal('600')))
+
+        db.session.delete(sale)
+        db.session.commit()
+        position = snapshot()
+        self.assertEqual((position.total_units, position.cost_basis), (Decimal('12'), Decimal('1200')))
+        self.assertEqual(position.pnl, Decimal('240'))
+
+        db.session.query(SecurityPrices).filter(SecurityPrices.date == datetime(2016, 1, 5).date()).delete()
+        db.session.commit()
+        position = snapshot()
+        self.assertEqual(position.price_date, datetime(2016, 1, 4).date())
+        self.assertEqual(position.market_value, Decimal('1320'))
+
+        # createdb backfills both tables from the existing rows
+        from pacioli.database.sql_views import create_position_snapshots_trigger_function
+        db.session.commit()
+        with db.engine.begin() as connection:
+            connection.execute('TRUNCATE investments.latest_prices, investments.position_snapshots')
+        create_position_snapshots_trigger_function()
+        position = snapshot()
+        self.assertEqual((position.total_units, position.cost_basis), (Decimal('12'), Decimal('1200')))
+        self.assertEqual(position.market_value, Decimal('1320'))
+
+
+class MappingMatcherTestCase(unittest.TestCase):
+    def test_precedence(self):
+        from collections import namedtuple
+        from pacioli.functions.mapping_functions import MappingMatcher
+
+        Mapping = namedtuple('Mapping', ['id', 'keyword'])
+        mappings = [Mapping(3, 'uber'), Mapping(1, 'amazon'), Mapping(2, 'amazon prime'),
+                    Mapping(4, 'uber eats'), Mapping(5, 'ub_r')]
+        mappings += [Mapping(100 + i, 'keyword{0}'.format(i)) for i in range(200)]
+        matcher = MappingMatcher(mappings)
+
+        self.assertEqual(matcher.match('AMAZON MKTPLACE').id, 1)
+        self.assertEqual(matcher.match('Amazon.com Prime Video').id, 2)
+        self.assertEqual(matcher.match('prime amazon').id, 1)
+        self.assertEqual(matcher.match('UBER *EATS').id, 4)
+        self.assertEqual(matcher.match('Uber trip').id, 3)
+        self.assertEqual(matcher.match('UBAR trip').id, 5)
+        self.assertEqual(matcher.match('Paid keyword199').id, 299)
+        self.assertIsNone(matcher.match('Starbucks'))
+        self.assertIsNone(matcher.match(None))
+
+
+def ofx_session_binding(_):
+    import os
+    from pacioli import database
+    session = database.OFXSession()
+    return (os.getpid(), session.get_bind() is database.worker_engine,
+            database.worker_engine.pool.size(), session.execute('SELECT current_database();').scalar())
+
+
+class StubOFXHandler(BaseHTTPRequestHandler):
+    concurrent_requests = 0
+    max_concurrent_requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        with self.lock:
+            StubOFXHandler.concurrent_requests += 1
+            StubOFXHandler.max_concurrent_requests = max(StubOFXHandler.max_concurrent_requests,
+                                                         StubOFXHandler.concurrent_requests)
+        try:
+            self.rfile.read(int(self.headers['Content-Length']))
+            if self.path == '/slow':
+                time.sleep(1)
+            else:
+                time.sleep(0.1)
+            body = b'OFXHEADER:100\r\n\r\n<OFX><SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ofx')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with self.lock:
+                StubOFXHandler.concurrent_requests -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubOFXServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# The OFX functions import the reflected view models, so these tests run
+# against a database as well
+class OFXDownloadTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(OFXDownloadTestCase, self).setUp()
+        StubOFXHandler.max_concurrent_requests = 0
+        self.server = StubOFXServer(('127.0.0.1', 0), StubOFXHandler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(OFXDownloadTestCase, self).tearDown()
+
+    def prepared_request(self, connection_id, path='/'):
+        return dict(connection_id=connection_id,
+                    url=self.url + path,
+                    body=b'<OFX></OFX>',
+                    headers={'Content-type': 'application/x-ofx'})
+
+    def host_semaphores(self, host_concurrency):
+        return {urlparse(self.url).netloc: threading.BoundedSemaphore(host_concurrency)}
+
+    def test_download(self):
+        from pacioli.functions.ofx_functions import download_ofx
+
+        connection_id, response, error, seconds = download_ofx(self.prepared_request(1),
+                                                               self.host_semaphores(1), timeout=5)
+        self.assertEqual(connection_id, 1)
+        self.assertIsNone(error)
+        self.assertIn('<SEVERITY>INFO', response.reader().read())
+        self.assertFalse(response.has_error)
+
+    def test_spooled_response(self):
+        from pacioli.functions.ofx_functions import SpooledResponse, response_text
+
+        body = u'<OFX><STATUS><CODE>2000<SEVERITY>ERROR<MESSAGE>Caf\u00e9</OFX>'.encode('utf-8')
+        # Small enough to roll over to a file part way through
+        response = SpooledResponse(max_size=16)
+        # Split the error marker and the multi-byte character across chunks
+        for chunk_start in range(0, len(body), 7):
+            response.write(body[chunk_start:chunk_start + 7])
+        response.finish()
+        self.assertTrue(response.has_error)
+        self.assertEqual(response.size, len(body))
+        self.assertEqual(response.sha256, hashlib.sha256(body).hexdigest())
+        self.assertEqual(response.reader().read(), body.decode('utf-8'))
+        self.assertEqual(response_text(response.compressed), body.decode('utf-8'))
+
+    def test_response_status(self):
+        from pacioli.functions.ofx_functions import response_status
+
+        sgml = ('OFXHEADER:100\r\n\r\n<OFX><SIGNONMSGSRSV1><SONRS><STATUS><CODE>15500\r\n'
+                '<SEVERITY>ERROR\r\n<MESSAGE>Signon invalid\r\n</STATUS></SONRS></SIGNONMSGSRSV1>'
+                '<BANKMSGSRSV1><STMTTRNRS><TRNUID>1<STATUS><CODE>2000<SEVERITY>ERROR</STATUS>'
+                '</STMTTRNRS></BANKMSGSRSV1></OFX>')
+        self.assertEqual(response_status(sgml), 'SONRS 15500: Signon invalid; STMTTRNRS 2000')
+        xml = ('<OFX><SIGNONMSGSRSV1><SONRS><STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>'
+               '</SONRS></SIGNONMSGSRSV1><CREDITCARDMSGSRSV1><CCSTMTTRNRS><TRNUID>1</TRNUID><STATUS>'
+               '<CODE>2003</CODE><SEVERITY>ERROR</SEVERITY><MESSAGE>Account not found</MESSAGE></STATUS>'
+               '</CCSTMTTRNRS></CREDITCARDMSGSRSV1></OFX>')
+        self.assertEqual(response_status(xml), 'CCSTMTTRNRS 2003: Account not found')
+        self.assertEqual(response_status('<HTML>Service unavailable</HTML>'), 'Unrecognized error response')
+
+    def test_timeout(self):
+        from pacioli.functions.ofx_functions import download_ofx
+
+        connection_id, response, error, seconds = download_ofx(self.prepared_request(1, '/slow'),
+                                                               self.host_semaphores(1), timeout=0.2)
+        self.assertIsNone(response)
+        self.assertIsNotNone(error)
+        self.assertLess(seconds, 1)
+
+    def test_host_concurrency(self):
+        from pacioli.functions.ofx_functions import download_ofx
+
+        pool = ThreadPool(4)
+        results = pool.map(partial(download_ofx, host_semaphores=self.host_semaphores(2), timeout=5),
+                           [self.prepared_request(connection_id) for connection_id in range(6)])
+        pool.close()
+        pool.join()
+        self.assertEqual(sorted(result[0] for result in results), list(range(6)))
+        self.assertTrue(all(result[2] is None for result in results))
+        self.assertEqual(StubOFXHandler.max_concurrent_requests, 2)
+
+
+class OFXImportTestCase(DatabaseTestCase):
+    def test_fix_ofx_lines(self):
+        from pacioli.functions.ofx_functions import fix_ofx_lines
+
+        lines = ['<SECID>\n', '<UNIQUEID>123\n', '<TICKER>ABC\n', '</SECID>\n',
+                 '<SECID>\n', '<UNIQUEID>456\n', '<HELDINACCT>CASH\n']
+        self.assertEqual(list(fix_ofx_lines(lines)),
+                         ['<SECID>\n', '<UNIQUEID>123\n', '<TICKER>ABC\n', '</SECID>\n',
+                          '<SECID>\n', '<UNIQUEID>456\n', '</SECID>\n', '<HELDINACCT>CASH\n'])
+
+
+class PriceProviderTestCase(unittest.TestCase):
+    def test_csv_directory_provider(self):
+        import os
+        import shutil
+        import tempfile
+        from datetime import date
+        from pacioli.functions.investment_functions import CSVDirectoryProvider
+
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'ABC.csv'), 'w') as csv_file:
+                csv_file.write('Date,Open,High,Low,Close,Adj Close,Volume\n'
+                               '2017-01-03,10.0,11.0,9.5,10.5,10.25,1000\n'
+                               '2017-01-04,10.5,12.0,10.0,11.5,11.25,2000\n'
+                               '2017-01-05,null,null,null,null,null,null\n')
+            provider = CSVDirectoryProvider(directory)
+            prices = provider.fetch('ABC', date(2017, 1, 4), date(2017, 1, 5))
+            with self.assertRaises(LookupError):
+                provider.fetch('XYZ', None, date(2017, 1, 5))
+            self.assertEqual(len(provider.fetch('ABC', None, date(2017, 1, 5))), 3)
+        finally:
+            shutil.rmtree(directory)
+        with self.assertRaises(ValueError):
+            CSVDirectoryProvider(directory)
+
+        self.assertEqual([price['date'] for price in prices], [date(2017, 1, 4), date(2017, 1, 5)])
+        self.assertEqual(prices[0]['adjusted_close'], Decimal('11.25'))
+        self.assertEqual(prices[0]['volume'], Decimal('2000'))
+        self.assertIsNone(prices[1]['close'])
+
+
 if __name__ == '__main__':
     unittest.main()